@@ -1,14 +1,35 @@
 """
 Main application entry point.
 """
-from fastapi import FastAPI
+from backend.utils import startup
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, PlainTextResponse
+import logging
 import os
+import time
 from pathlib import Path
 
+from backend.utils.logging_setup import configure_logging, shutdown_logging
+configure_logging()
+
 from backend.routes.generation_routes import router as generation_router
-from backend.config.settings import UPLOAD_DIR, RESULT_DIR
+from backend.routes.admin_routes import router as admin_router
+from backend.config.settings import MAX_FILE_SIZE, WARM_UP_PROVIDERS, SESSION_COOKIE_NAME, SESSION_COOKIE_MAX_AGE
+from backend.services.service_factory import SERVICES, available_services, warm_up
+from backend.services.job_manager import job_manager
+from backend.services.history_store import history_store, session_id_from, new_session_id
+from backend.utils.artifact_index import artifact_index
+from backend.utils.shared_state import shared_state, WORKER_ID
+from backend.utils.photoroom_client import photoroom_client
+from backend.utils.workers import shutdown_process_pool
+from backend.utils.derivatives import ResultFiles
+from backend.utils.storage import StorageFiles, upload_store, result_store
+from backend.utils import metrics
+from backend.utils import tracing
+from backend.utils.deadlines import deadline_seconds, set_deadline, reset_deadline
+
+logger = logging.getLogger(__name__)
 
 # Create FastAPI app
 app = FastAPI(title="Image Generation API")
@@ -22,12 +43,123 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Allowance for the form fields and multipart framing around an uploaded file
+MAX_FORM_OVERHEAD = 1024 * 1024
+
+@app.middleware("http")
+async def reject_oversized_requests(request: Request, call_next):
+    """Reject bodies that are declared larger than any valid upload before reading them."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + MAX_FORM_OVERHEAD:
+        return JSONResponse(status_code=413, content={"detail": "Request body too large"})
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Record the response time of every request, labelled by route template."""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route is not None else "other",
+            status=status,
+        )
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Record the span breakdown of each request and return it in a
+    Server-Timing header. Slow requests are kept in the slow-request buffer.
+    Send ?debug=timings (or the X-Debug-Timings: 1 header) to also get the
+    span tree in the JSON payload of /upload and /download.
+    """
+    debug = request.query_params.get("debug") == "timings" or request.headers.get("x-debug-timings") == "1"
+    trace, token = tracing.start_trace(f"{request.method} {request.url.path}", debug)
+    try:
+        with tracing.maybe_profile(trace):
+            response = await call_next(request)
+    finally:
+        tracing.end_trace(token)
+        tracing.record_if_slow(trace)
+    response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+@app.middleware("http")
+async def apply_deadline(request: Request, call_next):
+    """
+    Give the request a deadline (REQUEST_DEADLINE_SECONDS, or the client's
+    X-Request-Timeout when shorter). Provider calls made for the request, and
+    for the job it queues, stop when it expires.
+    """
+    token = set_deadline(deadline_seconds(request))
+    try:
+        return await call_next(request)
+    finally:
+        reset_deadline(token)
+
+@app.middleware("http")
+async def assign_session(request: Request, call_next):
+    """
+    Identify the browser session a request belongs to (its history is kept
+    per session), issuing a session cookie on the first request.
+    """
+    session_id = session_id_from(request)
+    issued = session_id is None
+    request.state.session_id = session_id or new_session_id()
+    response = await call_next(request)
+    if issued:
+        response.set_cookie(SESSION_COOKIE_NAME, request.state.session_id, max_age=SESSION_COOKIE_MAX_AGE,
+                            path="/", httponly=True, samesite="lax")
+    return response
+
 # Include routers - removing the /api prefix since main.py already mounts this app at /api
 app.include_router(generation_router, tags=["generation"])
+app.include_router(admin_router, prefix="/admin", tags=["admin"])
 
 # Mount static directories
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
-app.mount("/results", StaticFiles(directory=RESULT_DIR), name="results")
+app.mount("/uploads", StorageFiles(upload_store), name="uploads")
+app.mount("/results", ResultFiles(result_store), name="results")
+
+async def startup_event():
+    """
+    Open the shared store, the artifact index and the history store and start
+    their background tasks, optionally create the providers ahead of time,
+    then record the startup time.
+    """
+    await shared_state.start()
+    job_manager.start()
+    await artifact_index.start()
+    await history_store.start()
+    if WARM_UP_PROVIDERS:
+        logger.info("Warmed up providers", extra={"timings": warm_up()})
+    startup.mark_ready()
+
+async def shutdown_event():
+    """
+    Let queued and running jobs finish (see SHUTDOWN_DRAIN_SECONDS), then stop
+    background workers and close pooled connections when the server shuts down.
+    """
+    await job_manager.shutdown()
+    await artifact_index.shutdown()
+    await history_store.shutdown()
+    await photoroom_client.aclose()
+    await upload_store.aclose()
+    await result_store.aclose()
+    await shared_state.shutdown()
+    shutdown_process_pool()
+    shutdown_logging()
+
+# Lifecycle hooks. Mounted sub-applications do not receive lifespan events,
+# so main.py registers these handlers on the top-level app as well.
+app.add_event_handler("startup", startup_event)
+app.add_event_handler("shutdown", shutdown_event)
 
 # Root endpoint
 @app.get("/")
@@ -35,6 +167,30 @@ async def root():
     """Root endpoint."""
     return {"message": "Image Generation API is running"}
 
+@app.get("/health")
+async def health():
+    """
+    Readiness information: startup time, which providers are loaded and which
+    worker process answered. Answers 503 once the worker is shutting down.
+    """
+    return JSONResponse(status_code=503 if job_manager.draining else 200, content={
+        "ready": startup.startup_seconds() is not None and not job_manager.draining,
+        "startup_seconds": startup.startup_seconds(),
+        "providers_enabled": available_services(),
+        "providers_loaded": sorted(SERVICES),
+        "worker": WORKER_ID,
+        "draining": job_manager.draining,
+    })
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Metrics in the Prometheus text format: per-stage and per-route latency
+    histograms, provider call outcomes, queue depths, in-flight provider calls,
+    cache hit ratio and circuit breaker state.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("backend.app:app", host="0.0.0.0", port=8000, reload=True)
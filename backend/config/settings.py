@@ -1,6 +1,7 @@
 """
 Configuration settings for the application.
 """
+import logging
 import os
 from pathlib import Path
 from dotenv import load_dotenv
@@ -14,20 +15,276 @@ BASE_DIR = Path(__file__).resolve().parent.parent.parent
 # API Keys
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# PHOTOTOOM_API_KEY is the original (misspelt) variable name, still accepted
+PHOTOROOM_API_KEY = os.getenv("PHOTOROOM_API_KEY") or os.getenv("PHOTOTOOM_API_KEY")
+
+# Per-provider concurrency limits (bulkheads). A slow provider can only tie up
+# its own slots, so it cannot starve traffic to the others. With several
+# SERVER_WORKERS, each worker process has these limits.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+PHOTOROOM_MAX_CONCURRENCY = int(os.getenv("PHOTOROOM_MAX_CONCURRENCY", "4"))
+
+PROVIDER_CONCURRENCY = {
+    "gemini": GEMINI_MAX_CONCURRENCY,
+    "openai": OPENAI_MAX_CONCURRENCY,
+    "photoroom": PHOTOROOM_MAX_CONCURRENCY,
+}
+
+# Client-side rate limits per provider and API key: sustained requests per
+# second and burst size (token bucket). A rate of 0 disables the limit. With
+# several SERVER_WORKERS, the buckets are in the shared store and the limits
+# hold for all worker processes together.
+GEMINI_RATE_PER_SECOND = float(os.getenv("GEMINI_RATE_PER_SECOND", "2"))
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "8"))
+OPENAI_RATE_PER_SECOND = float(os.getenv("OPENAI_RATE_PER_SECOND", "1"))
+OPENAI_RATE_BURST = int(os.getenv("OPENAI_RATE_BURST", "5"))
+PHOTOROOM_RATE_PER_SECOND = float(os.getenv("PHOTOROOM_RATE_PER_SECOND", "5"))
+PHOTOROOM_RATE_BURST = int(os.getenv("PHOTOROOM_RATE_BURST", "10"))
+
+PROVIDER_RATE_LIMITS = {
+    "gemini": (GEMINI_RATE_PER_SECOND, GEMINI_RATE_BURST),
+    "openai": (OPENAI_RATE_PER_SECOND, OPENAI_RATE_BURST),
+    "photoroom": (PHOTOROOM_RATE_PER_SECOND, PHOTOROOM_RATE_BURST),
+}
+
+# Retries of 429, 5xx and connection errors: exponential backoff with full
+# jitter, or the provider's Retry-After when it sends one. A provider asking
+# to wait longer than RETRY_MAX_DELAY_SECONDS is not retried.
+PROVIDER_MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "0.5"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "20"))
+
+# Circuit breaker: after this many consecutive failures a provider is
+# considered down and calls fail fast with 503 until the reset period has
+# passed and a trial call succeeds
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+# Alternative API endpoints, e.g. a local fake provider for testing
+GEMINI_API_URL = os.getenv("GEMINI_API_URL")
+OPENAI_API_URL = os.getenv("OPENAI_API_URL")
+
+# PhotoRoom background removal API
+PHOTOROOM_API_URL = os.getenv("PHOTOROOM_API_URL", "https://sdk.photoroom.com")
+PHOTOROOM_TIMEOUT_SECONDS = float(os.getenv("PHOTOROOM_TIMEOUT_SECONDS", "60"))
+# Size of the keep-alive connection pool shared by all PhotoRoom requests
+PHOTOROOM_MAX_CONNECTIONS = int(os.getenv("PHOTOROOM_MAX_CONNECTIONS", "10"))
+
+# Local background removal, tried before PhotoRoom: images that already have
+# transparency, or a flat background that can be cut out on the CPU
+LOCAL_CUTOUT_ENABLED = os.getenv("LOCAL_CUTOUT_ENABLED", "true").lower() == "true"
+# Cut-outs scoring below this (0-1) are made by PhotoRoom instead
+LOCAL_CUTOUT_MIN_CONFIDENCE = float(os.getenv("LOCAL_CUTOUT_MIN_CONFIDENCE", "0.9"))
+# RGB distance from the background color below which pixels are fully transparent;
+# alpha ramps up to opaque at twice this distance
+LOCAL_CUTOUT_TOLERANCE = float(os.getenv("LOCAL_CUTOUT_TOLERANCE", "18"))
+
+# Image generation providers enabled in this deployment (comma separated)
+ENABLED_PROVIDERS = [name.strip().lower() for name in os.getenv("ENABLED_PROVIDERS", "gemini,openai").split(",") if name.strip()]
+# Create the enabled providers at startup instead of on their first request
+WARM_UP_PROVIDERS = os.getenv("WARM_UP_PROVIDERS", "false").lower() == "true"
+
+# model="auto": providers to try, primary first (comma separated). A hedge
+# request goes to the next provider when the primary has not answered within
+# its HEDGE_PERCENTILE latency, and errors fail over immediately.
+AUTO_PROVIDERS = [name.strip().lower() for name in os.getenv("AUTO_PROVIDERS", "gemini,openai").split(",") if name.strip()]
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Hedge delay used until a provider has HEDGE_MIN_SAMPLES observed latencies
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", "30"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "2"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# Number of recent successful calls kept per provider for latency statistics
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "200"))
 
 # Gemini model configuration
 GEMINI_MODEL = "gemini-2.5-flash-image-preview"
 OPENAI_MODEL = "gpt-image-1"
 # Upload configuration
-UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+UPLOAD_DIR = os.getenv("UPLOAD_DIR") or os.path.join(BASE_DIR, "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # Result configuration
-RESULT_DIR = os.path.join(BASE_DIR, "results")
+RESULT_DIR = os.getenv("RESULT_DIR") or os.path.join(BASE_DIR, "results")
 os.makedirs(RESULT_DIR, exist_ok=True)
 
+# Resized variants of results (e.g. history thumbnails) are stored here, sharded like the results
+DERIVATIVE_DIR = os.path.join(RESULT_DIR, "derivatives")
+os.makedirs(DERIVATIVE_DIR, exist_ok=True)
+# Widths that can be requested; other values are rounded up to the next one
+DERIVATIVE_WIDTHS = [64, 128, 256, 512, 1024]
+# Cache lifetime for files under /results, which are never modified once written
+RESULT_CACHE_MAX_AGE = int(os.getenv("RESULT_CACHE_MAX_AGE", str(365 * 24 * 60 * 60)))
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
 
 # Max file size (10MB)
 MAX_FILE_SIZE = 10 * 1024 * 1024
+
+# Uploads are streamed to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# Input image pre-processing
+# Uploads with more pixels than this are rejected (40 megapixels)
+MAX_INPUT_PIXELS = int(os.getenv("MAX_INPUT_PIXELS", str(40 * 1000 * 1000)))
+# Longest side input images are downsampled to before they are sent to each provider
+PROVIDER_INPUT_MAX_SIDE = {
+    "gemini": int(os.getenv("GEMINI_INPUT_MAX_SIDE", "1024")),
+    "openai": int(os.getenv("OPENAI_INPUT_MAX_SIDE", "1536")),
+}
+# Format and encoder settings for downsampled inputs
+PREPARED_INPUT_FORMAT = os.getenv("PREPARED_INPUT_FORMAT", "webp").lower()
+PREPARED_INPUT_OPTIONS = {"quality": int(os.getenv("PREPARED_INPUT_QUALITY", "90"))}
+# Downsampled inputs are cached here by content hash and target size
+PREPARED_DIR = os.path.join(UPLOAD_DIR, "prepared")
+os.makedirs(PREPARED_DIR, exist_ok=True)
+
+# Server state that is not served to clients (e.g. the artifact index)
+DATA_DIR = os.getenv("DATA_DIR") or os.path.join(BASE_DIR, "data")
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# Artifact retention
+# SQLite index of every file in UPLOAD_DIR and RESULT_DIR: kind, size, parent and last access
+ARTIFACT_INDEX_PATH = os.getenv("ARTIFACT_INDEX_PATH") or os.path.join(DATA_DIR, "artifacts.sqlite3")
+# Delete least recently used files once uploads and results together exceed this many bytes
+ARTIFACT_MAX_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", str(20 * 1024 * 1024 * 1024)))
+# Delete files not accessed for this long, per kind (seconds, 0 keeps them)
+ARTIFACT_TTL_SECONDS = {
+    "upload": int(os.getenv("UPLOAD_TTL_SECONDS", str(7 * 24 * 60 * 60))),
+    "prepared": int(os.getenv("PREPARED_TTL_SECONDS", str(24 * 60 * 60))),
+    "result": int(os.getenv("RESULT_TTL_SECONDS", str(30 * 24 * 60 * 60))),
+    "cutout": int(os.getenv("CUTOUT_TTL_SECONDS", str(30 * 24 * 60 * 60))),
+    "derivative": int(os.getenv("DERIVATIVE_TTL_SECONDS", str(7 * 24 * 60 * 60))),
+}
+# How often the garbage collector runs (seconds, 0 disables it)
+ARTIFACT_GC_INTERVAL_SECONDS = int(os.getenv("ARTIFACT_GC_INTERVAL_SECONDS", "600"))
+# New files and accesses are written to the index in batches this often (seconds)
+ARTIFACT_FLUSH_INTERVAL_SECONDS = float(os.getenv("ARTIFACT_FLUSH_INTERVAL_SECONDS", "10"))
+
+# Generation history
+# SQLite database of each session's generations and background removals
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH") or os.path.join(DATA_DIR, "history.sqlite3")
+# Entries per page of GET /history by default, and at most
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100"))
+# New entries are written to the database in batches this often (seconds)
+HISTORY_FLUSH_INTERVAL_SECONDS = float(os.getenv("HISTORY_FLUSH_INTERVAL_SECONDS", "2"))
+# Cookie identifying a browser session, which the history belongs to
+SESSION_COOKIE_NAME = os.getenv("SESSION_COOKIE_NAME", "imagegen_session")
+SESSION_COOKIE_MAX_AGE = int(os.getenv("SESSION_COOKIE_MAX_AGE", str(365 * 24 * 60 * 60)))
+
+# Server processes (used by `python main.py`)
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+# Worker processes serving requests. With more than one, jobs, the generation
+# cache index, rate-limit buckets and single-flight locks live in the shared store
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+# Restart on code changes (development only; runs a single worker)
+SERVER_RELOAD = os.getenv("SERVER_RELOAD", "false").lower() == "true"
+# On shutdown, open requests and streams get this long to finish (seconds), then
+# queued and running jobs get this long before they are cancelled
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "30"))
+# Store for state the worker processes share: "memory" (a single process) or
+# "sqlite" (a SQLite database in WAL mode, for all processes on the host).
+# Defaults to "sqlite" when SERVER_WORKERS is above 1
+SHARED_STATE_BACKEND = (os.getenv("SHARED_STATE_BACKEND") or ("sqlite" if SERVER_WORKERS > 1 else "memory")).lower()
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH") or os.path.join(DATA_DIR, "shared.sqlite3")
+# How often jobs are published to, and followed through, the shared store (seconds)
+SHARED_STATE_POLL_SECONDS = float(os.getenv("SHARED_STATE_POLL_SECONDS", "0.25"))
+
+# Admission control in front of /upload, /batch and /download. Each provider
+# runs as many requests at once as its concurrency limit above; the rest wait
+# in a per-provider queue, served round-robin across clients.
+# Requests a provider's queue holds before new ones are rejected with 429
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "32"))
+# Requests a single client may have waiting in a provider's queue
+ADMISSION_CLIENT_QUEUE_SIZE = int(os.getenv("ADMISSION_CLIENT_QUEUE_SIZE", "8"))
+# Longest a request may wait for a slot (seconds); requests that are expected
+# to wait longer are rejected up front
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "60"))
+# Header carrying a client's API key; clients without one are told apart by IP address
+ADMISSION_CLIENT_HEADER = os.getenv("ADMISSION_CLIENT_HEADER", "x-api-key").lower()
+
+# Deadlines and cancellation
+# Time given to a request, including the job it queues (seconds); clients may ask
+# for less with an X-Request-Timeout header. 0 disables deadlines
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "300"))
+# A job whose event-stream and long-poll clients have all disconnected is
+# cancelled if none comes back within this time (seconds; 0 never cancels)
+JOB_ABANDON_SECONDS = float(os.getenv("JOB_ABANDON_SECONDS", "15"))
+
+# Generation job configuration
+# How long finished jobs are kept around for status queries (seconds)
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+# Upper bound for long-poll waits on GET /jobs/{id}?wait=N (seconds)
+JOB_MAX_WAIT_SECONDS = int(os.getenv("JOB_MAX_WAIT_SECONDS", "30"))
+
+# Generation result cache
+# Identical (model, prompt, input image) requests are served from the cache
+GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "true").lower() == "true"
+# Size budget for cached results; least recently used results are no longer reused
+# beyond it (their files are deleted by the artifact garbage collector)
+GENERATION_CACHE_MAX_BYTES = int(os.getenv("GENERATION_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# How long a cached result may be reused (seconds)
+GENERATION_CACHE_TTL_SECONDS = int(os.getenv("GENERATION_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+
+# Output image pipeline
+# Format used when the client does not ask for one; empty keeps the provider's format
+DEFAULT_OUTPUT_FORMAT = os.getenv("DEFAULT_OUTPUT_FORMAT", "").lower() or None
+# Worker processes used for CPU-heavy image encoding
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+# Encoder settings per output format, passed to PIL's Image.save
+ENCODER_OPTIONS = {
+    "png": {"compress_level": int(os.getenv("PNG_COMPRESS_LEVEL", "6"))},
+    "webp": {"quality": int(os.getenv("WEBP_QUALITY", "85")), "method": int(os.getenv("WEBP_METHOD", "4"))},
+    "avif": {"quality": int(os.getenv("AVIF_QUALITY", "60")), "speed": int(os.getenv("AVIF_SPEED", "6"))},
+    "jpeg": {"quality": int(os.getenv("JPEG_QUALITY", "90")), "optimize": True},
+}
+
+# Progressive results
+# Partial images OpenAI streams before the final one (0-3; 0 disables streaming)
+OPENAI_PARTIAL_IMAGES = int(os.getenv("OPENAI_PARTIAL_IMAGES", "2"))
+# Partial images are pushed to clients as previews of this width and format
+# (one of ENCODER_OPTIONS; anything else falls back to webp)
+PREVIEW_WIDTH = int(os.getenv("PREVIEW_WIDTH", "256"))
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "webp").lower().replace("jpg", "jpeg")
+if PREVIEW_FORMAT not in ENCODER_OPTIONS:
+    logging.getLogger(__name__).warning("Unsupported PREVIEW_FORMAT %r, using webp", PREVIEW_FORMAT)
+    PREVIEW_FORMAT = "webp"
+
+# Batch generation
+# Largest number of images (prompts x variations) a single batch may request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "32"))
+# Provider calls a single batch may have in flight at once
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+# Logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" writes one JSON object per line; "text" writes plain lines
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+# Request timing and slow-request capture
+# Requests and jobs slower than this keep their span tree in the slow-request buffer
+SLOW_REQUEST_THRESHOLD_SECONDS = float(os.getenv("SLOW_REQUEST_THRESHOLD_SECONDS", "10"))
+# Number of slow requests kept in memory (oldest are dropped)
+SLOW_REQUEST_BUFFER_SIZE = int(os.getenv("SLOW_REQUEST_BUFFER_SIZE", "100"))
+# Share of requests run under cProfile; the profile is kept only if the request is slow
+SLOW_REQUEST_PROFILE_RATE = float(os.getenv("SLOW_REQUEST_PROFILE_RATE", "0"))
+# Token required in the X-Admin-Token header by the /admin endpoints (unset: they are disabled)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Storage of uploads and results
+# "local" keeps them in UPLOAD_DIR and RESULT_DIR only; "s3" also writes them to an
+# S3-compatible bucket and uses the local directories as a cache in front of it
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+S3_BUCKET = os.getenv("S3_BUCKET")
+# Endpoint of an S3-compatible service (e.g. a local MinIO); AWS when unset
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID") or os.getenv("AWS_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY") or os.getenv("AWS_SECRET_ACCESS_KEY")
+# Prepended to every object key, e.g. "imagegen/"
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_TIMEOUT_SECONDS = float(os.getenv("S3_TIMEOUT_SECONDS", "60"))
+S3_MAX_CONNECTIONS = int(os.getenv("S3_MAX_CONNECTIONS", "10"))
@@ -0,0 +1,60 @@
+"""
+Operational endpoints for inspecting the running server.
+"""
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import JSONResponse
+
+from backend.config.settings import ADMIN_TOKEN, SLOW_REQUEST_THRESHOLD_SECONDS
+from backend.utils.artifact_index import artifact_index
+from backend.utils.tracing import slow_requests, clear_slow_requests
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Check the X-Admin-Token header; without a configured ADMIN_TOKEN every request is refused."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN to enable them")
+    if not (x_admin_token and secrets.compare_digest(x_admin_token, ADMIN_TOKEN)):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+@router.get("/slow-requests")
+async def get_slow_requests(limit: int = 20):
+    """
+    Returns the most recent requests and jobs that took longer than
+    SLOW_REQUEST_THRESHOLD_SECONDS, newest first, with their span trees
+    and, when one was sampled, a profiler capture.
+    """
+    requests = slow_requests()[:max(limit, 0)]
+    return JSONResponse(content={
+        "success": True,
+        "threshold_seconds": SLOW_REQUEST_THRESHOLD_SECONDS,
+        "count": len(requests),
+        "requests": requests,
+    })
+
+@router.delete("/slow-requests")
+async def delete_slow_requests():
+    """Empties the slow-request buffer."""
+    clear_slow_requests()
+    return JSONResponse(content={"success": True})
+
+@router.get("/artifacts")
+async def get_artifacts():
+    """
+    Returns the disk usage of uploads and results by kind, the disk budget and
+    TTLs, and the outcome of the last garbage collection.
+    """
+    return JSONResponse(content={"success": True, **artifact_index.stats()})
+
+@router.post("/artifacts/gc")
+async def collect_artifacts():
+    """Runs the artifact garbage collector now and returns what it deleted."""
+    return JSONResponse(content={"success": True, **await artifact_index.collect()})
+
+@router.post("/artifacts/rebuild")
+async def rebuild_artifacts():
+    """Rebuilds the artifact index from the files in UPLOAD_DIR and RESULT_DIR."""
+    return JSONResponse(content={"success": True, "files": await artifact_index.rebuild()})
@@ -1,77 +1,356 @@
 """
 API routes for image generation.
 """
-from fastapi import APIRouter, File, Form, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, File, Form, Query, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
+import asyncio
+import json
+import logging
+import math
 import os
+import time
 
-from backend.services.service_factory import get_service
-from backend.utils.file_utils import save_uploaded_file, allowed_file
+from backend.services.service_factory import get_service, SERVICES, AUTO_MODEL
+from backend.utils.latency import latency_stats
+from backend.utils.resilience import ProviderUnavailableError, resilience_stats
+from backend.utils.admission import AdmissionRejectedError, get_admission, client_key, admission_stats
+from backend.utils.deadlines import (
+    DeadlineExceededError,
+    ClientDisconnectedError,
+    until_disconnected,
+    REASON_CANCELLED,
+)
+from backend.utils.tracing import current_trace
+from backend.utils.file_utils import save_uploaded_file, allowed_file, resolve_result_path, hash_file, result_url
+from backend.utils.image_output import validate_output_format
+from backend.utils.image_preprocess import validate_input_image
+from backend.utils.artifact_index import artifact_index
 from backend.utils.prompting_utility import get_prompting_details
-from backend.config.settings import BASE_DIR
+from backend.services.job_manager import job_manager, ShuttingDownError
+from backend.services.generation_cache import generation_cache
+from backend.services.batch_service import plan_batch, run_batch
+from backend.services.history_store import history_store, KIND_BACKGROUND_REMOVAL
+from backend.config.settings import JOB_MAX_WAIT_SECONDS, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE
 # from backend.utils.bg_remover_op import remove_bg
 from backend.utils.file_utils import remove_bg
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
+# Interval between keep-alive comments on idle event streams (seconds)
+SSE_KEEPALIVE_SECONDS = 15
+
 class DownloadRequest(BaseModel):
     path: str
 
-@router.post("/upload")
+def _with_timings(content):
+    """Add the request's span tree to a response payload when debug timings were requested."""
+    trace = current_trace()
+    if trace is not None and trace.debug:
+        content["timings"] = trace.to_dict()
+    return content
+
+def _unavailable(error):
+    """Turn a ProviderUnavailableError into a 503 that tells the client when to retry."""
+    headers = {"Retry-After": str(math.ceil(error.retry_after))} if error.retry_after else None
+    return HTTPException(status_code=503, detail=str(error), headers=headers)
+
+def _too_busy(error):
+    """Turn an AdmissionRejectedError into a 429 that tells the client when to retry."""
+    return HTTPException(status_code=429, detail=str(error),
+                         headers={"Retry-After": str(math.ceil(error.retry_after))})
+
+async def _resolve_input_image(file, source_result):
+    """
+    Save the uploaded file, or resolve the referenced result, used as input image.
+
+    Returns:
+        tuple: (file_path, image_hash), both None when there is no input image
+    """
+    if file and file.filename:
+        if not allowed_file(file.filename):
+            raise HTTPException(status_code=400, detail="FILE TYPE NOT ALLOWED")
+
+        file_path, image_hash = await save_uploaded_file(file)
+        await validate_input_image(file_path)
+        logger.debug("Input file saved", extra={"file_path": file_path})
+        return file_path, image_hash
+
+    if source_result:
+        logger.debug("Using existing result as input", extra={"source_result": source_result})
+        try:
+            file_path = await resolve_result_path(source_result)
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        image_hash = await asyncio.to_thread(hash_file, file_path)
+        return file_path, image_hash
+
+    return None, None
+
+@router.post("/upload", status_code=202)
 async def upload_image(
+    request: Request,
     prompt: str = Form(...),
     file: Optional[UploadFile] = File(None),
-    model: str = Form(...)
+    model: str = Form(...),
+    output_format: Optional[str] = Form(None),
+    source_result: Optional[str] = Form(None)
 ):
-    print(f"[INFO]---INSIDE GENERATION ROUTES---")
+    """
+    Queues an image generation job and returns immediately.
+
+    The job is processed in the background; use GET /jobs/{job_id} (or the
+    /jobs/{job_id}/events stream) to follow its progress and get the result path.
+    The optional output_format ("png", "webp" or "avif") selects the format of
+    the generated file; by default the provider's format is kept.
+
+    Instead of uploading a file, source_result can reference an existing
+    result (e.g. "/results/<name>") to use as the input image, so iterative
+    edits do not transfer or store the image again.
+
+    Answers 429 with a Retry-After header when the model's queue cannot take
+    the job (see backend/utils/admission.py).
+    """
     try:
-        # Save uploaded file if provided
-        
-        file_path = None
-        # img_details = None
-        if file and file.filename:
-            print(f"[INFO]---CHECKING IF FILE IS ALLOWED---")
-            if not allowed_file(file.filename):
-                raise HTTPException(status_code=400, detail="FILE TYPE NOT ALLOWED")
-
-            file_path = save_uploaded_file(file)
-            print(f"[INFO]---FILE SAVED SUCCESSFULLY---")
-        #     img_details = get_prompting_details(file_path)
-        #     improved_prompt = f"YOU ARE BEING PROVIDED WITH A USER QUERY AND A REFERENCE IMAGE AND A JSON DESCRIPTION THE IMAGE. **USER REQUIREMENTS ARE OF HIGHEST PRIORITY** . JSON DESCRIPTION IS GIVEN FOR MORE UNDERSTANDING OF THE PROVIDED IMAGE. CLUB THE PROVIDED KNOWLEDGE TO PRODUCE THE BEST POSSIBLE OUTPUT.\n # USER QUERY: {prompt} # \nIMG_DETAILS: {img_details}" 
-        # # VALIDATE MODEL NAME TO MATCH WITH BACKEND
-        # CREATE AN ENNUM TO TRACK THE MODEL NAME
-        # IF THE MODEL NAME IS NOT IN THE ENUM, RAISE AN ERROR
-        # IF THE MODEL NAME IS IN THE ENUM, GET THE SERVICE FROM THE FACTORY
-        
-        # Get the appropriate service from the factory
-        print(f"[INFO]---GETTING SERVICE FROM THE FACTORY WITH MODEL NAME: {model}---")
+        # Validate the model before doing any work
         service = get_service(model)
-        result_path = None
-        result_filename = None
-        
-        if service:
-            print(f"[INFO]---SERVICE FOUND IN THE FACTORY---",flush=True)
-            result_path = service.generate_image(prompt, file_path)
-
-            print(f"[INFO]---RESULT PATH RECIEVED FROM SERVICE: {result_path}---")
-            result_filename = os.path.basename(result_path)
-        
-            return JSONResponse(content={
-                "success": True,
-                "message": "Image generated successfully",
-                "result_path": f"/results/{result_filename}"
-            })
-        else:
-            raise HTTPException(status_code=400, detail="SERVICE NOT FOUND")
+        # Fail fast while the provider is down, or too busy, instead of queueing doomed work
+        service.ensure_available()
+        client = client_key(request)
+        get_admission(model).check(client)
+        output_format = validate_output_format(output_format)
+
+        file_path, image_hash = await _resolve_input_image(file, source_result)
+
+        job = await job_manager.submit(model, prompt, file_path, image_hash, output_format, request.state.session_id,
+                                 client)
+
+        return JSONResponse(status_code=202, content=_with_timings({
+            "success": True,
+            "message": "Image generation queued",
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": request.url_for("get_job", job_id=job.id).path,
+        }))
+    except HTTPException:
+        raise
+    except ProviderUnavailableError as e:
+        raise _unavailable(e)
+    except AdmissionRejectedError as e:
+        raise _too_busy(e)
+    except ShuttingDownError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except ValueError as e:
         # Handle the case where the model is not supported
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/batch")
+async def batch_generate(
+    request: Request,
+    model: str = Form(...),
+    prompts: List[str] = Form(...),
+    variations: int = Form(1),
+    file: Optional[UploadFile] = File(None),
+    output_format: Optional[str] = Form(None),
+    source_result: Optional[str] = Form(None)
+):
+    """
+    Generates images for several prompts and/or several variations per prompt.
+
+    The optional input image is sent once and shared by every item. Provider
+    calls run concurrently (up to BATCH_MAX_CONCURRENCY), variations use the
+    provider's native multi-image parameter where one exists, and results are
+    streamed as NDJSON in completion order: one "result" or "error" line per
+    image, followed by a final "summary" line. Each provider call waits for a
+    slot in the model's admission queue like a job does; a batch is rejected
+    with 429 up front when the queue is saturated.
+
+    Args:
+        model: Name of the generation service
+        prompts: One or more prompts (repeat the form field for each)
+        variations: Number of images per prompt
+        file: Optional input image
+        output_format: Optional output format ("png", "webp" or "avif")
+        source_result: Optional existing result to use as the input image
+    """
+    logger.info("Batch request", extra={"model": model, "prompts": len(prompts), "variations": variations})
+    try:
+        service = get_service(model)
+        service.ensure_available()
+        client = client_key(request)
+        get_admission(model).check(client)
+        output_format = validate_output_format(output_format)
+        items = plan_batch(prompts, variations, service.max_images_per_call)
+        file_path, image_hash = await _resolve_input_image(file, source_result)
+    except HTTPException:
+        raise
+    except ProviderUnavailableError as e:
+        raise _unavailable(e)
+    except AdmissionRejectedError as e:
+        raise _too_busy(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def ndjson_stream():
+        async with artifact_index.pinned(file_path):
+            async for record in run_batch(service, model, items, file_path, image_hash, output_format,
+                                          request.state.session_id, client):
+                yield json.dumps(record) + "\n"
+
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+@router.get("/jobs/{job_id}", name="get_job")
+async def get_job(job_id: str, wait: float = 0, debug: Optional[str] = None):
+    """
+    Returns the status of a generation job.
+
+    Args:
+        job_id: The id returned by POST /upload
+        wait: Optional long-poll timeout in seconds. If the job is not finished,
+            the response is held until it changes state or the timeout expires.
+        debug: "timings" adds the job's span breakdown (queue wait, input
+            preparation, provider call, saving) to the response
+
+    Returns:
+        JSONResponse with the job status and, once done, the result path
+    """
+    job = await job_manager.find(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+
+    wait = min(max(wait, 0), JOB_MAX_WAIT_SECONDS)
+    if wait and not job.finished:
+        # Progress events also wake waiters; only a change of state ends the wait.
+        # A long-polling client counts as following the job until it stops polling.
+        deadline = time.monotonic() + wait
+        status = job.status
+        with job_manager.watch(job):
+            while job.status == status and (remaining := deadline - time.monotonic()) > 0:
+                await job.wait_for_change(remaining, job.version)
+
+    return JSONResponse(content={"success": True, **job.to_dict(debug=debug == "timings")})
+
+@router.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """
+    Streams job updates as Server-Sent Events until the job finishes.
+
+    Events:
+        status: The job (as returned by GET /jobs/{job_id}) whenever its state changes
+        progress: A stage was reached: "queued", "sent" (the provider call
+            started), "received" (the provider answered) or "saved" (with the
+            result_path, just before the job is done)
+        partial: A low-resolution preview of a partial image streamed by the
+            provider, as a data URI under "image"; sent by providers that
+            support it (OpenAI)
+
+    Every event carries "elapsed", the seconds since the job was accepted.
+    When every client following the job has disconnected and none comes back
+    within JOB_ABANDON_SECONDS, the job is cancelled.
+    """
+    job = await job_manager.find(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+
+    async def event_stream():
+        sent = 0
+        status = None
+        with job_manager.watch(job):
+            while True:
+                version = job.version
+                events, sent = job.events[sent:], len(job.events)
+                for event in events:
+                    if event["stage"] != "partial":
+                        yield f"event: progress\ndata: {json.dumps(event)}\n\n"
+                    elif "image" in event:
+                        # Superseded previews are dropped, so late subscribers get the latest only
+                        yield f"event: partial\ndata: {json.dumps(event)}\n\n"
+                if job.status != status:
+                    status = job.status
+                    yield f"event: status\ndata: {json.dumps(job.to_dict())}\n\n"
+                if job.finished:
+                    break
+                while not await job.wait_for_change(SSE_KEEPALIVE_SECONDS, version):
+                    # Keep intermediaries from closing an idle connection
+                    yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Cancels a queued or running job, e.g. when the user retries or leaves.
+
+    The provider call is cancelled if it is in flight; a finished job is left as it is.
+
+    Returns:
+        JSONResponse with the job status and whether it was cancelled
+    """
+    job = await job_manager.find(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    cancelled = await job_manager.stop(job, REASON_CANCELLED)
+    return JSONResponse(content={"success": True, "cancelled": cancelled, **job.to_dict()})
+
+@router.get("/history")
+async def get_history(request: Request, limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+                      cursor: Optional[str] = None):
+    """
+    Returns a page of the session's generations and background removals, newest first.
+
+    Args:
+        limit: Number of entries, from 1 to HISTORY_MAX_PAGE_SIZE; other values are rejected with 422
+        cursor: The next_cursor of the previous page; omit it for the first page
+
+    Returns:
+        JSONResponse with "items" and "next_cursor", which is null on the last page
+    """
+    try:
+        page = await history_store.page(request.state.session_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"success": True, **page})
+
+@router.delete("/history")
+async def delete_history(request: Request):
+    """Deletes the session's history; the images themselves are kept."""
+    deleted = await history_store.clear(request.state.session_id)
+    return JSONResponse(content={"success": True, "deleted": deleted})
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """
+    Returns hit/miss counters and disk usage of the generation result cache.
+    """
+    return JSONResponse(content={"success": True, **generation_cache.stats()})
+
+@router.get("/providers/stats")
+async def get_provider_stats():
+    """
+    Returns the observed latency of each provider, the rate limit, retry and
+    circuit breaker state per provider and API key, the usage of each
+    admission queue, and, once model="auto" has been used, its routing order,
+    hedge delays and outcome counters.
+    """
+    auto = SERVICES.get(AUTO_MODEL)
+    return JSONResponse(content={
+        "success": True,
+        "latency": latency_stats(),
+        "resilience": resilience_stats(),
+        "admission": admission_stats(),
+        "auto": auto.stats() if auto else None,
+    })
+
 @router.post("/download")
-async def download_image(request: DownloadRequest):
+async def download_image(request: DownloadRequest, http_request: Request):
     """
     Processes an image for download by removing its background using OpenAI GPT-image-1.
 
@@ -81,55 +360,52 @@ async def download_image(request: DownloadRequest):
     Returns:
         JSONResponse with the path to the processed image
     """
-    print(f"[INFO]--- DOWNLOAD REQUEST RECEIVED ---")
-    print(f"[INFO]--- Original path from request: {request.path} ---")
+    logger.debug("Download request", extra={"path": request.path})
 
     try:
-        # Extract filename from the URL path
-        # The path comes as "/results/filename.png" or similar
-        if request.path.startswith('/results/'):
-            filename = request.path.replace('/results/', '')
-        elif request.path.startswith('results/'):
-            filename = request.path.replace('results/', '')
-        else:
-            # Extract just the filename from the path
-            filename = os.path.basename(request.path)
-
-        # Construct the full filesystem path
-        image_path = os.path.join(BASE_DIR, 'results', filename)
-
-        print(f"[INFO]--- Resolved filesystem path: {image_path} ---")
-
-        # Verify the file exists
-        if not os.path.exists(image_path):
-            print(f"[ERROR]--- Image not found at path: {image_path} ---")
-            raise HTTPException(status_code=404, detail=f"Image not found: {filename}")
-
-        print(f"[INFO]--- Image file confirmed to exist ---")
-        print(f"[INFO]--- Initiating background removal using OpenAI GPT-image-1 ---")
-
-        # Remove background using OpenAI API
-        processed_image_path_fs = remove_bg(image_path)
-        # processed_image_path_fs= image_path
+        # Resolve the URL path ("/results/ab/cd/<name>.png" or similar) in the result store
+        try:
+            image_path = await resolve_result_path(request.path)
+        except FileNotFoundError as e:
+            logger.warning("%s", e)
+            raise HTTPException(status_code=404, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-        print(f"[INFO]--- Background removal completed. Processed image saved at: {processed_image_path_fs} ---")
+        # Remove background locally or using PhotoRoom; fails fast with a 503
+        # when PhotoRoom is needed but its circuit breaker is open, and with a
+        # 429 when too many PhotoRoom removals are already waiting.
+        # Stop paying for the removal if the client goes away meanwhile
+        processed_image_path_fs = await until_disconnected(http_request,
+                                                           remove_bg(image_path, client_key(http_request)))
+        # processed_image_path_fs= image_path
+        history_store.record(http_request.state.session_id, KIND_BACKGROUND_REMOVAL, processed_image_path_fs,
+                             input_path=image_path)
 
         # Convert filesystem path back to URL path
-        # Get just the filename from the processed path
-        processed_filename = os.path.basename(processed_image_path_fs)
-        processed_image_path_url = f"/results/{processed_filename}"
-
-        print(f"[INFO]--- Returning processed image URL: {processed_image_path_url} ---")
+        processed_image_path_url = result_url(processed_image_path_fs)
 
-        return JSONResponse(content={
+        return JSONResponse(content=_with_timings({
             "success": True,
             "message": "Background removed successfully. Image ready for download.",
             "path": processed_image_path_url
-        })
+        }))
 
     except HTTPException:
         # Re-raise HTTP exceptions as-is
         raise
+    except ProviderUnavailableError as e:
+        logger.error("Background removal unavailable: %s", e)
+        raise _unavailable(e)
+    except AdmissionRejectedError as e:
+        logger.warning("Background removal rejected: %s", e)
+        raise _too_busy(e)
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except ClientDisconnectedError as e:
+        logger.info("Background removal cancelled: %s", e)
+        # Nobody reads the response; the status shows up in the request metrics
+        raise HTTPException(status_code=499, detail=str(e))
     except Exception as e:
-        print(f"[ERROR]--- Failed to process download request: {str(e)} ---")
+        logger.error("Failed to process download request: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,18 +1,137 @@
+import time
 from abc import ABC, abstractmethod
 
+from backend.config.settings import PROVIDER_INPUT_MAX_SIDE
+from backend.utils.concurrency import get_bulkhead, gather_all
+from backend.utils.image_preprocess import prepare_input_image
+from backend.utils.latency import get_latency_tracker
+from backend.utils.resilience import get_policy
+from backend.utils.metrics import observe_stage
+from backend.utils.progress import report
+
 class BaseImageGenerationService(ABC):
     """Abstract base class for image generation services."""
 
-    @abstractmethod
-    def generate_image(self, prompt: str, image_path: str = None) -> str:
+    # Provider name, used to look up the provider's concurrency limit
+    name = None
+    # Largest number of images the provider can return from a single call;
+    # generate_images splits larger requests into several calls
+    max_images_per_call = 1
+
+    def __init__(self, api_key: str = None):
+        self.bulkhead = get_bulkhead(self.name)
+        # Rate limit, retries and circuit breaker for this provider and key
+        self.resilience = get_policy(self.name, api_key)
+        # Input images are downsampled to this size before they are sent
+        self.input_max_side = PROVIDER_INPUT_MAX_SIDE.get(self.name)
+        self.latency = get_latency_tracker(self.name)
+
+    async def generate_image(self, prompt: str, image_path: str = None, output_format: str = None,
+                             image_hash: str = None) -> str:
         """
         Generate an image based on a prompt and an optional input image.
+
+        The input image is first downsampled to the provider's target size.
+        The provider call is then limited by the provider's bulkhead, so at
+        most the configured number of requests are in flight to it at any time.
+        Each attempt is rate limited, transient provider errors are retried
+        with backoff, and calls fail fast while the provider's circuit
+        breaker is open. The duration of each successful provider attempt,
+        excluding preprocessing, the bulkhead wait and retry backoff, is
+        recorded in the provider's latency tracker.
         
         Args:
             prompt (str): The text prompt for generation.
             image_path (str, optional): The path to an input image.
+            output_format (str, optional): Requested file format ("png", "webp"
+                or "avif"); None keeps the format returned by the provider.
+            image_hash (str, optional): SHA-256 of the input image, used to
+                cache the downsampled variant.
             
         Returns:
             str: The path to the generated image.
         """
+        if image_path:
+            with observe_stage("preprocess", self.name):
+                image_path = await prepare_input_image(image_path, self.input_max_side, image_hash)
+
+        async def attempt():
+            async with self.bulkhead:
+                report("sent", provider=self.name)
+                started = time.perf_counter()
+                result_path = await self._generate_image(prompt, image_path, output_format)
+                if result_path:
+                    self.latency.record(time.perf_counter() - started)
+                return result_path
+
+        return await self.resilience.call(attempt)
+
+    async def generate_images(self, prompt: str, n: int, image_path: str = None, output_format: str = None,
+                              image_hash: str = None) -> list:
+        """
+        Generate n variations of an image.
+
+        The images are requested in calls of at most max_images_per_call
+        images each, run concurrently. Each call is made like generate_image:
+        under the bulkhead and resilience policy, with its duration recorded
+        in the provider's latency tracker.
+
+        Args:
+            prompt (str): The text prompt for generation.
+            n (int): Number of images.
+            image_path (str, optional): The path to an input image.
+            output_format (str, optional): Requested file format.
+            image_hash (str, optional): SHA-256 of the input image.
+
+        Returns:
+            list: Paths to the generated images.
+        """
+        if n == 1:
+            return [await self.generate_image(prompt, image_path, output_format, image_hash)]
+
+        if image_path:
+            with observe_stage("preprocess", self.name):
+                image_path = await prepare_input_image(image_path, self.input_max_side, image_hash)
+
+        async def attempt(count):
+            async with self.bulkhead:
+                report("sent", provider=self.name)
+                started = time.perf_counter()
+                result_paths = await self._generate_images(prompt, count, image_path, output_format)
+                if result_paths:
+                    self.latency.record(time.perf_counter() - started)
+                return result_paths
+
+        per_call = max(self.max_images_per_call, 1)
+        counts = [min(per_call, n - first) for first in range(0, n, per_call)]
+        results = await gather_all(*(self.resilience.call(lambda count=count: attempt(count)) for count in counts))
+        return [path for result_paths in results for path in result_paths]
+
+    def ensure_available(self):
+        """
+        Fail fast if the provider is known to be down.
+
+        Raises:
+            ProviderUnavailableError: If the provider's circuit breaker is open
+        """
+        self.resilience.ensure_available()
+
+    async def _generate_images(self, prompt: str, n: int, image_path: str = None, output_format: str = None) -> list:
+        """
+        Provider-specific implementation of generate_images, for one call of
+        at most max_images_per_call images.
+
+        Providers with a native multi-image parameter override it; by default
+        each image is a separate _generate_image request, made concurrently.
+        """
+        return await gather_all(*(self._generate_image(prompt, image_path, output_format) for _ in range(n)))
+
+    @abstractmethod
+    async def _generate_image(self, prompt: str, image_path: str = None, output_format: str = None) -> str:
+        """
+        Provider-specific implementation of generate_image.
+
+        Must not block the event loop: use the provider's async client and
+        move file and image processing work off the loop.
+        """
         pass
@@ -0,0 +1,144 @@
+"""
+Batch and variation generation.
+
+A batch runs many prompts and/or several variations per prompt against one
+optional input image. Provider calls run concurrently under a cap, and each
+result is reported as soon as it finishes, so one slow item never holds back
+the others.
+"""
+import asyncio
+import logging
+
+from backend.config.settings import BATCH_MAX_ITEMS, BATCH_MAX_CONCURRENCY
+from backend.services.generation_cache import generation_cache
+from backend.services.history_store import history_store, KIND_GENERATION
+from backend.utils.admission import get_admission
+from backend.utils.deadlines import REASON_DISCONNECTED
+from backend.utils.file_utils import result_url
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItem:
+    """One provider call in a batch: a prompt and the variations it produces."""
+
+    def __init__(self, prompt_index, prompt, first_variation, count, cacheable):
+        self.prompt_index = prompt_index
+        self.prompt = prompt
+        self.first_variation = first_variation
+        self.count = count
+        # Only single-image prompts may be served from the result cache;
+        # variations are meant to differ from each other
+        self.cacheable = cacheable
+
+
+def plan_batch(prompts, variations, max_images_per_call):
+    """
+    Split a batch into provider calls.
+
+    Variations of a prompt are grouped into as few calls as the provider's
+    native multi-image parameter allows.
+
+    Args:
+        prompts (list): The prompts to run
+        variations (int): Number of images per prompt
+        max_images_per_call (int): Largest n the provider accepts
+
+    Returns:
+        list: BatchItem objects
+
+    Raises:
+        ValueError: If the batch is empty or larger than BATCH_MAX_ITEMS
+    """
+    if not prompts:
+        raise ValueError("At least one prompt is required")
+    if variations < 1:
+        raise ValueError("variations must be at least 1")
+    if len(prompts) * variations > BATCH_MAX_ITEMS:
+        raise ValueError(f"A batch may request at most {BATCH_MAX_ITEMS} images")
+
+    items = []
+    for prompt_index, prompt in enumerate(prompts):
+        for first_variation in range(0, variations, max_images_per_call):
+            count = min(max_images_per_call, variations - first_variation)
+            items.append(BatchItem(prompt_index, prompt, first_variation, count, variations == 1))
+    return items
+
+
+async def run_batch(service, model, items, image_path=None, image_hash=None, output_format=None, session_id=None,
+                    client=None):
+    """
+    Run the planned provider calls concurrently and yield results as they finish.
+
+    Prompts without variations go through the result cache; variations do
+    not, since their point is to produce different images.
+
+    Args:
+        service: The image generation service
+        model (str): Model name, used for the cache key
+        items (list): BatchItem objects from plan_batch
+        image_path (str, optional): Input image shared by all items
+        image_hash (str, optional): SHA-256 of the input image
+        output_format (str, optional): Requested output format
+        session_id (str, optional): Session whose history the results are added to
+        client (str, optional): Client the provider calls are queued for, from client_key
+
+    Yields:
+        dict: One "result" or "error" record per image, then a "summary" record
+    """
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    admission = get_admission(model)
+
+    async def run(item):
+        async with semaphore, admission.admit(client):
+            if item.cacheable:
+                result_path, _ = await generation_cache.get_or_generate(
+                    model,
+                    item.prompt,
+                    image_hash,
+                    lambda: service.generate_image(item.prompt, image_path, output_format, image_hash),
+                    output_format,
+                )
+                return item, [result_path]
+            if item.count == 1:
+                return item, [await service.generate_image(item.prompt, image_path, output_format, image_hash)]
+            return item, await service.generate_images(item.prompt, item.count, image_path, output_format, image_hash)
+
+    async def run_safely(item):
+        try:
+            return await run(item)
+        except Exception as e:
+            logger.error("Batch item failed: %s", e, extra={"prompt_index": item.prompt_index})
+            return item, e
+
+    tasks = [asyncio.create_task(run_safely(item)) for item in items]
+    succeeded = 0
+    failed = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            item, outcome = await next_done
+            if isinstance(outcome, Exception):
+                for variation in range(item.first_variation, item.first_variation + item.count):
+                    failed += 1
+                    yield {"type": "error", "prompt_index": item.prompt_index, "variation": variation,
+                           "error": str(outcome)}
+                continue
+
+            for offset in range(item.count):
+                variation = item.first_variation + offset
+                if offset < len(outcome) and outcome[offset]:
+                    succeeded += 1
+                    history_store.record(session_id, KIND_GENERATION, outcome[offset], model=model,
+                                         prompt=item.prompt, input_path=image_path)
+                    yield {"type": "result", "prompt_index": item.prompt_index, "variation": variation,
+                           "result_path": result_url(outcome[offset])}
+                else:
+                    failed += 1
+                    yield {"type": "error", "prompt_index": item.prompt_index, "variation": variation,
+                           "error": "The model did not return an image"}
+    finally:
+        # Stop outstanding provider calls if the client went away
+        for task in tasks:
+            task.cancel(REASON_DISCONNECTED)
+
+    yield {"type": "summary", "succeeded": succeeded, "failed": failed}
@@ -3,54 +3,57 @@ Service for interacting with Google's Gemini API.
 """
 from google import genai
 from google.genai import types
-from PIL import Image
-from io import BytesIO
+import asyncio
+import logging
+import mimetypes
 import os
-import uuid
 from pathlib import Path
 
-from backend.config.settings import GEMINI_API_KEY, GEMINI_MODEL, RESULT_DIR
+from backend.config.settings import GEMINI_API_KEY, GEMINI_MODEL, GEMINI_API_URL
 from backend.services.base_service import BaseImageGenerationService
+from backend.utils.image_output import save_image_bytes
+from backend.utils.metrics import observe_stage
+
+logger = logging.getLogger(__name__)
 
 class GeminiService(BaseImageGenerationService):    
+    name = "gemini"
+
     def __init__(self):
-        print(f"[INFO]---INITIALIZING GEMINI SERVICE---")
-        self.client = genai.Client(api_key=GEMINI_API_KEY)
+        logger.info("Initializing Gemini service")
+        super().__init__(api_key=GEMINI_API_KEY)
+        http_options = types.HttpOptions(base_url=GEMINI_API_URL) if GEMINI_API_URL else None
+        self.client = genai.Client(api_key=GEMINI_API_KEY, http_options=http_options)
         self.model = GEMINI_MODEL
     
-    def generate_image(self, prompt, image_path=None):
+    async def _generate_image(self, prompt, image_path=None, output_format=None):
 
         try:
             contents = [prompt]
             if image_path and os.path.exists(image_path):
-                print(f"[INFO]---RECIEVED IMAGE PATH---")
-                image = Image.open(image_path)
-                contents.append(image)
+                logger.debug("Sending the input image")
+                # Send the encoded file as-is instead of decoding it with PIL
+                image_bytes = await asyncio.to_thread(Path(image_path).read_bytes)
+                mime_type = mimetypes.guess_type(image_path)[0] or "image/png"
+                contents.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
             else:
-                print(f"[INFO]---NO IMAGE PATH PROVIDED. GOING FORWARD WITH PROMPT ONLY---")
-            
-            print(f"[INFO]---CALLING GEMINI CLIENT---")
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=contents
-            )
-            
+                logger.debug("No input image, generating from the prompt only")
+
+            with observe_stage("provider_call", self.name):
+                response = await self.client.aio.models.generate_content(
+                    model=self.model,
+                    contents=contents
+                )
+
             # Save the generated image
-            print(f"[INFO]---SAVING THE GENERATED IMAGE---")
             result_path = None
-            # print(f"[INFO]---RESPONSE RECIEVED FROM GEMINI CLIENT: {response}---")
             for part in response.candidates[0].content.parts:
                 if part.inline_data is not None:
-                    # Generate a unique filename
-                    filename = f"generated_{uuid.uuid4().hex}.png"
-                    result_path = os.path.join(RESULT_DIR, filename)
-                    
-                    # Save the image
-                    image = Image.open(BytesIO(part.inline_data.data))
-                    image.save(result_path)
-                    print(f"[INFO]---IMAGE SAVED SUCCESSFULLY AT: {result_path}---")
+                    # Save the image, transcoding only if another format was requested
+                    result_path = await save_image_bytes(part.inline_data.data, output_format)
+                    logger.info("Image saved", extra={"provider": self.name, "result_path": result_path})
                     break
             return result_path
         except Exception as e:
-            print(f"Error generating image: {str(e)}")
+            logger.error("Error generating image: %s", e, extra={"provider": self.name})
             raise
@@ -0,0 +1,256 @@
+"""
+Content-addressed cache for generated images.
+
+Results are keyed by the model name, the normalized prompt and the SHA-256 of
+the input image, so repeated submissions of the same request reuse the image
+that was already generated instead of making another paid provider call.
+
+With several worker processes, each keeps its own index of the results it
+generated, and publishes them to the shared store (backend/utils/shared_state.py)
+where the others find them. A lease on the key makes sure only one worker
+generates a given result; the others wait for it.
+"""
+import hashlib
+import logging
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+
+from backend.config.settings import (
+    GENERATION_CACHE_ENABLED,
+    GENERATION_CACHE_MAX_BYTES,
+    GENERATION_CACHE_TTL_SECONDS,
+)
+from backend.utils.artifact_index import artifact_index
+from backend.utils.concurrency import SingleFlight
+from backend.utils.metrics import Gauge
+from backend.utils.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# How a result was obtained, reported back to the caller
+CACHE_HIT = "hit"
+CACHE_JOINED = "joined"
+CACHE_MISS = "miss"
+CACHE_BYPASS = "bypass"
+
+
+def normalize_prompt(prompt):
+    """
+    Normalize a prompt so trivially different spellings share a cache entry.
+
+    Args:
+        prompt (str): The user prompt
+
+    Returns:
+        str: The prompt with unicode normalized and whitespace collapsed
+    """
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+
+def _shared_key(key):
+    return f"cache:{key}"
+
+
+class CacheEntry:
+    """A cached result file."""
+
+    def __init__(self, result_path, size):
+        self.result_path = result_path
+        self.size = size
+        self.created_at = time.time()
+
+
+class GenerationCache:
+    """
+    LRU cache of generated images with a size budget and a TTL.
+
+    Evicted results are only dropped from the cache; the files stay until the
+    artifact garbage collector (backend/utils/artifact_index.py) deletes them,
+    since jobs, the history and derived files may still use them.
+
+    Identical requests that arrive while a generation is already running
+    attach to that call instead of starting another one.
+    """
+
+    def __init__(self, max_bytes=GENERATION_CACHE_MAX_BYTES, ttl=GENERATION_CACHE_TTL_SECONDS,
+                 enabled=GENERATION_CACHE_ENABLED):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._in_flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(model, prompt, image_hash=None, output_format=None):
+        """
+        Build the cache key for a generation request.
+
+        Args:
+            model (str): Name of the generation service
+            prompt (str): The text prompt
+            image_hash (str, optional): SHA-256 of the input image, if any
+            output_format (str, optional): Requested output format, if any
+
+        Returns:
+            str: Hex digest identifying the request
+        """
+        parts = [model.lower(), normalize_prompt(prompt), image_hash or "", output_format or ""]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        """
+        Return the cached result path for a key, or None.
+
+        Expired entries and entries whose file has disappeared are dropped.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry.created_at > self.ttl:
+            self._drop(key)
+            self.expirations += 1
+            return None
+        if not os.path.exists(entry.result_path):
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        artifact_index.touch(entry.result_path)
+        return entry.result_path
+
+    async def lookup_shared(self, key):
+        """Return the result another worker process generated for a key, or None."""
+        entry = await shared_state.get(_shared_key(key))
+        if entry is None or not os.path.exists(entry["result_path"]):
+            return None
+        artifact_index.touch(entry["result_path"])
+        return entry["result_path"]
+
+    def store(self, key, result_path):
+        """
+        Add a generated result to the cache and enforce the size budget.
+
+        Args:
+            key (str): The request key from make_key
+            result_path (str): Path of the generated image
+        """
+        if key in self._entries:
+            self._drop(key)
+        size = os.path.getsize(result_path)
+        self._entries[key] = CacheEntry(result_path, size)
+        self.total_bytes += size
+        self._evict()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.size
+        return entry
+
+    def _evict(self):
+        """Drop least recently used results until the cache fits its budget."""
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    async def get_or_generate(self, model, prompt, image_hash, generate, output_format=None):
+        """
+        Return a cached result, join an identical in-flight call, or generate.
+
+        Args:
+            model (str): Name of the generation service
+            prompt (str): The text prompt
+            image_hash (str): SHA-256 of the input image, or None
+            generate: Zero-argument callable returning an awaitable that
+                produces the result path
+            output_format (str, optional): Requested output format
+
+        Returns:
+            tuple: (result_path, cache_status) where cache_status is one of
+                "hit", "joined", "miss" or "bypass"
+        """
+        if not self.enabled:
+            return await generate(), CACHE_BYPASS
+
+        key = self.make_key(model, prompt, image_hash, output_format)
+        result_path = self.lookup(key)
+        if result_path is None and shared_state.shared:
+            result_path = await self.lookup_shared(key)
+        if result_path:
+            self.hits += 1
+            return result_path, CACHE_HIT
+
+        async def generate_and_store():
+            if shared_state.shared:
+                return await self._generate_once(key, generate)
+            self.misses += 1
+            return await self._generate(key, generate), CACHE_MISS
+
+        if self._in_flight.in_flight(key):
+            self.joins += 1
+            result_path, _ = await self._in_flight.do(key, generate_and_store)
+            return result_path, CACHE_JOINED
+
+        return await self._in_flight.do(key, generate_and_store)
+
+    async def _generate(self, key, generate):
+        path = await generate()
+        if path:
+            self.store(key, path)
+            if shared_state.shared:
+                await shared_state.set(_shared_key(key), {"result_path": path}, ttl=self.ttl)
+        return path
+
+    async def _generate_once(self, key, generate):
+        """
+        Generate a result unless another worker process is already generating it.
+
+        The worker holding the key's lease generates; the others wait until it
+        releases the lease, then take its result from the shared store, or
+        generate themselves if there is none (e.g. the generation failed).
+        """
+        async def generate_here():
+            self.misses += 1
+            return await self._generate(key, generate)
+
+        result_path, generated = await shared_state.run_once(f"generate:{key}", generate_here,
+                                                             lambda: self.lookup_shared(key))
+        if generated:
+            return result_path, CACHE_MISS
+        self.joins += 1
+        return result_path, CACHE_JOINED
+
+    def stats(self):
+        """Return cache counters and usage."""
+        lookups = self.hits + self.joins + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "joins": self.joins,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": (self.hits + self.joins) / lookups if lookups else 0.0,
+        }
+
+
+generation_cache = GenerationCache()
+
+Gauge("imagegen_cache_hit_ratio", "Share of generation requests served from the cache or a joined call",
+      lambda: generation_cache.stats()["hit_ratio"])
+Gauge("imagegen_cache_lookups", "Generation cache lookups by outcome",
+      lambda: {("hit",): generation_cache.hits, ("joined",): generation_cache.joins,
+               ("miss",): generation_cache.misses},
+      ["outcome"])
+Gauge("imagegen_cache_bytes", "Disk space used by cached results",
+      lambda: generation_cache.total_bytes)
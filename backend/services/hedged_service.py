@@ -0,0 +1,212 @@
+"""
+Hedged generation across providers (model="auto").
+
+A request starts on the primary provider. If no result has arrived once the
+primary's usual worst-case latency (HEDGE_PERCENTILE) has passed, a hedge
+request is sent to the next provider and whichever finishes first wins; the
+other call is cancelled. Errors from a provider fail over to the next one
+immediately. The delays come from the latency observed per provider, so only
+the slow tail of requests pays for a second call.
+"""
+import asyncio
+import logging
+import os
+
+from backend.config.settings import (
+    AUTO_PROVIDERS,
+    HEDGE_PERCENTILE,
+    HEDGE_DEFAULT_DELAY_SECONDS,
+    HEDGE_MIN_DELAY_SECONDS,
+    HEDGE_MIN_SAMPLES,
+)
+from backend.services.service_factory import available_services, get_service
+from backend.utils.admission import AdmissionRejectedError, current_client, get_admission
+from backend.utils.concurrency import gather_all
+from backend.utils.deadlines import cancel_reason, REASON_HEDGE
+from backend.utils.latency import get_latency_tracker
+from backend.utils.resilience import ProviderUnavailableError
+
+logger = logging.getLogger(__name__)
+
+
+class HedgedService:
+    """Generates with the primary provider and hedges or fails over to the others."""
+
+    name = "auto"
+    max_images_per_call = 1
+
+    def __init__(self, providers=None, percentile=HEDGE_PERCENTILE):
+        enabled = available_services()
+        self.providers = [name for name in (providers or AUTO_PROVIDERS) if name in enabled]
+        if not self.providers:
+            raise ValueError("No providers are enabled for model auto")
+        self.percentile = percentile
+        self.hedges = 0
+        self.failovers = 0
+        self.wins = {name: 0 for name in self.providers}
+
+    def ordered_providers(self):
+        """
+        Return the providers in the order they should be tried.
+
+        Once every provider has enough latency samples, the one with the lowest
+        median goes first; until then the configured order is kept.
+        """
+        trackers = [get_latency_tracker(name) for name in self.providers]
+        if all(tracker.count >= HEDGE_MIN_SAMPLES for tracker in trackers):
+            return [tracker.name for tracker in sorted(trackers, key=lambda tracker: tracker.percentile(50))]
+        return list(self.providers)
+
+    def hedge_delay(self, provider):
+        """
+        Return how long to wait on a provider before sending a hedge request.
+
+        Args:
+            provider (str): The provider currently being waited on
+
+        Returns:
+            float: Seconds
+        """
+        tracker = get_latency_tracker(provider)
+        if tracker.count < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SECONDS
+        return max(tracker.percentile(self.percentile), HEDGE_MIN_DELAY_SECONDS)
+
+    async def generate_image(self, prompt: str, image_path: str = None, output_format: str = None,
+                             image_hash: str = None) -> str:
+        """
+        Generate an image with the first provider to answer successfully.
+
+        Each provider call waits in that provider's admission queue, under the
+        client of the current request or job.
+
+        Args:
+            prompt (str): The text prompt for generation.
+            image_path (str, optional): The path to an input image.
+            output_format (str, optional): Requested file format.
+            image_hash (str, optional): SHA-256 of the input image.
+
+        Returns:
+            str: The path to the generated image.
+
+        Raises:
+            ProviderUnavailableError: If every provider is down or its queue
+                cannot take the request
+            RuntimeError: If every provider failed
+        """
+        remaining = self.ordered_providers()
+        pending = {}
+        errors = []
+        # Retry-After of providers that were down or too busy, if that is all that failed
+        unavailable = []
+        latest = None
+
+        def record_error(name, error):
+            errors.append(f"{name}: {str(error)}")
+            if isinstance(error, (ProviderUnavailableError, AdmissionRejectedError)):
+                unavailable.append(error.retry_after or 0.0)
+
+        async def attempt(service):
+            # Each call waits its turn in the provider's queue, like requests for that model
+            async with get_admission(service.name).admit(current_client()):
+                return await service.generate_image(prompt, image_path, output_format, image_hash)
+
+        def launch_next():
+            nonlocal latest
+            while remaining:
+                name = remaining.pop(0)
+                try:
+                    service = get_service(name)
+                    # Skip providers whose circuit breaker is open
+                    service.ensure_available()
+                except Exception as e:
+                    record_error(name, e)
+                    continue
+                task = asyncio.create_task(attempt(service))
+                pending[task] = name
+                latest = name
+                return True
+            return False
+
+        launch_next()
+        # Why calls still running at the end are cancelled
+        reason = REASON_HEDGE
+        try:
+            while pending:
+                timeout = self.hedge_delay(latest) if remaining else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info("No result from %s after %.1fs, sending hedge request", latest, timeout)
+                    if launch_next():
+                        self.hedges += 1
+                    continue
+
+                winner = None
+                for task in done:
+                    name = pending.pop(task)
+                    try:
+                        result_path = task.result()
+                    except Exception as e:
+                        logger.warning("Auto: %s failed: %s", name, e)
+                        record_error(name, e)
+                        continue
+                    if not result_path:
+                        errors.append(f"{name}: The model did not return an image")
+                    elif winner is None:
+                        winner = (name, result_path)
+                    else:
+                        # Both calls finished at the same moment; keep one result
+                        await asyncio.to_thread(os.remove, result_path)
+
+                if winner:
+                    self.wins[winner[0]] += 1
+                    return winner[1]
+                if not pending and launch_next():
+                    self.failovers += 1
+        except asyncio.CancelledError as e:
+            reason = cancel_reason(e)
+            raise
+        finally:
+            # The losing call is no longer needed
+            for task in pending:
+                task.cancel(reason)
+
+        if errors and len(unavailable) == len(errors):
+            raise ProviderUnavailableError(f"All providers are unavailable: {'; '.join(errors)}",
+                                           retry_after=min(unavailable))
+        raise RuntimeError(f"All providers failed: {'; '.join(errors)}")
+
+    async def generate_images(self, prompt: str, n: int, image_path: str = None, output_format: str = None,
+                              image_hash: str = None) -> list:
+        """Generate n images, each as a separate hedged request."""
+        return await gather_all(*(self.generate_image(prompt, image_path, output_format, image_hash)
+                                  for _ in range(n)))
+
+    def ensure_available(self):
+        """
+        Fail fast if none of the providers can take a request.
+
+        Raises:
+            ProviderUnavailableError: If every provider's circuit breaker is open
+        """
+        retry_after = []
+        for name in self.providers:
+            try:
+                get_service(name).ensure_available()
+                return
+            except ProviderUnavailableError as e:
+                retry_after.append(e.retry_after or 0.0)
+            except Exception:
+                continue
+        raise ProviderUnavailableError("All providers are temporarily unavailable, please retry later",
+                                       retry_after=min(retry_after) if retry_after else None)
+
+    def stats(self):
+        """Return the routing order, current hedge delays and outcome counters."""
+        return {
+            "providers": self.ordered_providers(),
+            "hedge_delay_seconds": {name: self.hedge_delay(name) for name in self.providers},
+            "hedges": self.hedges,
+            "failovers": self.failovers,
+            "wins": self.wins,
+        }
@@ -0,0 +1,262 @@
+"""
+Server-side history of generated images.
+
+Each browser session (identified by a cookie) gets a history of its
+generations and the background removals made from them: prompt, model, input
+image, result, cache status and timings. Entries are stored in SQLite and read
+newest first in pages keyed by entry id (keyset pagination), so a page costs
+the same at the start of the history as a hundred thousand entries in.
+
+New entries are buffered in memory and written in batches, so jobs and
+requests never wait on SQLite; reads flush the buffer first.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+
+from backend.config.settings import (
+    HISTORY_DB_PATH,
+    HISTORY_PAGE_SIZE,
+    HISTORY_MAX_PAGE_SIZE,
+    HISTORY_FLUSH_INTERVAL_SECONDS,
+    SESSION_COOKIE_NAME,
+)
+from backend.utils.storage import upload_store, result_store
+
+logger = logging.getLogger(__name__)
+
+# Entry kinds
+KIND_GENERATION = "generation"
+KIND_BACKGROUND_REMOVAL = "background_removal"
+
+# Session ids are random URL-safe tokens; anything else is replaced
+_SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+# Cursors are entry ids: ASCII digits within SQLite's INTEGER range
+_CURSOR = re.compile(r"^[0-9]{1,19}$")
+_MAX_ID = 2 ** 63 - 1
+
+# AUTOINCREMENT keeps ids from being reused after deletions, so a cursor
+# never points into entries written later
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    model TEXT,
+    prompt TEXT,
+    input_path TEXT,
+    result_path TEXT NOT NULL,
+    parent_id INTEGER,
+    cache TEXT,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS history_session ON history (session_id, id);
+CREATE INDEX IF NOT EXISTS history_session_result ON history (session_id, result_path);
+CREATE UNIQUE INDEX IF NOT EXISTS history_session_cutout ON history (session_id, result_path)
+    WHERE kind = 'background_removal';
+"""
+
+# The parent is the session's latest entry whose result is this entry's input,
+# e.g. the generation a background removal or an edit was made from.
+# Background removals of the same image are recorded once.
+_INSERT = """
+INSERT OR IGNORE INTO history
+    (session_id, kind, created_at, model, prompt, input_path, result_path, parent_id, cache, timings)
+VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT MAX(id) FROM history WHERE session_id = ? AND result_path = ?), ?, ?)
+"""
+
+_COLUMNS = "id, kind, created_at, model, prompt, input_path, result_path, parent_id, cache, timings"
+
+
+def new_session_id():
+    return secrets.token_urlsafe(24)
+
+
+def session_id_from(request):
+    """
+    Return the session id sent with a request, or None.
+
+    Browsers send the session cookie; other clients may send an X-Session-Id
+    header instead.
+    """
+    session_id = request.headers.get("x-session-id") or request.cookies.get(SESSION_COOKIE_NAME)
+    return session_id if session_id and _SESSION_ID.match(session_id) else None
+
+
+def file_url(path):
+    """Return the URL of an upload or result, or None for other paths."""
+    if not path:
+        return None
+    path = os.path.realpath(path)
+    for store in (result_store, upload_store):
+        if path.startswith(store.root + os.sep):
+            return store.url(path)
+    return None
+
+
+def _entry(row):
+    entry = dict(zip(_COLUMNS.split(", "), row))
+    entry["timings"] = json.loads(entry["timings"]) if entry["timings"] else None
+    return entry
+
+
+class HistoryStore:
+    """SQLite store of each session's generations, read in keyset-paginated pages."""
+
+    def __init__(self, db_path=HISTORY_DB_PATH, flush_interval=HISTORY_FLUSH_INTERVAL_SECONDS):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self._db = None
+        # Serializes use of the connection between flushes and reads
+        self._lock = threading.Lock()
+        # Entries waiting for the next flush, oldest first
+        self._pending = []
+        # Keeps batches in order, so parents are always written before their children
+        self._flushing = asyncio.Lock()
+        self._task = None
+
+    # Recording (called on the request path; only touches memory)
+
+    def record(self, session_id, kind, result_path, model=None, prompt=None, input_path=None,
+               cache=None, timings=None):
+        """
+        Add an entry to a session's history.
+
+        Args:
+            session_id (str): The session, or None to record nothing
+            kind (str): KIND_GENERATION or KIND_BACKGROUND_REMOVAL
+            result_path (str): Filesystem path of the produced image
+            model (str, optional): The model that produced it
+            prompt (str, optional): The prompt it was produced from
+            input_path (str, optional): Filesystem path of the input image
+            cache (str, optional): Whether the result came from the generation cache
+            timings (dict, optional): Milliseconds per stage
+        """
+        result_url = file_url(result_path)
+        if not session_id or not result_url:
+            return
+        input_url = file_url(input_path)
+        self._pending.append((
+            session_id, kind, time.time(), model, prompt, input_url, result_url,
+            session_id, input_url, cache, json.dumps(timings) if timings else None,
+        ))
+
+    # Database access (runs in a worker thread)
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def _flush(self, pending):
+        with self._lock, self._db:
+            # One statement per entry, so each can see the parents written before it
+            for entry in pending:
+                self._db.execute(_INSERT, entry)
+
+    def _page(self, session_id, limit, before):
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {_COLUMNS} FROM history WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before, limit + 1),
+            ).fetchall()
+        return [_entry(row) for row in rows]
+
+    def _clear(self, session_id):
+        with self._lock, self._db:
+            return self._db.execute("DELETE FROM history WHERE session_id = ?", (session_id,)).rowcount
+
+    # Async API
+
+    async def _open(self):
+        if self._db is None:
+            await asyncio.to_thread(self._connect)
+
+    async def start(self):
+        """Open the database and start the background flush task."""
+        await self._open()
+        if self._task is None:
+            # The flusher outlives the request that started it
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def flush(self):
+        """Write buffered entries to the database."""
+        if self._db is None:
+            return
+        async with self._flushing:
+            pending, self._pending = self._pending, []
+            if pending:
+                await asyncio.to_thread(self._flush, pending)
+
+    async def page(self, session_id, limit=HISTORY_PAGE_SIZE, cursor=None):
+        """
+        Return a page of a session's history, newest first.
+
+        Args:
+            session_id (str): The session
+            limit (int): Number of entries, capped at HISTORY_MAX_PAGE_SIZE
+            cursor (str, optional): The next_cursor of the previous page
+
+        Returns:
+            dict: "items" and "next_cursor" (None on the last page)
+
+        Raises:
+            ValueError: If the cursor is invalid
+        """
+        limit = min(max(limit, 1), HISTORY_MAX_PAGE_SIZE)
+        before = _parse_cursor(cursor)
+        await self._open()
+        await self.flush()
+        items = await asyncio.to_thread(self._page, session_id, limit, before)
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = str(items[-1]["id"])
+        return {"items": items, "next_cursor": next_cursor}
+
+    async def clear(self, session_id):
+        """Delete a session's history; returns the number of entries deleted."""
+        await self._open()
+        await self.flush()
+        return await asyncio.to_thread(self._clear, session_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Failed to write history entries: %s", e)
+
+    async def shutdown(self):
+        """Stop the background task, write pending entries and close the database."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._db is not None:
+            await self.flush()
+            self._db.close()
+            self._db = None
+
+
+def _parse_cursor(cursor):
+    """Return the id a page must start below."""
+    if not cursor:
+        return _MAX_ID
+    if not _CURSOR.fullmatch(cursor) or not 1 <= int(cursor) <= _MAX_ID:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return int(cursor)
+
+
+history_store = HistoryStore()
@@ -0,0 +1,551 @@
+"""
+Background job management for image generation.
+
+Generation requests are accepted immediately and queued as jobs. Each job
+waits in its provider's admission queue (backend/utils/admission.py) for a
+slot, then runs in a task of its own, and clients poll (or stream) the job
+status until the result is available.
+
+A job keeps the deadline of the request that submitted it. Once every client
+following a job (event streams and long-polls) has disconnected and none
+comes back within JOB_ABANDON_SECONDS, the job is cancelled.
+
+With several worker processes, a job runs in the worker that accepted it and
+publishes its state to the shared store (backend/utils/shared_state.py); the
+other workers answer for it from there, and pass cancellations and their
+clients' interest in it on to its worker as messages. On shutdown, the worker
+stops accepting jobs and gives the ones it has SHUTDOWN_DRAIN_SECONDS to finish.
+"""
+import asyncio
+import base64
+import contextvars
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from backend.config.settings import (
+    JOB_RETENTION_SECONDS,
+    JOB_ABANDON_SECONDS,
+    SHARED_STATE_POLL_SECONDS,
+    SHUTDOWN_DRAIN_SECONDS,
+)
+from backend.services.service_factory import get_service
+from backend.services.generation_cache import generation_cache
+from backend.services.history_store import history_store, KIND_GENERATION
+from backend.utils.admission import AdmissionRejectedError, get_admission, use_client, reset_client
+from backend.utils.artifact_index import artifact_index
+from backend.utils.deadlines import (
+    DeadlineExceededError,
+    current_deadline,
+    use_deadline,
+    cancel_reason,
+    REASON_CANCELLED,
+    REASON_DISCONNECTED,
+    REASON_SHUTDOWN,
+)
+from backend.utils.file_utils import result_url
+from backend.utils.metrics import Gauge, STAGE_SECONDS, TIME_TO_FIRST_PIXEL_SECONDS
+from backend.utils.progress import use_reporter, reset_reporter
+from backend.utils.shared_state import shared_state, WORKER_ID
+from backend.utils.tracing import RequestTrace, use_trace, end_trace, add_span, record_if_slow
+
+logger = logging.getLogger(__name__)
+
+# Job states
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+FINISHED_STATES = {JOB_DONE, JOB_FAILED}
+
+# Longest DELETE /jobs/{id} waits for another worker process to cancel its job (seconds)
+REMOTE_CANCEL_WAIT_SECONDS = 10.0
+
+
+class ShuttingDownError(Exception):
+    """Raised when a job is submitted to a worker that is shutting down; answered with 503."""
+
+
+def _job_key(job_id):
+    return f"job:{job_id}"
+
+
+class Job:
+    """A single image generation request and its current state."""
+
+    def __init__(self, model, prompt, file_path=None, image_hash=None, output_format=None, session_id=None,
+                 client=None):
+        self.id = uuid.uuid4().hex
+        # The client the job is queued for (see backend/utils/admission.py)
+        self.client = client
+        # The session whose history the result is added to
+        self.session_id = session_id
+        # Deadline of the request that submitted the job (monotonic time, or None)
+        self.deadline = current_deadline()
+        # Clients currently following the job, and when the last one left
+        self.watchers = 0
+        self.unwatched_at = None
+        self.task = None
+        self.model = model
+        self.prompt = prompt
+        self.file_path = file_path
+        self.image_hash = image_hash
+        self.output_format = output_format
+        self.cache_status = None
+        self.status = JOB_QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result_path = None
+        self.error = None
+        # Progress events (see backend/utils/progress.py), oldest first
+        self.events = []
+        self.first_pixel_at = None
+        # Span breakdown of the work done for the job
+        self.trace = RequestTrace(f"job {self.id}")
+        # Bumped on every state change; the event is replaced so waiters can
+        # block until the next update
+        self.version = 0
+        self._changed = asyncio.Event()
+        # Version last written to the shared store
+        self.published_version = None
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def set_status(self, status, result_path=None, error=None):
+        """
+        Move the job to a new state and wake up anyone waiting on it.
+
+        Args:
+            status (str): The new job state
+            result_path (str, optional): Filesystem path of the generated image
+            error (str, optional): Error message if the job failed
+        """
+        self.status = status
+        if status == JOB_RUNNING:
+            self.started_at = time.time()
+        if status in FINISHED_STATES:
+            self.finished_at = time.time()
+        if result_path is not None:
+            self.result_path = result_path
+        if error is not None:
+            self.error = error
+        if status == JOB_DONE:
+            self._mark_first_pixel("result")
+        self._notify()
+
+    def add_event(self, stage, details):
+        """
+        Record a progress event and wake up anyone waiting on the job.
+
+        Partial images are kept as data URIs on the latest partial event only,
+        so a job holds at most one preview.
+
+        Args:
+            stage (str): "queued", "sent", "partial", "received" or "saved"
+            details (dict): Event details; for "partial", the preview bytes
+                under "image" and their "format"
+        """
+        event = {"stage": stage, "elapsed": round(time.time() - self.created_at, 3), **details}
+        if stage == "partial":
+            for earlier in self.events:
+                earlier.pop("image", None)
+            encoded = base64.b64encode(event["image"]).decode("ascii")
+            event["image"] = f"data:image/{event.pop('format')};base64,{encoded}"
+            self._mark_first_pixel("partial")
+        self.events.append(event)
+        self._notify()
+
+    def _mark_first_pixel(self, source):
+        if self.first_pixel_at is None:
+            self.first_pixel_at = time.time()
+            TIME_TO_FIRST_PIXEL_SECONDS.observe(self.first_pixel_at - self.created_at,
+                                                provider=self.model, source=source)
+
+    def _notify(self):
+        self.version += 1
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_for_change(self, timeout, version):
+        """
+        Wait until the job changes state or the timeout expires.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait
+            version (int): The job version the caller last saw
+
+        Returns:
+            bool: True if the job changed state, False on timeout
+        """
+        if self.version != version:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def to_dict(self, debug=False):
+        """
+        Return the public representation of the job.
+
+        Args:
+            debug (bool): Include the job's span breakdown under "timings"
+        """
+        entry = {
+            "job_id": self.id,
+            "status": self.status,
+            "model": self.model,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result_path": result_url(self.result_path) if self.result_path else None,
+            "error": self.error,
+            "cache": self.cache_status,
+            "stage": self.events[-1]["stage"] if self.events else None,
+            "first_pixel_seconds": round(self.first_pixel_at - self.created_at, 3) if self.first_pixel_at else None,
+        }
+        if debug:
+            entry["timings"] = self.trace.to_dict()
+        return entry
+
+    def record(self):
+        """Return the job as published to the shared store for the other worker processes."""
+        return {**self.to_dict(debug=True), "owner": WORKER_ID, "version": self.version, "events": self.events}
+
+
+class SharedJob:
+    """
+    A job run by another worker process, as last published to the shared store.
+
+    It can be read and waited on like a Job; it follows the job by polling
+    the store every SHARED_STATE_POLL_SECONDS.
+    """
+
+    def __init__(self, record):
+        self._apply(record)
+
+    def _apply(self, record):
+        self._record = record
+        self.id = record["job_id"]
+        self.owner = record["owner"]
+        self.status = record["status"]
+        self.version = record["version"]
+        self.events = record["events"]
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    async def refresh(self):
+        """Read the job's latest state from the shared store."""
+        record = await shared_state.get(_job_key(self.id))
+        if record is not None:
+            self._apply(record)
+
+    async def wait_for_change(self, timeout, version):
+        """See Job.wait_for_change."""
+        deadline = time.monotonic() + timeout
+        while self.version == version:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            await asyncio.sleep(min(SHARED_STATE_POLL_SECONDS, left))
+            await self.refresh()
+        return True
+
+    def to_dict(self, debug=False):
+        """See Job.to_dict."""
+        entry = {key: value for key, value in self._record.items()
+                 if key not in ("owner", "version", "events", "timings")}
+        if debug:
+            entry["timings"] = self._record.get("timings")
+        return entry
+
+
+class JobManager:
+    """Queues generation jobs behind admission control and runs them as they are admitted."""
+
+    def __init__(self, retention=JOB_RETENTION_SECONDS):
+        self.retention = retention
+        self.jobs = {}
+        self._tasks = set()
+        # Set once shutdown has started; no new jobs are accepted
+        self.draining = False
+        self._sync_task = None
+
+    async def submit(self, model, prompt, file_path=None, image_hash=None, output_format=None, session_id=None,
+               client=None):
+        """
+        Queue a new generation job.
+
+        Args:
+            model (str): Name of the generation service to use
+            prompt (str): The text prompt for generation
+            file_path (str, optional): Path to the uploaded input image
+            image_hash (str, optional): SHA-256 of the input image, used as
+                part of the result cache key
+            output_format (str, optional): Requested output format
+            session_id (str, optional): Session whose history the result is added to
+            client (str, optional): Client the job is queued for, from client_key
+
+        Returns:
+            Job: The queued job
+
+        Raises:
+            AdmissionRejectedError: If the model's queue cannot take the job
+            ShuttingDownError: If the worker is shutting down
+        """
+        if self.draining:
+            raise ShuttingDownError("The server is shutting down, please retry shortly")
+        self._prune()
+
+        # The input image must not be garbage collected while the job waits or runs
+        await artifact_index.pin(file_path)
+        try:
+            ticket = get_admission(model).enter(client)
+        except BaseException:
+            await artifact_index.unpin(file_path)
+            raise
+        job = Job(model, prompt, file_path, image_hash, output_format, session_id, client)
+
+        self.jobs[job.id] = job
+        job.add_event("queued", {"position": ticket.position})
+        # The job outlives the request that submitted it, so it must not
+        # inherit its context (e.g. its request trace)
+        job.task = asyncio.create_task(self._admit_and_run(job, ticket), context=contextvars.Context())
+        self._tasks.add(job.task)
+        job.task.add_done_callback(self._tasks.discard)
+        logger.info("Job queued", extra={"job_id": job.id, "model": model, "position": ticket.position})
+        if shared_state.shared:
+            # The client may ask another worker about the job right away
+            await self._publish([job])
+        return job
+
+    def get(self, job_id):
+        """Return the job with the given id, or None if this worker does not run it."""
+        return self.jobs.get(job_id)
+
+    async def find(self, job_id):
+        """
+        Return the job with the given id, whichever worker process runs it.
+
+        Returns:
+            Job, SharedJob for a job run by another worker, or None if it is unknown
+        """
+        job = self.jobs.get(job_id)
+        if job is None and shared_state.shared:
+            record = await shared_state.get(_job_key(job_id))
+            if record is not None:
+                job = SharedJob(record)
+        return job
+
+    def cancel(self, job, reason):
+        """
+        Stop a job that is queued or running; its provider call is cancelled.
+
+        Returns:
+            bool: False if the job had already finished
+        """
+        if job.finished or job.task is None:
+            return False
+        job.task.cancel(reason)
+        return True
+
+    async def stop(self, job, reason):
+        """
+        Cancel a job, whichever worker process runs it, and wait until it has finished.
+
+        Returns:
+            bool: False if the job had already finished
+        """
+        if isinstance(job, SharedJob):
+            if job.finished:
+                return False
+            await shared_state.send(job.owner, {"cancel": job.id, "reason": reason})
+            deadline = time.monotonic() + REMOTE_CANCEL_WAIT_SECONDS
+            while not job.finished and (left := deadline - time.monotonic()) > 0:
+                await job.wait_for_change(left, job.version)
+            return True
+        if not self.cancel(job, reason):
+            return False
+        # Let the job task record the cancellation
+        await asyncio.wait([job.task])
+        return True
+
+    @contextmanager
+    def watch(self, job):
+        """
+        Mark the job as followed by a client for the duration of the block.
+
+        When the last client leaves an unfinished job, the job is cancelled
+        unless a client starts following it again within JOB_ABANDON_SECONDS.
+        Clients of other worker processes keep the job alive with heartbeat messages.
+        """
+        if isinstance(job, SharedJob):
+            heartbeat = asyncio.create_task(self._send_heartbeats(job))
+            try:
+                yield
+            finally:
+                heartbeat.cancel()
+            return
+        job.watchers += 1
+        try:
+            yield
+        finally:
+            job.watchers -= 1
+            self._left(job)
+
+    def _left(self, job):
+        """Start the abandonment timer if nobody in this process follows the job any more."""
+        if job.watchers == 0 and not job.finished and JOB_ABANDON_SECONDS > 0:
+            job.unwatched_at = time.monotonic()
+            asyncio.get_running_loop().call_later(JOB_ABANDON_SECONDS, self._cancel_if_abandoned, job)
+
+    async def _send_heartbeats(self, job):
+        """Tell the worker running a job that a client of this worker follows it."""
+        while not job.finished and JOB_ABANDON_SECONDS > 0:
+            try:
+                await shared_state.send(job.owner, {"watch": job.id})
+            except Exception as e:
+                logger.error("Failed to send a job heartbeat: %s", e, extra={"job_id": job.id})
+            await asyncio.sleep(JOB_ABANDON_SECONDS / 3)
+
+    def _cancel_if_abandoned(self, job):
+        if job.watchers == 0 and time.monotonic() - job.unwatched_at >= JOB_ABANDON_SECONDS:
+            if self.cancel(job, REASON_DISCONNECTED):
+                logger.info("Job abandoned by its clients", extra={"job_id": job.id})
+
+    async def _admit_and_run(self, job, ticket):
+        # The task has a context of its own; the job keeps its request's deadline
+        use_deadline(job.deadline)
+        try:
+            await ticket.wait()
+            await self._run(job)
+        except (AdmissionRejectedError, DeadlineExceededError) as e:
+            logger.warning("Job expired in the queue", extra={"job_id": job.id})
+            job.set_status(JOB_FAILED, error=str(e))
+        except asyncio.CancelledError as e:
+            logger.info("Job cancelled", extra={"job_id": job.id, "reason": cancel_reason(e)})
+            job.set_status(JOB_FAILED, error=f"Cancelled ({cancel_reason(e)})")
+            raise
+        finally:
+            ticket.release()
+            await artifact_index.unpin(job.file_path)
+
+    async def _run(self, job):
+        job.set_status(JOB_RUNNING)
+        token = use_trace(job.trace)
+        reporter_token = use_reporter(job.add_event)
+        client_token = use_client(job.client)
+        queue_wait = job.started_at - job.created_at
+        STAGE_SECONDS.observe(queue_wait, stage="queue_wait", provider=job.model)
+        add_span("queue_wait", job.trace.started, queue_wait)
+        logger.info("Job started", extra={"job_id": job.id})
+        try:
+            service = get_service(job.model)
+            result_path, job.cache_status = await generation_cache.get_or_generate(
+                job.model,
+                job.prompt,
+                job.image_hash,
+                lambda: service.generate_image(job.prompt, job.file_path, job.output_format, job.image_hash),
+                job.output_format,
+            )
+            if not result_path:
+                raise RuntimeError("The model did not return an image")
+            job.set_status(JOB_DONE, result_path=result_path)
+            logger.info("Job finished", extra={"job_id": job.id, "result_path": result_path, "cache": job.cache_status})
+        except Exception as e:
+            logger.error("Job failed: %s", e, extra={"job_id": job.id})
+            job.set_status(JOB_FAILED, error=str(e))
+        finally:
+            reset_client(client_token)
+            reset_reporter(reporter_token)
+            end_trace(token)
+            record_if_slow(job.trace)
+        if job.status == JOB_DONE:
+            history_store.record(job.session_id, KIND_GENERATION, job.result_path, model=job.model,
+                                 prompt=job.prompt, input_path=job.file_path, cache=job.cache_status,
+                                 timings=job.trace.durations())
+
+    async def _publish(self, jobs):
+        records = {_job_key(job.id): job.record() for job in jobs}
+        versions = [(job, job.version) for job in jobs]
+        # Finished jobs are kept for the retention period, unfinished ones as long as they keep changing
+        await shared_state.set_many(records, ttl=self.retention)
+        for job, version in versions:
+            job.published_version = version
+
+    async def sync(self):
+        """Publish the jobs that changed, and act on messages from the other worker processes."""
+        await self._publish([job for job in self.jobs.values() if job.version != job.published_version])
+        for message in await shared_state.receive():
+            job = self.jobs.get(message.get("cancel") or message.get("watch"))
+            if job is None:
+                continue
+            if "cancel" in message:
+                self.cancel(job, message.get("reason", REASON_CANCELLED))
+            else:
+                # A heartbeat counts as a client that has just left: the job is
+                # cancelled JOB_ABANDON_SECONDS after the last one
+                self._left(job)
+
+    async def _run_sync(self):
+        while True:
+            await asyncio.sleep(SHARED_STATE_POLL_SECONDS)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error("Failed to sync jobs with the shared store: %s", e)
+
+    def start(self):
+        """Start publishing jobs to the shared store, when there is one."""
+        if shared_state.shared and self._sync_task is None:
+            # The sync outlives the request that started it
+            self._sync_task = asyncio.create_task(self._run_sync(), context=contextvars.Context())
+
+    def _prune(self):
+        """Forget finished jobs that are older than the retention period."""
+        cutoff = time.time() - self.retention
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def shutdown(self, drain_seconds=SHUTDOWN_DRAIN_SECONDS):
+        """
+        Stop accepting jobs and let queued and running ones finish.
+
+        Jobs still unfinished after drain_seconds are cancelled.
+        """
+        self.draining = True
+        pending = set(self._tasks)
+        if pending and drain_seconds > 0:
+            logger.info("Draining jobs", extra={"jobs": len(pending)})
+            _, pending = await asyncio.wait(pending, timeout=drain_seconds)
+        for task in pending:
+            task.cancel(REASON_SHUTDOWN)
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logger.warning("Cancelled jobs at shutdown", extra={"jobs": len(pending)})
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+            self._sync_task = None
+            # Let the other workers see how the jobs ended
+            await self.sync()
+
+
+job_manager = JobManager()
+
+Gauge("imagegen_job_queue_depth", "Generation jobs waiting for an admission slot",
+      lambda: sum(1 for job in job_manager.jobs.values() if job.status == JOB_QUEUED))
+Gauge("imagegen_jobs", "Known generation jobs by status",
+      lambda: {(status,): sum(1 for job in job_manager.jobs.values() if job.status == status)
+               for status in (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED)},
+      ["status"])
@@ -1,59 +1,87 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
+import asyncio
 import base64
+import logging
 from dotenv import load_dotenv
 import os
 load_dotenv()
 from backend.services.base_service import BaseImageGenerationService
-from PIL import Image
-from io import BytesIO
-import os
-import uuid
 from pathlib import Path
-from backend.config.settings import RESULT_DIR
+from backend.utils.image_output import save_base64_image
+from backend.config.settings import OPENAI_API_URL, OPENAI_PARTIAL_IMAGES
+from backend.utils.metrics import observe_stage
+from backend.utils import progress
+
+logger = logging.getLogger(__name__)
+
+# Output formats gpt-image-1 can produce itself, so no transcode is needed
+NATIVE_OUTPUT_FORMATS = {"png", "webp"}
+
 class OpenAIService(BaseImageGenerationService):    
+    name = "openai"
+    # gpt-image-1 accepts n=1..10
+    max_images_per_call = 10
+
     def __init__(self):
-        print(f"[INFO]---INITIALIZING OPENAI SERVICE---")
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        logger.info("Initializing OpenAI service")
+        super().__init__(api_key=os.getenv("OPENAI_API_KEY"))
+        # Retries are handled by the resilience policy, not by the SDK
+        self.client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=OPENAI_API_URL, max_retries=0)
         self.model = 'gpt-image-1'
     
-    def generate_image(self, prompt, image_path=None):
+    async def _generate_image(self, prompt, image_path=None, output_format=None):
+        result_paths = await self._generate_images(prompt, 1, image_path, output_format)
+        return result_paths[0]
 
-        print(f"[INFO]---RECIEVED PROMPT: {prompt}---")
+    async def _generate_images(self, prompt, n, image_path=None, output_format=None):
+
+        logger.debug("Received prompt: %s", prompt)
         try:
-            result = None
+            native_format = output_format if output_format in NATIVE_OUTPUT_FORMATS else "png"
+            options = dict(model="gpt-image-1", prompt=prompt, quality="high", output_format=native_format, n=n)
             if image_path and os.path.exists(image_path):
-                print(f"[INFO]---RECIEVED IMAGE PATH---")
-                result = self.client.images.edit(
-                    model="gpt-image-1",
-                    image=[open(image_path, "rb")],
-                    prompt=prompt,
-                    input_fidelity="high",
-                    quality="high"
-                )
+                logger.debug("Editing the input image")
+                image_bytes = await asyncio.to_thread(Path(image_path).read_bytes)
+                options.update(image=[(os.path.basename(image_path), image_bytes)], input_fidelity="high")
+                call = self.client.images.edit
             else:
-                print(f"[INFO]---NO IMAGE PATH PROVIDED. GOING FORWARD WITH PROMPT ONLY---")
-                
-                result = self.client.images.generate(
-                    model="gpt-image-1",
-                    prompt=prompt,
-                    quality="high"
-                )
-            
-            print(f"[INFO]---SAVING THE GENERATED IMAGE---")
-            result_path = None
-            image_base64 = result.data[0].b64_json
-            image_bytes = base64.b64decode(image_base64)
-            # Generate a unique filename
-            filename = f"generated_{uuid.uuid4().hex}.png"
-            result_path = os.path.join(RESULT_DIR, filename)
-            with open(result_path, "wb") as f:
-                f.write(image_bytes)
-            print(f"[INFO]---IMAGE SAVED SUCCESSFULLY AT: {result_path}---")
-            return result_path
+                logger.debug("No input image, generating from the prompt only")
+                call = self.client.images.generate
+
+            with observe_stage("provider_call", self.name):
+                # Jobs stream partial images so clients can show a preview early;
+                # batches do not, and the API streams single images only
+                if n == 1 and OPENAI_PARTIAL_IMAGES > 0 and progress.active():
+                    images = [await self._stream(call, options)]
+                else:
+                    result = await call(**options)
+                    images = [image.b64_json for image in result.data]
+
+            result_paths = []
+            for image_base64 in images:
+                result_path = await save_base64_image(image_base64, output_format)
+                logger.info("Image saved", extra={"provider": self.name, "result_path": result_path})
+                result_paths.append(result_path)
+            return result_paths
         except Exception as e:
-            print(f"Error generating image: {str(e)}")
+            logger.error("Error generating image: %s", e, extra={"provider": self.name})
             raise
 
+    async def _stream(self, call, options):
+        """
+        Make a streaming call, reporting each partial image as it arrives.
+
+        Returns:
+            str: The final image, base64-encoded
+        """
+        stream = await call(**options, stream=True, partial_images=OPENAI_PARTIAL_IMAGES)
+        async for event in stream:
+            if event.type.endswith(".partial_image"):
+                data = await asyncio.to_thread(base64.b64decode, event.b64_json)
+                await progress.report_partial(data, event.partial_image_index, self.name)
+            elif event.type.endswith(".completed"):
+                return event.b64_json
+        raise RuntimeError("The image stream ended without a final image")
 
 
 # result = client.images.edit(
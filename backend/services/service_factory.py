@@ -1,20 +1,88 @@
+"""
+Registry of image generation services.
+
+Services are created lazily: a provider's SDK is imported and its client built
+on first use (or by warm_up), so workers start quickly, never pay for providers
+the deployment does not use, and a missing key for one provider does not stop
+the others from starting.
+"""
+import importlib
+import logging
+import time
+
+from backend.config.settings import ENABLED_PROVIDERS, AUTO_PROVIDERS
 from .base_service import BaseImageGenerationService
-from .gemini_service import GeminiService
-from .openai_service import OpenAIService
 
-# A registry of available services
-SERVICES = {
-    "gemini": GeminiService(),
-    "openai": OpenAIService(),
+logger = logging.getLogger(__name__)
+
+# Import paths of the available services, by model name
+SERVICE_CLASSES = {
+    "gemini": "backend.services.gemini_service:GeminiService",
+    "openai": "backend.services.openai_service:OpenAIService",
 }
 
+# Model name that routes across providers with hedging and failover
+AUTO_MODEL = "auto"
+SERVICE_CLASSES[AUTO_MODEL] = "backend.services.hedged_service:HedgedService"
+
+# Services that have been created so far
+SERVICES = {}
+
+def available_services():
+    """Return the model names that are enabled in this deployment."""
+    names = [name for name in SERVICE_CLASSES if name in ENABLED_PROVIDERS]
+    if any(name in names for name in AUTO_PROVIDERS):
+        names.append(AUTO_MODEL)
+    return names
+
+def register_service(model_name: str, service: BaseImageGenerationService):
+    """
+    Install a service instance under a model name, replacing any existing one.
+    """
+    SERVICES[model_name.lower()] = service
+
+def _create_service(model_name: str) -> BaseImageGenerationService:
+    module_path, class_name = SERVICE_CLASSES[model_name].split(":")
+    service_class = getattr(importlib.import_module(module_path), class_name)
+    return service_class()
+
 def get_service(model_name: str) -> BaseImageGenerationService:
     """
     Returns an instance of an image generation service based on the model name.
     """
-    print(f"---RECEIVED MODEL NAME IN GET SERVICE: {model_name}---")
-    print(f"---ALLOWED MODELs : {SERVICES.keys()}---")
-    service = SERVICES.get(model_name.lower())
-    if not service:
+    name = model_name.lower()
+    service = SERVICES.get(name)
+    if service:
+        return service
+
+    if name not in available_services():
         raise ValueError(f"Unsupported model: {model_name}")
+
+    logger.info("Creating service", extra={"model": name})
+    service = _create_service(name)
+    SERVICES[name] = service
     return service
+
+def warm_up(model_names=None):
+    """
+    Create services ahead of the first request.
+
+    A provider that fails to initialize (e.g. because its API key is missing)
+    is reported and skipped, so it does not prevent the others from starting.
+
+    Args:
+        model_names (list, optional): Services to create; defaults to all enabled
+
+    Returns:
+        dict: Seconds spent creating each service, or the error message
+    """
+    timings = {}
+    for name in model_names or available_services():
+        started = time.perf_counter()
+        try:
+            get_service(name)
+            timings[name] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            logger.error("Failed to initialize service %s: %s", name, e)
+            timings[name] = f"error: {str(e)}"
+    return timings
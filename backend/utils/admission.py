@@ -0,0 +1,340 @@
+"""
+Admission control in front of the generation routes.
+
+Each provider has an admission queue. A request either gets one of the
+provider's slots straight away or waits in the queue. Waiting requests are
+grouped by client (API key, or IP address) and served round-robin, so a
+client that sends a burst only delays its own requests.
+
+The queue is bounded in total and per client, and a request may wait at most
+ADMISSION_MAX_WAIT_SECONDS. A request that does not fit, or that would wait
+longer than that, is rejected up front with a Retry-After estimated from the
+queue ahead of it and the time requests have recently held a slot.
+
+Requests for model auto wait in their own queue, and each provider call they
+make (including hedges) then waits in that provider's queue as well, under
+the same client, so auto traffic shares the providers' slots fairly.
+"""
+import asyncio
+import contextvars
+import hashlib
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from backend.config.settings import (
+    PROVIDER_CONCURRENCY,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_CLIENT_QUEUE_SIZE,
+    ADMISSION_MAX_WAIT_SECONDS,
+    ADMISSION_CLIENT_HEADER,
+)
+from backend.utils.concurrency import DEFAULT_CONCURRENCY
+from backend.utils.deadlines import (
+    DeadlineExceededError,
+    remaining,
+    cancel_reason,
+    record_wasted,
+    REASON_DEADLINE,
+    OUTCOME_AVOIDED,
+)
+from backend.utils.latency import LatencyTracker, get_latency_tracker
+from backend.utils.metrics import Counter, Gauge
+
+# Slot holding time assumed for Retry-After until a queue or its provider has
+# recorded any; requests are not rejected for their expected wait until then
+DEFAULT_SERVICE_SECONDS = 10.0
+
+# Rejection reasons
+REJECTED_QUEUE_FULL = "queue_full"
+REJECTED_CLIENT_LIMIT = "client_limit"
+REJECTED_DEADLINE = "deadline"
+
+ADMISSION_REJECTIONS = Counter(
+    "imagegen_admission_rejections",
+    "Requests rejected by admission control, by reason (queue_full, client_limit, deadline)",
+    ["provider", "reason"],
+)
+
+
+# Client the current request or job is queued for, so the provider calls it
+# fans out to (model auto) queue under the same client
+_current_client = contextvars.ContextVar("admission_client", default=None)
+
+
+def use_client(client):
+    """
+    Make a client current for the running task (and the tasks it creates).
+
+    Returns:
+        Token to pass to reset_client
+    """
+    return _current_client.set(client)
+
+
+def reset_client(token):
+    _current_client.reset(token)
+
+
+def current_client():
+    """Return the client the current work is queued for, or None."""
+    return _current_client.get()
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a request is not admitted; answered with 429 and Retry-After."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def client_key(request):
+    """
+    Return the key requests are grouped by for fair queuing.
+
+    Clients sending an API key (ADMISSION_CLIENT_HEADER) are told apart by
+    that key, others by their IP address.
+    """
+    api_key = request.headers.get(ADMISSION_CLIENT_HEADER)
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+class Ticket:
+    """A request's place in an admission queue, and later its slot."""
+
+    def __init__(self, admission, client):
+        self.admission = admission
+        self.client = client
+        self.created = time.monotonic()
+        self.granted_at = None
+        self.released = False
+        # Place in the queue when the ticket was issued (0: admitted straight away)
+        self.position = 0
+        self._granted = asyncio.get_running_loop().create_future()
+
+    @property
+    def granted(self):
+        return self.granted_at is not None
+
+    def _grant(self):
+        self.granted_at = time.monotonic()
+        self._granted.set_result(None)
+
+    async def wait(self, timeout=ADMISSION_MAX_WAIT_SECONDS):
+        """
+        Wait until the request gets a slot.
+
+        Args:
+            timeout (float): Longest the request may wait, from when it was queued
+
+        Raises:
+            AdmissionRejectedError: If the timeout passes first
+            DeadlineExceededError: If the request's deadline passes first
+        """
+        if self.granted:
+            return
+        queue_left = timeout - (time.monotonic() - self.created)
+        deadline_left = remaining()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._granted), max(min(queue_left, deadline_left), 0))
+        except asyncio.TimeoutError:
+            if self.granted:
+                return
+            self.released = True
+            self.admission._abandon(self)
+            if deadline_left < queue_left:
+                record_wasted(self.admission.name, REASON_DEADLINE, OUTCOME_AVOIDED)
+                raise DeadlineExceededError("The request deadline expired while waiting for a free slot")
+            raise self.admission._reject(REJECTED_DEADLINE, f"Waited more than {timeout:g}s for a free slot",
+                                         self.admission.wait_estimate(1))
+        except asyncio.CancelledError as e:
+            if not self.granted:
+                record_wasted(self.admission.name, cancel_reason(e), OUTCOME_AVOIDED)
+            self.release()
+            raise
+
+    def release(self):
+        """Give the slot back, or leave the queue if it was not granted yet."""
+        if self.released:
+            return
+        self.released = True
+        if self.granted:
+            self.admission._finish(self)
+        else:
+            self.admission._abandon(self)
+
+
+class AdmissionQueue:
+    """Slots and the fair queue in front of them for one provider."""
+
+    def __init__(self, name, slots, queue_size=ADMISSION_QUEUE_SIZE, client_queue_size=ADMISSION_CLIENT_QUEUE_SIZE,
+                 max_wait=ADMISSION_MAX_WAIT_SECONDS):
+        self.name = name
+        self.slots = slots
+        self.queue_size = queue_size
+        self.client_queue_size = client_queue_size
+        self.max_wait = max_wait
+        self.running = 0
+        self.queued = 0
+        self.admitted = 0
+        # Waiting tickets per client; the first client is served next
+        self._waiting = OrderedDict()
+        # How long admitted requests held their slot
+        self._service = LatencyTracker(f"admission {name}")
+
+    def service_seconds(self):
+        """Return the typical time a request holds a slot, or None before any was observed."""
+        return self._service.percentile(50) or get_latency_tracker(self.name).percentile(50)
+
+    def wait_estimate(self, places):
+        """Return the seconds until `places` more waiting requests have been admitted."""
+        return places * (self.service_seconds() or DEFAULT_SERVICE_SECONDS) / self.slots
+
+    def position(self, client):
+        """
+        Return the place a new request from the client would take in the queue.
+
+        With round-robin service, the request is admitted in the round after
+        the client's queued requests, behind at most that many requests of
+        every other client.
+        """
+        rounds = len(self._waiting.get(client, ())) + 1
+        return sum(min(len(tickets), rounds) for other, tickets in self._waiting.items() if other != client) + rounds
+
+    def check(self, client):
+        """
+        Raise if a request from the client would not be admitted right now.
+
+        Raises:
+            AdmissionRejectedError: If the queue is full, the client already has
+                ADMISSION_CLIENT_QUEUE_SIZE requests waiting, or the request
+                would wait longer than the deadline
+        """
+        if self.running < self.slots and not self.queued:
+            return
+        if self.queued >= self.queue_size:
+            raise self._reject(REJECTED_QUEUE_FULL, f"The {self.name} queue is full", self.wait_estimate(1))
+        if len(self._waiting.get(client, ())) >= self.client_queue_size:
+            # The client's next request is admitted after one request of each waiting client
+            raise self._reject(REJECTED_CLIENT_LIMIT, f"Too many requests queued for {self.name}",
+                               self.wait_estimate(len(self._waiting)))
+        wait = self.wait_estimate(self.position(client))
+        if self.service_seconds() is not None and wait > self.max_wait:
+            raise self._reject(REJECTED_DEADLINE, f"The {self.name} queue is too long to start within "
+                                                  f"{self.max_wait:g}s", wait - self.max_wait)
+
+    def enter(self, client):
+        """
+        Take a slot, or a place in the queue, for a request from the client.
+
+        Returns:
+            Ticket: Wait on it before doing the work, and release it afterwards
+
+        Raises:
+            AdmissionRejectedError: See check
+        """
+        self.check(client)
+        ticket = Ticket(self, client)
+        if self.running < self.slots and not self.queued:
+            self._start(ticket)
+        else:
+            ticket.position = self.position(client)
+            self._waiting.setdefault(client, deque()).append(ticket)
+            self.queued += 1
+        return ticket
+
+    @asynccontextmanager
+    async def admit(self, client):
+        """Hold a slot for the enclosed block, waiting for one in the queue first; the client is current within it."""
+        ticket = self.enter(client)
+        token = use_client(client)
+        try:
+            await ticket.wait(self.max_wait)
+            yield ticket
+        finally:
+            reset_client(token)
+            ticket.release()
+
+    def _start(self, ticket):
+        self.running += 1
+        self.admitted += 1
+        ticket._grant()
+
+    def _dispatch(self):
+        """Hand free slots to waiting requests, one client at a time."""
+        while self.running < self.slots and self._waiting:
+            client, tickets = next(iter(self._waiting.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                self._waiting.move_to_end(client)
+            else:
+                del self._waiting[client]
+            self.queued -= 1
+            self._start(ticket)
+
+    def _finish(self, ticket):
+        self._service.record(time.monotonic() - ticket.granted_at)
+        self.running -= 1
+        self._dispatch()
+
+    def _abandon(self, ticket):
+        """Take a ticket that was not granted out of the queue."""
+        tickets = self._waiting.get(ticket.client)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            self.queued -= 1
+            if not tickets:
+                del self._waiting[ticket.client]
+
+    def _reject(self, reason, message, retry_after):
+        ADMISSION_REJECTIONS.inc(provider=self.name, reason=reason)
+        return AdmissionRejectedError(f"{message}, please retry later", max(retry_after, 1.0))
+
+    def stats(self):
+        """Return the current usage of the queue."""
+        return {
+            "slots": self.slots,
+            "running": self.running,
+            "queued": self.queued,
+            "clients_waiting": len(self._waiting),
+            "admitted": self.admitted,
+            "service_seconds": self.service_seconds(),
+        }
+
+
+_queues = {}
+
+
+def get_admission(name):
+    """
+    Return the admission queue for a provider, creating it on first use.
+
+    Args:
+        name (str): The model or provider name, e.g. "gemini", "auto" or "photoroom";
+            case-insensitive, like get_service. The "auto" queue only limits
+            requests for model auto; their provider calls wait in the
+            providers' queues as well.
+
+    Returns:
+        AdmissionQueue: The provider's queue, with as many slots as its bulkhead
+    """
+    name = name.lower()
+    queue = _queues.get(name)
+    if queue is None:
+        queue = AdmissionQueue(name, PROVIDER_CONCURRENCY.get(name, DEFAULT_CONCURRENCY))
+        _queues[name] = queue
+    return queue
+
+
+def admission_stats():
+    """Return the usage of every admission queue seen so far."""
+    return {name: queue.stats() for name, queue in _queues.items()}
+
+
+Gauge("imagegen_admission_running", "Requests holding an admission slot",
+      lambda: {(name,): queue.running for name, queue in _queues.items()}, ["provider"])
+Gauge("imagegen_admission_queued", "Requests waiting in an admission queue",
+      lambda: {(name,): queue.queued for name, queue in _queues.items()}, ["provider"])
@@ -0,0 +1,509 @@
+"""
+Index and garbage collection of files in UPLOAD_DIR and RESULT_DIR.
+
+Every upload, prepared input, result, cut-out and derivative is recorded in a
+SQLite index with its kind, size, the file it was derived from and when it was
+last accessed. A background collector deletes files that have not been
+accessed for their kind's TTL and, while the total size is over the disk
+budget, the least recently accessed files. Files in use by queued or running
+jobs are pinned and never deleted.
+
+New files and accesses are buffered in memory and written in batches, so the
+request path never waits on SQLite. The index only describes what is on disk
+and can be rebuilt from the directories at any time.
+
+With several worker processes, every worker writes to the index, and one of
+them collects per ARTIFACT_GC_INTERVAL_SECONDS. Each worker also holds its
+pins in the shared state, renewed while its jobs run, and the collector checks
+them before it deletes a file, so files used by any worker's jobs are kept.
+"""
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from backend.config.settings import (
+    UPLOAD_DIR,
+    RESULT_DIR,
+    PREPARED_DIR,
+    DERIVATIVE_DIR,
+    ARTIFACT_INDEX_PATH,
+    ARTIFACT_MAX_BYTES,
+    ARTIFACT_TTL_SECONDS,
+    ARTIFACT_GC_INTERVAL_SECONDS,
+    ARTIFACT_FLUSH_INTERVAL_SECONDS,
+)
+from backend.utils.metrics import Counter, Gauge
+from backend.utils.shared_state import shared_state, LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Artifact kinds
+KIND_UPLOAD = "upload"
+KIND_PREPARED = "prepared"
+KIND_RESULT = "result"
+KIND_CUTOUT = "cutout"
+KIND_DERIVATIVE = "derivative"
+
+# Prefix of the shared-state holds on pinned files
+PIN_KEY_PREFIX = "pin:"
+
+# Kinds that are useless without their parent and are deleted along with it
+DEPENDENT_KINDS = {KIND_DERIVATIVE}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    parent TEXT,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access);
+CREATE INDEX IF NOT EXISTS artifacts_kind_last_access ON artifacts (kind, last_access);
+CREATE INDEX IF NOT EXISTS artifacts_parent ON artifacts (parent);
+"""
+
+ARTIFACTS_DELETED = Counter(
+    "imagegen_artifacts_deleted",
+    "Files deleted by the artifact garbage collector, by kind and reason (ttl, budget, parent)",
+    ["kind", "reason"],
+)
+
+# Cut-outs are named "<source>_no_bg.png" (formerly "<source>_no_bg_<hash>.png")
+_CUTOUT_NAME = re.compile(r"^(?P<stem>.+)_no_bg(_[0-9a-f]{12})?\.png$")
+_DERIVATIVE_NAME = re.compile(r"^(?P<stem>.+)_w\d+\.[a-z]+$")
+
+# Directories holding each kind of file; nested ones come first so they are
+# not counted as part of their parent directory
+_LOCATIONS = [
+    (PREPARED_DIR, KIND_PREPARED),
+    (DERIVATIVE_DIR, KIND_DERIVATIVE),
+    (UPLOAD_DIR, KIND_UPLOAD),
+    (RESULT_DIR, KIND_RESULT),
+]
+
+
+def _normalize(path):
+    return os.path.realpath(path)
+
+
+def _is_artifact_name(name):
+    """Skip hidden files (e.g. .gitkeep) and partially written temporary files."""
+    return not name.startswith(".") and not name.endswith(".tmp")
+
+
+def classify(path):
+    """Return the kind of a stored file from its location and name, or None."""
+    for directory, kind in _LOCATIONS:
+        directory = _normalize(directory)
+        if path.startswith(directory + os.sep):
+            if kind == KIND_RESULT and _CUTOUT_NAME.match(os.path.basename(path)):
+                return KIND_CUTOUT
+            return kind
+    return None
+
+
+def scan_directories():
+    """
+    List the artifacts on disk, with the kind and parent implied by their location and name.
+
+    Returns:
+        list: (path, kind, size, parent, mtime) tuples
+    """
+    found = []
+    result_stems = {}
+    nested = {_normalize(directory) for directory, _ in _LOCATIONS}
+    for top, kind in _LOCATIONS:
+        top = _normalize(top)
+        for directory, subdirectories, files in os.walk(top):
+            # Skip staging areas and directories scanned on their own
+            subdirectories[:] = [name for name in subdirectories if not name.startswith(".")
+                                 and os.path.join(directory, name) not in nested]
+            for name in files:
+                if not _is_artifact_name(name):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat_result = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                entry_kind = kind
+                if kind == KIND_RESULT:
+                    if _CUTOUT_NAME.match(name):
+                        entry_kind = KIND_CUTOUT
+                    else:
+                        result_stems[os.path.splitext(name)[0]] = path
+                found.append([path, entry_kind, stat_result.st_size, None, stat_result.st_mtime])
+
+    # Cut-outs and derivatives are named after the result they were made from
+    for artifact in found:
+        pattern = {KIND_CUTOUT: _CUTOUT_NAME, KIND_DERIVATIVE: _DERIVATIVE_NAME}.get(artifact[1])
+        if pattern is not None:
+            match = pattern.match(os.path.basename(artifact[0]))
+            artifact[3] = result_stems.get(match.group("stem")) if match else None
+    return [tuple(artifact) for artifact in found]
+
+
+class ArtifactIndex:
+    """SQLite index of stored files, with disk-budget and TTL garbage collection."""
+
+    def __init__(self, db_path=ARTIFACT_INDEX_PATH, max_bytes=ARTIFACT_MAX_BYTES, ttls=ARTIFACT_TTL_SECONDS,
+                 gc_interval=ARTIFACT_GC_INTERVAL_SECONDS, flush_interval=ARTIFACT_FLUSH_INTERVAL_SECONDS):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.ttls = dict(ttls)
+        self.gc_interval = gc_interval
+        self.flush_interval = flush_interval
+        self._db = None
+        # Serializes use of the connection between the collector and flushes
+        self._lock = threading.Lock()
+        # Writes waiting for the next flush: path -> (kind, parent, time) and path -> time
+        self._pending = {}
+        self._accessed = {}
+        # Paths in use by running work, with reference counts
+        self._pins = collections.Counter()
+        # Serializes updates of this worker's shared holds on pinned paths
+        self._pin_lock = asyncio.Lock()
+        # Pins held in the shared state expire unless renewed by the background task
+        self.pin_ttl = max(LEASE_SECONDS, 3 * flush_interval)
+        self._task = None
+        self._usage = {}
+        self.last_collection = None
+
+    # Recording (called on the request path; only touches memory)
+
+    def record(self, path, kind, parent=None):
+        """
+        Register a newly written file.
+
+        Args:
+            path (str): The file
+            kind (str): One of the KIND_* constants
+            parent (str, optional): The file it was derived from
+        """
+        if path:
+            self._pending[_normalize(path)] = (kind, _normalize(parent) if parent else None, time.time())
+
+    def record_existing(self, path):
+        """Register a file that reappeared on disk (e.g. fetched from remote storage)."""
+        path = _normalize(path)
+        kind = classify(path)
+        if kind is not None:
+            self._pending[path] = (kind, None, time.time())
+
+    def touch(self, path):
+        """Note that a file was read, so it counts as recently used."""
+        if path:
+            self._accessed[_normalize(path)] = time.time()
+
+    async def pin(self, path):
+        """Protect a file (and its derived files) from deletion, in every worker process, until unpinned."""
+        if path:
+            key = _normalize(path)
+            self._pins[key] += 1
+            try:
+                await self._publish_pin(key)
+            except BaseException:
+                self._release_pin(key)
+                raise
+
+    async def unpin(self, path):
+        if path:
+            key = _normalize(path)
+            self._release_pin(key)
+            await self._publish_pin(key)
+
+    def _release_pin(self, key):
+        self._pins[key] -= 1
+        if self._pins[key] <= 0:
+            del self._pins[key]
+
+    async def _publish_pin(self, key):
+        """Hold or release the shared pin on a path to match this worker's pins."""
+        if not shared_state.shared:
+            return
+        async with self._pin_lock:
+            if key in self._pins:
+                await shared_state.hold([PIN_KEY_PREFIX + key], self.pin_ttl)
+            else:
+                await shared_state.unhold(PIN_KEY_PREFIX + key)
+
+    async def _renew_pins(self):
+        if shared_state.shared and self._pins:
+            async with self._pin_lock:
+                await shared_state.hold([PIN_KEY_PREFIX + key for key in list(self._pins)], self.pin_ttl)
+
+    async def _shared_pins(self):
+        """Return the paths pinned by any worker process."""
+        return {key[len(PIN_KEY_PREFIX):] for key in await shared_state.held(PIN_KEY_PREFIX)}
+
+    @asynccontextmanager
+    async def pinned(self, *paths):
+        """Pin files for the duration of the enclosed block."""
+        pinned = []
+        try:
+            for path in paths:
+                await self.pin(path)
+                pinned.append(path)
+            yield
+        finally:
+            for path in pinned:
+                await self.unpin(path)
+
+    def is_pinned(self, path, parent=None, shared_pins=()):
+        """Whether a file or its parent is pinned by this worker or, per shared_pins, by any worker."""
+        return (path in self._pins or path in shared_pins
+                or (parent is not None and (parent in self._pins or parent in shared_pins)))
+
+    # Database access (runs in a worker thread)
+
+    def _connect(self):
+        """Open the index, and rebuild it from disk if it is new."""
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        empty = self._db.execute("SELECT NOT EXISTS (SELECT 1 FROM artifacts)").fetchone()[0]
+        if empty:
+            self._rebuild()
+        else:
+            self._refresh_usage()
+
+    def _flush(self, pending, accessed):
+        rows = []
+        for path, (kind, parent, recorded_at) in pending.items():
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                # Deleted again before it was indexed (e.g. a transcoded raw file)
+                continue
+            rows.append((path, kind, size, parent, recorded_at, recorded_at))
+        with self._lock, self._db:
+            self._db.executemany(
+                """
+                INSERT INTO artifacts (path, kind, size, parent, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    kind = excluded.kind,
+                    size = excluded.size,
+                    parent = COALESCE(excluded.parent, artifacts.parent),
+                    last_access = MAX(artifacts.last_access, excluded.last_access)
+                """,
+                rows,
+            )
+            self._db.executemany(
+                "UPDATE artifacts SET last_access = MAX(last_access, ?) WHERE path = ?",
+                [(accessed_at, path) for path, accessed_at in accessed.items()],
+            )
+        if rows:
+            self._refresh_usage()
+
+    def _refresh_usage(self):
+        with self._lock:
+            self._usage = {
+                kind: {"files": files, "bytes": size}
+                for kind, files, size in self._db.execute(
+                    "SELECT kind, COUNT(*), COALESCE(SUM(size), 0) FROM artifacts GROUP BY kind"
+                )
+            }
+
+    def _rebuild(self):
+        """Replace the index with what is on disk, keeping known access times."""
+        started = time.perf_counter()
+        found = scan_directories()
+        with self._lock, self._db:
+            known = dict(self._db.execute("SELECT path, last_access FROM artifacts"))
+            self._db.execute("DELETE FROM artifacts")
+            self._db.executemany(
+                "INSERT INTO artifacts (path, kind, size, parent, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, kind, size, parent, mtime, max(known.get(path, mtime), mtime))
+                 for path, kind, size, parent, mtime in found],
+            )
+        self._refresh_usage()
+        logger.info("Artifact index rebuilt from disk: %d files in %.2fs", len(found), time.perf_counter() - started)
+        return len(found)
+
+    def _delete(self, path, kind, reason, deleted):
+        """Delete a file and its dependent files; return the bytes freed."""
+        freed = 0
+        with self._lock:
+            children = self._db.execute(
+                "SELECT path, kind, size FROM artifacts WHERE parent = ? AND kind IN ({})".format(
+                    ",".join("?" * len(DEPENDENT_KINDS))),
+                (path, *DEPENDENT_KINDS),
+            ).fetchall()
+        for child_path, child_kind, _ in children:
+            freed += self._delete(child_path, child_kind, "parent", deleted)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error("Failed to delete %s: %s", path, e)
+            return freed
+        with self._lock, self._db:
+            row = self._db.execute("DELETE FROM artifacts WHERE path = ? RETURNING size", (path,)).fetchone()
+        if row is None:
+            # Already deleted along with its parent
+            return freed
+        ARTIFACTS_DELETED.inc(kind=kind, reason=reason)
+        deleted[reason] = deleted.get(reason, 0) + 1
+        return freed + row[0]
+
+    def _collect(self, shared_pins=None):
+        """
+        Delete expired files, then least recently used files until the budget is met.
+
+        Args:
+            shared_pins: Callable returning the paths pinned by any worker
+                process, or None with a single process. It is called once to
+                choose the files to delete and again before each deletion, for
+                pins taken meanwhile.
+        """
+        started = time.perf_counter()
+        pins = shared_pins() if shared_pins else ()
+
+        def in_use(path, parent):
+            return self.is_pinned(path, parent, shared_pins() if shared_pins else ())
+        now = time.time()
+        deleted = {}
+        freed = 0
+
+        for kind, ttl in self.ttls.items():
+            if ttl <= 0:
+                continue
+            with self._lock:
+                expired = self._db.execute(
+                    "SELECT path, parent FROM artifacts WHERE kind = ? AND last_access < ?", (kind, now - ttl)
+                ).fetchall()
+            for path, parent in expired:
+                if not self.is_pinned(path, parent, pins) and not in_use(path, parent):
+                    freed += self._delete(path, kind, "ttl", deleted)
+
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        if total > self.max_bytes:
+            victims = []
+            excess = total - self.max_bytes
+            with self._lock:
+                cursor = self._db.execute("SELECT path, kind, size, parent FROM artifacts ORDER BY last_access")
+                for path, kind, size, parent in cursor:
+                    if excess <= 0:
+                        break
+                    if self.is_pinned(path, parent, pins):
+                        continue
+                    victims.append((path, kind, parent))
+                    excess -= size
+                cursor.close()
+            for path, kind, parent in victims:
+                if not in_use(path, parent):
+                    freed += self._delete(path, kind, "budget", deleted)
+
+        self._refresh_usage()
+        self.last_collection = {
+            "finished_at": time.time(),
+            "duration_seconds": round(time.perf_counter() - started, 3),
+            "deleted": deleted,
+            "bytes_freed": freed,
+        }
+        if deleted:
+            logger.info("Artifact garbage collection freed %d bytes", freed, extra={"deleted": deleted})
+        return self.last_collection
+
+    # Async API
+
+    async def _open(self):
+        if self._db is None:
+            await asyncio.to_thread(self._connect)
+
+    async def start(self):
+        """Open the index and start the background flush and collection task."""
+        await self._open()
+        if self._task is None:
+            # The collector outlives the request that started it
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def flush(self):
+        """Write buffered new files and accesses to the index."""
+        if self._db is None:
+            return
+        pending, self._pending = self._pending, {}
+        accessed, self._accessed = self._accessed, {}
+        if pending or accessed:
+            await asyncio.to_thread(self._flush, pending, accessed)
+
+    async def collect(self):
+        """Run a garbage collection now and return what it deleted."""
+        await self._open()
+        await self.flush()
+        shared_pins = None
+        if shared_state.shared:
+            loop = asyncio.get_running_loop()
+
+            def shared_pins():
+                return asyncio.run_coroutine_threadsafe(self._shared_pins(), loop).result()
+
+        return await asyncio.to_thread(self._collect, shared_pins)
+
+    async def rebuild(self):
+        """Re-scan UPLOAD_DIR and RESULT_DIR and replace the index; returns the number of files."""
+        await self._open()
+        await self.flush()
+        return await asyncio.to_thread(self._rebuild)
+
+    async def _run(self):
+        last_collection = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._renew_pins()
+                if (self.gc_interval > 0 and time.monotonic() - last_collection >= self.gc_interval
+                        and await shared_state.claim("artifact-gc", self.gc_interval)):
+                    last_collection = time.monotonic()
+                    await self.collect()
+                else:
+                    await self.flush()
+            except Exception as e:
+                logger.error("Artifact index maintenance failed: %s", e)
+
+    async def shutdown(self):
+        """Stop the background task, write pending updates and close the index."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._db is not None:
+            await self.flush()
+            self._db.close()
+            self._db = None
+
+    def stats(self):
+        """Return usage by kind, the budget and TTLs, and the last collection."""
+        return {
+            "max_bytes": self.max_bytes,
+            "total_bytes": sum(usage["bytes"] for usage in self._usage.values()),
+            "kinds": self._usage,
+            "ttl_seconds": self.ttls,
+            "pinned": len(self._pins),
+            "pending_writes": len(self._pending) + len(self._accessed),
+            "last_collection": self.last_collection,
+        }
+
+
+artifact_index = ArtifactIndex()
+
+Gauge("imagegen_artifact_bytes", "Disk space used by uploads and results, by kind",
+      lambda: {(kind,): usage["bytes"] for kind, usage in artifact_index._usage.items()},
+      ["kind"])
+Gauge("imagegen_artifact_files", "Number of stored uploads and results, by kind",
+      lambda: {(kind,): usage["files"] for kind, usage in artifact_index._usage.items()},
+      ["kind"])
@@ -1,4 +1,3 @@
-from openai import OpenAI
 import base64
 from dotenv import load_dotenv
 import os
@@ -6,7 +5,15 @@ import uuid
 from pathlib import Path
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+_client = None
+
+def _get_client():
+    """Create the OpenAI client on first use instead of at import time."""
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
 
 def remove_bg(image_path):
     """
@@ -31,7 +38,7 @@ def remove_bg(image_path):
         # Call OpenAI API to remove background
         with open(image_path, "rb") as image_file:
             print(f"[INFO]--- Calling OpenAI GPT-image-1 API for background removal ---")
-            result = client.images.edit(
+            result = _get_client().images.edit(
                 model="gpt-image-1",
                 image=image_file,
                 prompt="Remove the background completely and make it transparent. Keep the main subject intact and preserve all details of the foreground object.",
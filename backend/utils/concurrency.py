@@ -0,0 +1,145 @@
+"""
+Concurrency primitives shared by the provider integrations.
+"""
+import asyncio
+
+from backend.config.settings import PROVIDER_CONCURRENCY
+from backend.utils.metrics import Gauge
+
+# Limit applied to providers that have no explicit entry in PROVIDER_CONCURRENCY
+DEFAULT_CONCURRENCY = 4
+
+
+class Bulkhead:
+    """
+    Caps the number of concurrent calls to a single provider.
+
+    Each provider gets its own bulkhead, so a slowdown at one provider only
+    exhausts that provider's slots and never blocks calls to the others.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        """Return the current usage of the bulkhead."""
+        return {"limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting}
+
+
+_bulkheads = {}
+
+
+def get_bulkhead(name):
+    """
+    Return the bulkhead for a provider, creating it on first use.
+
+    Args:
+        name (str): The provider name, e.g. "gemini", "openai" or "photoroom"
+
+    Returns:
+        Bulkhead: The provider's bulkhead
+    """
+    bulkhead = _bulkheads.get(name)
+    if bulkhead is None:
+        bulkhead = Bulkhead(name, PROVIDER_CONCURRENCY.get(name, DEFAULT_CONCURRENCY))
+        _bulkheads[name] = bulkhead
+    return bulkhead
+
+
+Gauge("imagegen_provider_in_flight", "Provider calls currently in flight",
+      lambda: {(name,): bulkhead.in_flight for name, bulkhead in _bulkheads.items()}, ["provider"])
+Gauge("imagegen_provider_waiting", "Provider calls waiting for a bulkhead slot",
+      lambda: {(name,): bulkhead.waiting for name, bulkhead in _bulkheads.items()}, ["provider"])
+
+
+class _Call:
+    """An in-flight call tracked by SingleFlight."""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into a single execution.
+
+    The first caller for a key starts the work; callers that arrive while it is
+    still running wait for the same result instead of starting another call.
+    The work is cancelled only once every caller waiting on it has gone away,
+    with the cancellation message of the last one.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def in_flight(self, key):
+        """Return True if a call for the key is currently running."""
+        return key in self._calls
+
+    async def do(self, key, func):
+        """
+        Run func() for the key, or join the call that is already running.
+
+        Args:
+            key: Identifies equivalent calls
+            func: Zero-argument callable returning an awaitable
+
+        Returns:
+            The result of the (shared) call
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(func()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _task: self._forget(key, call))
+
+        call.waiters += 1
+        reason = ()
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError as e:
+            reason = e.args
+            raise
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel(*reason)
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+async def gather_all(*awaitables):
+    """
+    Run awaitables concurrently and return their results in order.
+
+    Unlike asyncio.gather, the first failure (or cancellation) cancels the
+    others, so no provider call keeps running for a result nobody will use.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
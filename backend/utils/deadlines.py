@@ -0,0 +1,176 @@
+"""
+Deadlines and cancellation of provider work.
+
+Every API request gets a deadline: REQUEST_DEADLINE_SECONDS, or less when the
+client sends an X-Request-Timeout header. A job keeps the deadline of the
+request that queued it. Like the request trace, the deadline lives in a
+context variable and follows the work into the tasks it creates. Admission
+waits, rate-limit waits and provider calls stop when it expires.
+
+Work is also cancelled once nobody is waiting for it: a /download whose
+client disconnects, a batch whose stream is closed, a job whose clients have
+all gone away. The reason is passed as the cancellation message, so the
+provider call that is cut short is counted under it.
+"""
+import asyncio
+import contextvars
+import math
+import time
+from contextlib import asynccontextmanager
+
+from backend.config.settings import REQUEST_DEADLINE_SECONDS
+from backend.utils.metrics import Counter
+
+# Why work was cancelled
+REASON_DEADLINE = "deadline"
+REASON_DISCONNECTED = "disconnected"
+REASON_CANCELLED = "cancelled"
+REASON_HEDGE = "hedge"
+REASON_SHUTDOWN = "shutdown"
+
+# What happened to a provider call nobody needed any more
+OUTCOME_AVOIDED = "avoided"
+OUTCOME_ABORTED = "aborted"
+
+WASTED_PROVIDER_CALLS = Counter(
+    "imagegen_wasted_provider_calls",
+    "Provider calls whose result was no longer wanted, by reason (deadline, disconnected, cancelled, hedge, "
+    "shutdown) and outcome (avoided: never sent, aborted: cancelled in flight)",
+    ["provider", "reason", "outcome"],
+)
+
+# Monotonic time by which the current request's result is needed, or None
+_expires = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceededError(Exception):
+    """Raised when work is still unfinished at its request's deadline."""
+
+
+class ClientDisconnectedError(Exception):
+    """Raised when the client of a request went away before the result was ready."""
+
+
+def deadline_seconds(request):
+    """
+    Return the time budget of a request in seconds, or None for no deadline.
+
+    Clients may ask for a shorter budget than REQUEST_DEADLINE_SECONDS with
+    an X-Request-Timeout header.
+    """
+    budget = REQUEST_DEADLINE_SECONDS or math.inf
+    try:
+        requested = float(request.headers.get("x-request-timeout") or "inf")
+    except ValueError:
+        requested = math.inf
+    if requested > 0:
+        budget = min(budget, requested)
+    return None if budget == math.inf else budget
+
+
+def set_deadline(seconds):
+    """
+    Give the current task (and tasks it creates) a deadline.
+
+    Args:
+        seconds (float): Time from now, or None for no deadline
+
+    Returns:
+        Token to pass to reset_deadline
+    """
+    return _expires.set(time.monotonic() + seconds if seconds is not None else None)
+
+
+def use_deadline(expires):
+    """Make an existing deadline (from current_deadline) current, e.g. a job's in its task."""
+    return _expires.set(expires)
+
+
+def reset_deadline(token):
+    _expires.reset(token)
+
+
+def current_deadline():
+    """Return the monotonic time the current deadline expires at, or None."""
+    return _expires.get()
+
+
+def remaining():
+    """Return the seconds left until the current deadline (infinite without one)."""
+    expires = _expires.get()
+    return math.inf if expires is None else expires - time.monotonic()
+
+
+@asynccontextmanager
+async def bounded():
+    """
+    Run the enclosed block until the current deadline at most.
+
+    Raises:
+        DeadlineExceededError: If the deadline has passed, or passes before the
+            block finishes (the block is cancelled)
+    """
+    left = remaining()
+    if left == math.inf:
+        yield
+        return
+    if left <= 0:
+        raise DeadlineExceededError("The request deadline expired")
+    try:
+        async with asyncio.timeout(left) as scope:
+            yield
+    except TimeoutError:
+        if scope.expired():
+            raise DeadlineExceededError("The request deadline expired") from None
+        raise
+
+
+def cancel_reason(error):
+    """Return the reason a CancelledError was raised for."""
+    if error.args and isinstance(error.args[0], str):
+        return error.args[0]
+    return REASON_CANCELLED
+
+
+def record_wasted(provider, reason, outcome):
+    """Count a provider call whose result was no longer wanted."""
+    WASTED_PROVIDER_CALLS.inc(provider=provider, reason=reason, outcome=outcome)
+
+
+async def _disconnected(request):
+    """Return once the client of a request has disconnected."""
+    # Request.is_disconnected() only peeks at the receive channel, which does
+    # not see the disconnect through the HTTP middlewares; waiting on it does
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def until_disconnected(request, awaitable):
+    """
+    Await the work for a request, cancelling it if the client disconnects first.
+
+    Args:
+        request: The request whose client is watched
+        awaitable: The work
+
+    Returns:
+        The result of the work
+
+    Raises:
+        ClientDisconnectedError: If the client went away; the work has been
+            cancelled and has finished cleaning up
+    """
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_disconnected(request))
+    try:
+        await asyncio.wait([work, watcher], return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError as e:
+        work.cancel(cancel_reason(e))
+        raise
+    finally:
+        watcher.cancel()
+    if not work.done():
+        work.cancel(REASON_DISCONNECTED)
+        await asyncio.wait([work])
+        raise ClientDisconnectedError("The client disconnected")
+    return work.result()
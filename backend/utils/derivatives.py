@@ -0,0 +1,153 @@
+"""
+Resized and re-encoded variants of generated images.
+
+Derivatives such as history sidebar thumbnails are generated once (by one
+worker process at a time), stored next to the results and served from disk
+afterwards.
+"""
+import os
+import uuid
+from urllib.parse import parse_qs
+
+from starlette.exceptions import HTTPException
+
+from backend.config.settings import (
+    DERIVATIVE_DIR,
+    DERIVATIVE_WIDTHS,
+    ENCODER_OPTIONS,
+    RESULT_CACHE_MAX_AGE,
+)
+from backend.utils.artifact_index import artifact_index, KIND_DERIVATIVE
+from backend.utils.concurrency import SingleFlight
+from backend.utils.shared_state import shared_state
+from backend.utils.storage import StorageFiles, result_store, shard_path
+from backend.utils.image_output import FILE_EXTENSIONS, validate_output_format
+from backend.utils.workers import run_in_process, run_to_completion
+
+_generating = SingleFlight()
+
+
+def make_thumbnail(source_path, target_path, width, output_format, options):
+    """
+    Write a copy of an image scaled to the given width (runs in the process pool).
+
+    Images narrower than the width are re-encoded at their original size.
+
+    Args:
+        source_path (str): The image to read
+        target_path (str): Where to write the derivative
+        width (int): Target width in pixels
+        output_format (str): Format of the derivative
+        options (dict): Encoder settings passed to Image.save
+    """
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        image.draft("RGB", (width, width))
+        if output_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        image.save(target_path, format=output_format.upper(), **options)
+
+
+def normalize_width(width):
+    """
+    Round a requested width up to the nearest supported derivative width.
+
+    Args:
+        width (int): The requested width
+
+    Returns:
+        int: A width from DERIVATIVE_WIDTHS
+    """
+    for allowed in DERIVATIVE_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return DERIVATIVE_WIDTHS[-1]
+
+
+async def get_derivative(source_path, width=None, output_format=None):
+    """
+    Return the path of a resized/re-encoded variant, generating it on first use.
+
+    Args:
+        source_path (str): Path of the original result
+        width (int, optional): Requested width; None keeps the original size
+        output_format (str, optional): Requested format; None keeps PNG
+
+    Returns:
+        str: Path of the derivative file
+    """
+    width = normalize_width(width) if width else DERIVATIVE_WIDTHS[-1]
+    output_format = output_format or "png"
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    derivative_path = shard_path(DERIVATIVE_DIR, f"{stem}_w{width}.{FILE_EXTENSIONS[output_format]}")
+    if os.path.exists(derivative_path):
+        return derivative_path
+
+    async def generate():
+        temp_path = f"{derivative_path}.{uuid.uuid4().hex[:8]}.tmp"
+        os.makedirs(os.path.dirname(derivative_path), exist_ok=True)
+        try:
+            await run_to_completion(run_in_process(make_thumbnail, source_path, temp_path, width, output_format,
+                                                   ENCODER_OPTIONS.get(output_format, {})))
+            os.replace(temp_path, derivative_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        artifact_index.record(derivative_path, KIND_DERIVATIVE, parent=source_path)
+        return derivative_path
+
+    async def reuse():
+        return derivative_path if os.path.exists(derivative_path) else None
+
+    async def generate_once():
+        path, _ = await shared_state.run_once(f"derivative:{derivative_path}", generate, reuse)
+        return path
+
+    return await _generating.do(derivative_path, generate_once)
+
+
+class ResultFiles(StorageFiles):
+    """
+    Serves /results with long-lived caching and on-demand derivatives.
+
+    Result files are never modified after they are written (they are named
+    by their content hash), so responses carry an immutable Cache-Control
+    header alongside the ETag, and conditional requests are answered with 304.
+    A "w" (width) and/or "fmt" query parameter serves a resized variant
+    instead, e.g. /results/<path>?w=256&fmt=webp.
+    """
+
+    async def get_response(self, path, scope):
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if "w" not in query and "fmt" not in query:
+            return await super().get_response(path, scope)
+
+        try:
+            width = int(query["w"][0]) if "w" in query else None
+            output_format = validate_output_format(query["fmt"][0]) if "fmt" in query else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if width is not None and width <= 0:
+            raise HTTPException(status_code=400, detail="Width must be positive")
+
+        await self.fetch(path)
+        full_path, stat_result = self.lookup_path(path)
+        if stat_result is None or not os.path.isfile(full_path):
+            raise HTTPException(status_code=404)
+
+        # Reading a derivative also counts as a use of the original
+        artifact_index.touch(full_path)
+        derivative_path = await get_derivative(full_path, width, output_format)
+        return self.file_response(derivative_path, os.stat(derivative_path), scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        artifact_index.touch(full_path)
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Cache-Control"] = f"public, max-age={RESULT_CACHE_MAX_AGE}, immutable"
+        return response
@@ -1,18 +1,50 @@
 """
 Utility functions for file operations.
 """
+import asyncio
+import contextlib
+import hashlib
+import logging
 import os
-import uuid
-from pathlib import Path
-import http.client
-import mimetypes
-from backend.config.settings import UPLOAD_DIR, ALLOWED_EXTENSIONS, MAX_FILE_SIZE
-from PIL import Image
+import time
+from urllib.parse import urlparse, unquote
+from backend.config.settings import (
+    ALLOWED_EXTENSIONS,
+    MAX_FILE_SIZE,
+    UPLOAD_CHUNK_SIZE,
+    PHOTOROOM_API_KEY,
+    LOCAL_CUTOUT_ENABLED,
+    LOCAL_CUTOUT_MIN_CONFIDENCE,
+    LOCAL_CUTOUT_TOLERANCE,
+    ENCODER_OPTIONS,
+)
+from backend.utils.admission import get_admission
+from backend.utils.artifact_index import artifact_index, KIND_UPLOAD, KIND_CUTOUT
+from backend.utils.concurrency import get_bulkhead, SingleFlight
+from backend.utils.storage import upload_store, result_store, hash_file
+from backend.utils.photoroom_client import photoroom_client
+from backend.utils.resilience import get_policy
+from backend.utils.shared_state import shared_state
+from backend.utils.local_cutout import cut_out_locally
+from backend.utils.metrics import Counter, STAGE_SECONDS, observe_stage
+from backend.utils.tracing import add_span
+from backend.utils.workers import run_in_process, run_to_completion
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Background removals in progress, keyed by the SHA-256 of the source image
+_cutouts_in_flight = SingleFlight()
+
+BACKGROUND_REMOVALS = Counter(
+    "imagegen_background_removals",
+    "Background removals by engine (local, photoroom) and method (existing_alpha, flat_background, api)",
+    ["engine", "method"],
+)
+
 def allowed_file(filename):
     """
     Check if the file extension is allowed.
@@ -25,114 +57,209 @@ def allowed_file(filename):
     """
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def save_uploaded_file(file):
+async def save_uploaded_file(file):
     """
-    Save an uploaded file to the upload directory.
+    Save an uploaded file to the upload store.
+
+    The upload is streamed to disk in chunks: the size limit is enforced as
+    the data arrives and the content hash is computed in the same pass. Disk
+    writes and hashing run in a worker thread, off the event loop. The file is
+    stored under its content hash, so an image uploaded again is not stored
+    twice.
     
     Args:
         file: The uploaded file object
         
     Returns:
-        str: Path to the saved file
+        tuple: (file_path, sha256) with the path to the saved file and the
+            hex digest of its contents
     """
-    # Check file size
-    file.file.seek(0, os.SEEK_END)
-    file_size = file.file.tell()
-    file.file.seek(0)
-    
-    if file_size > MAX_FILE_SIZE:
-        raise ValueError(f"File size exceeds the maximum allowed size of {MAX_FILE_SIZE / (1024 * 1024)}MB")
-    
-    # Generate a unique filename
+    started = time.perf_counter()
     original_filename = file.filename
     extension = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
-    filename = f"{uuid.uuid4().hex}.{extension}"
-    
-    # Save the file
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    with open(file_path, "wb") as buffer:
-        buffer.write(file.file.read())
-    
-    return file_path
+    staging_path = upload_store.staging_path(extension)
+
+    digest = hashlib.sha256()
+    file_size = 0
+    buffer = await asyncio.to_thread(open, staging_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            file_size += len(chunk)
+            if file_size > MAX_FILE_SIZE:
+                raise ValueError(f"File size exceeds the maximum allowed size of {MAX_FILE_SIZE / (1024 * 1024)}MB")
+
+            await asyncio.to_thread(_write_chunk, buffer, digest, chunk)
+        await asyncio.to_thread(buffer.close)
+        file_path = await upload_store.put_file(staging_path, extension, digest.hexdigest())
+    except BaseException:
+        await asyncio.to_thread(buffer.close)
+        await _discard(staging_path)
+        raise
 
-def remove_bg(input_path):
+    duration = time.perf_counter() - started
+    STAGE_SECONDS.observe(duration, stage="upload_save", provider="")
+    add_span("upload_save", started, duration)
+    artifact_index.record(file_path, KIND_UPLOAD)
+    return file_path, digest.hexdigest()
+
+async def _discard(path):
+    """Delete a staged file in a worker thread, if it still exists."""
+    with contextlib.suppress(FileNotFoundError):
+        await asyncio.to_thread(os.remove, path)
+
+def _write_chunk(buffer, digest, chunk):
+    """Write a chunk to disk and add it to the running hash."""
+    buffer.write(chunk)
+    digest.update(chunk)
+
+def result_url(result_path):
     """
-    Removes the background from an image using PhotoRoom API.
+    Convert the filesystem path of a result into its URL path.
 
     Args:
-        input_path (str): The path to the input image.
+        result_path (str): Path of a file in the result store
 
     Returns:
-        str: The path to the output image with the background removed.
+        str: The URL path, e.g. "/results/ab/cd/<name>"
+    """
+    return result_store.url(result_path)
+
+async def resolve_result_path(path):
     """
-    print(f"[INFO]--- Starting PhotoRoom background removal for: {input_path} ---")
+    Resolve a reference to a generated image to its file in the result store.
+
+    Accepts the forms the frontend uses: "/results/<path>", "results/<path>",
+    a full URL ending in "/results/<path>", or a bare filename. The resolved
+    path must stay inside the store, so references cannot escape it. With a
+    remote storage backend the file is fetched if it is not cached locally.
+
+    Args:
+        path (str): The reference to resolve
 
-    # Get API key from environment
-    api_key = os.getenv('PHOTOTOOM_API_KEY')
-    if not api_key:
-        print(f"[ERROR]--- PhotoRoom API key not found in environment variables ---")
-        raise ValueError("PhotoRoom API key not configured")
+    Returns:
+        str: Absolute path of the result file
 
-    # Create output path with unique suffix
-    filename = Path(input_path).stem
-    unique_suffix = uuid.uuid4().hex[:8]
-    output_path = os.path.join(os.path.dirname(input_path), f"{filename}_no_bg_{unique_suffix}.png")
+    Raises:
+        ValueError: If the reference points outside the result store
+        FileNotFoundError: If the result does not exist
+    """
+    url_path = unquote(urlparse(path).path)
+    if '/results/' in f"/{url_path}":
+        relative_path = f"/{url_path}".rsplit('/results/', 1)[1]
+    else:
+        relative_path = os.path.basename(url_path)
 
     try:
-        # Define multipart boundary
-        boundary = '----------{}'.format(uuid.uuid4().hex)
-
-        # Get mimetype of image
-        content_type, _ = mimetypes.guess_type(input_path)
-        if content_type is None:
-            content_type = 'application/octet-stream'
-
-        print(f"[INFO]--- Reading image file for PhotoRoom API ---")
-
-        # Prepare the POST data
-        with open(input_path, 'rb') as f:
-            image_data = f.read()
-        filename = os.path.basename(input_path)
-
-        body = (
-            f"--{boundary}\r\n"
-            f"Content-Disposition: form-data; name=\"image_file\"; filename=\"{filename}\"\r\n"
-            f"Content-Type: {content_type}\r\n\r\n"
-        ).encode('utf-8') + image_data + f"\r\n--{boundary}--\r\n".encode('utf-8')
-
-        print(f"[INFO]--- Calling PhotoRoom API for background removal ---")
-
-        # Set up the HTTP connection and headers
-        conn = http.client.HTTPSConnection('sdk.photoroom.com')
-
-        headers = {
-            'Content-Type': f'multipart/form-data; boundary={boundary}',
-            'x-api-key': api_key
-        }
-
-        # Make the POST request
-        conn.request('POST', '/v1/segment', body=body, headers=headers)
-        response = conn.getresponse()
-
-        # Handle the response
-        if response.status == 200:
-            response_data = response.read()
-            with open(output_path, 'wb') as out_f:
-                out_f.write(response_data)
-            print(f"[INFO]--- PhotoRoom background removal successful ---")
-            print(f"[INFO]--- Image saved to: {output_path} ---")
-        else:
-            error_msg = f"PhotoRoom API error: {response.status} - {response.reason}"
-            print(f"[ERROR]--- {error_msg} ---")
-            error_body = response.read()
-            print(f"[ERROR]--- Response: {error_body} ---")
-            raise Exception(error_msg)
-
-        # Close the connection
-        conn.close()
+        image_path = result_store.resolve(relative_path)
+    except ValueError:
+        raise ValueError(f"Invalid result path: {path}")
+    if not await result_store.fetch(image_path):
+        raise FileNotFoundError(f"Image not found: {relative_path}")
+    return image_path
 
+async def _remove_bg_locally(input_path):
+    """
+    Try to cut out an image on the CPU (see backend/utils/local_cutout.py).
+
+    Returns:
+        str: The staged cut-out, or None if PhotoRoom has to do it
+    """
+    staged_path = result_store.staging_path("png")
+    try:
+        with observe_stage("background_removal", "local"):
+            method, confidence = await run_to_completion(run_in_process(
+                cut_out_locally, input_path, staged_path,
+                LOCAL_CUTOUT_TOLERANCE, LOCAL_CUTOUT_MIN_CONFIDENCE, ENCODER_OPTIONS["png"],
+            ))
+    except BaseException as e:
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+        if not isinstance(e, Exception):
+            # Cancelled, e.g. because the client went away
+            raise
+        logger.warning("Local background removal failed: %s", e, extra={"input_path": input_path})
+        return None
+    if confidence < LOCAL_CUTOUT_MIN_CONFIDENCE:
+        logger.info("Local background removal not confident enough",
+                    extra={"input_path": input_path, "method": method, "confidence": confidence})
+        return None
+    BACKGROUND_REMOVALS.inc(engine="local", method=method)
+    logger.info("Local background removal successful", extra={"method": method, "confidence": confidence})
+    return staged_path
+
+async def remove_bg(input_path, client=None):
+    """
+    Removes the background from an image, locally when possible and otherwise using PhotoRoom API.
+
+    Images that already have a transparent background, or that have a flat
+    background that can be cut out with high confidence, are handled on the
+    CPU in milliseconds; everything else is sent to PhotoRoom.
+
+    Background removal is idempotent: the cut-out is stored under the content
+    hash of the source image, so repeated calls for the same image return the
+    existing file, and concurrent calls share a single PhotoRoom request, also
+    across worker processes.
+
+    Requests go through the pooled PhotoRoom client and are limited by the
+    PhotoRoom bulkhead. They wait in PhotoRoom's admission queue first; local
+    cut-outs do not. Each attempt is rate limited, transient errors are
+    retried with backoff, and calls fail fast while PhotoRoom's circuit
+    breaker is open.
+
+    Args:
+        input_path (str): The path to the input image.
+        client (str, optional): Client the PhotoRoom call is queued for, from client_key
+
+    Returns:
+        str: The path to the output image with the background removed.
+
+    Raises:
+        AdmissionRejectedError: If PhotoRoom is needed and its queue cannot take the request
+    """
+    digest = await asyncio.to_thread(hash_file, input_path)
+
+    output_name = f"{digest}_no_bg"
+    output_path = result_store.path_for(output_name, "png")
+    if await result_store.fetch(output_path):
+        logger.info("Reusing existing background removal result", extra={"result_path": output_path})
+        artifact_index.touch(output_path)
         return output_path
 
-    except Exception as e:
-        print(f"[ERROR]--- Failed to remove background using PhotoRoom: {str(e)} ---")
-        raise
+    async def attempt():
+        async with get_bulkhead("photoroom"):
+            return await photoroom_client.segment(input_path, result_store.staging_path("png"))
+
+    async def remove():
+        async with artifact_index.pinned(input_path):
+            staged_path = await _remove_bg_locally(input_path) if LOCAL_CUTOUT_ENABLED else None
+            if staged_path is None:
+                logger.info("Starting PhotoRoom background removal", extra={"input_path": input_path})
+                async with get_admission("photoroom").admit(client):
+                    try:
+                        with observe_stage("background_removal", "photoroom"):
+                            staged_path = await get_policy("photoroom", PHOTOROOM_API_KEY).call(attempt)
+                    except Exception as e:
+                        logger.error("Failed to remove background using PhotoRoom: %s", e)
+                        raise
+                BACKGROUND_REMOVALS.inc(engine="photoroom", method="api")
+                logger.info("PhotoRoom background removal successful", extra={"input_path": input_path})
+        try:
+            path = await result_store.put_file(staged_path, "png", name=output_name)
+        except BaseException:
+            await _discard(staged_path)
+            raise
+        artifact_index.record(path, KIND_CUTOUT, parent=input_path)
+        return path
+
+    async def reuse():
+        return output_path if await result_store.fetch(output_path) else None
+
+    async def remove_once():
+        path, _ = await shared_state.run_once(f"cutout:{digest}", remove, reuse)
+        return path
+
+    return await _cutouts_in_flight.do(digest, remove_once)
@@ -0,0 +1,198 @@
+"""
+Output stage for generated images.
+
+Provider bytes are written straight to disk when they are already in the
+requested format. Only when a different format is requested is the image
+transcoded, and that runs in the process pool so encoding never competes with
+request handling. Saved images are moved into the result store under their
+content hash, which is computed while they are written. A save cancelled
+midway (e.g. because the client went away) leaves no partial file behind.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+
+from backend.config.settings import DEFAULT_OUTPUT_FORMAT, ENCODER_OPTIONS
+from backend.utils.artifact_index import artifact_index, KIND_RESULT
+from backend.utils.storage import result_store
+from backend.utils.workers import run_in_process, run_to_completion
+from backend.utils.metrics import observe_stage
+from backend.utils.progress import report
+from backend.utils.tracing import span
+
+# Formats clients can ask for, and the file extension used for each
+OUTPUT_FORMATS = {"png": "png", "webp": "webp", "avif": "avif"}
+
+# Formats that may come back from a provider
+FILE_EXTENSIONS = {**OUTPUT_FORMATS, "jpeg": "jpg"}
+
+# Base64 text is decoded in slices of this many characters (a multiple of 4)
+BASE64_CHUNK_CHARS = 4 * 256 * 1024
+
+
+def validate_output_format(output_format):
+    """
+    Check a requested output format.
+
+    Args:
+        output_format (str): The requested format, or None/empty for the default
+
+    Returns:
+        str: The normalized format name, or None to keep the provider's format
+
+    Raises:
+        ValueError: If the format is unknown or not supported by this server
+    """
+    output_format = (output_format or DEFAULT_OUTPUT_FORMAT or "").lower() or None
+    if output_format is None:
+        return None
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}. Choose one of: {', '.join(OUTPUT_FORMATS)}")
+    if output_format == "avif":
+        from PIL import features
+        if not features.check("avif"):
+            raise ValueError("AVIF output is not available on this server")
+    return output_format
+
+
+def sniff_format(data):
+    """
+    Identify an image format from its first bytes.
+
+    Args:
+        data (bytes): At least the first 12 bytes of the image
+
+    Returns:
+        str: "png", "jpeg", "webp" or "avif", or None if unrecognized
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "avif"
+    return None
+
+
+def _discard(path):
+    """Remove a partially written file, if it exists."""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _write_bytes(data, path):
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_base64(image_base64, path):
+    """
+    Decode base64 text slice by slice while writing, without a full decoded copy.
+
+    Returns the SHA-256 of the decoded image, computed in the same pass.
+    """
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        for start in range(0, len(image_base64), BASE64_CHUNK_CHARS):
+            chunk = base64.b64decode(image_base64[start:start + BASE64_CHUNK_CHARS])
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def transcode_file(source_path, target_path, output_format, options):
+    """
+    Re-encode an image file (runs in the process pool).
+
+    Args:
+        source_path (str): The image to read
+        target_path (str): Where to write the re-encoded image
+        output_format (str): Target format name
+        options (dict): Encoder settings passed to Image.save
+    """
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        if output_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(target_path, format=output_format.upper(), **options)
+
+
+async def _store(raw_path, digest, native_format, output_format):
+    """
+    Move a written image into the result store, transcoding it first if it is
+    not already in the requested format.
+    """
+    target_format = output_format or native_format or "png"
+    if target_format != native_format:
+        transcoded_path = result_store.staging_path(FILE_EXTENSIONS[target_format])
+        try:
+            with span("transcode", format=target_format):
+                await run_to_completion(run_in_process(transcode_file, raw_path, transcoded_path, target_format,
+                                                       ENCODER_OPTIONS.get(target_format, {})))
+        except BaseException:
+            _discard(transcoded_path)
+            raise
+        finally:
+            _discard(raw_path)
+        raw_path, digest = transcoded_path, None
+
+    result_path = await result_store.put_file(raw_path, FILE_EXTENSIONS[target_format], digest)
+    artifact_index.record(result_path, KIND_RESULT)
+    report("saved", result_path=result_store.url(result_path))
+    return result_path
+
+
+async def save_image_bytes(data, output_format=None):
+    """
+    Save image bytes returned by a provider.
+
+    Args:
+        data (bytes): The encoded image
+        output_format (str, optional): Requested format; None keeps the provider's
+
+    Returns:
+        str: Path of the saved image in the result store
+    """
+    report("received")
+    with observe_stage("save_output"):
+        native_format = sniff_format(data[:16])
+        raw_path = result_store.staging_path(FILE_EXTENSIONS.get(native_format, "bin"))
+        try:
+            with span("disk_write"):
+                digest = await run_to_completion(asyncio.to_thread(_write_bytes, data, raw_path))
+        except BaseException:
+            _discard(raw_path)
+            raise
+        return await _store(raw_path, digest, native_format, output_format)
+
+
+async def save_base64_image(image_base64, output_format=None):
+    """
+    Save a base64-encoded image returned by a provider.
+
+    The text is decoded in slices straight to disk, so the decoded image is
+    never held in memory in full.
+
+    Args:
+        image_base64 (str): The base64-encoded image
+        output_format (str, optional): Requested format; None keeps the provider's
+
+    Returns:
+        str: Path of the saved image in the result store
+    """
+    report("received")
+    with observe_stage("save_output"):
+        native_format = sniff_format(base64.b64decode(image_base64[:24]))
+        raw_path = result_store.staging_path(FILE_EXTENSIONS.get(native_format, "bin"))
+        try:
+            with span("decode_write"):
+                digest = await run_to_completion(asyncio.to_thread(_write_base64, image_base64, raw_path))
+        except BaseException:
+            _discard(raw_path)
+            raise
+        return await _store(raw_path, digest, native_format, output_format)
@@ -0,0 +1,147 @@
+"""
+Pre-processing of input images before they are sent to a provider.
+
+The models work at roughly 1024 px, so larger uploads are downsampled to a
+per-provider size and re-encoded compactly. This cuts upload bandwidth and
+provider latency. Prepared variants are cached on disk by content hash, and
+each is prepared by one worker process at a time.
+"""
+import asyncio
+import logging
+import os
+import uuid
+
+from backend.config.settings import (
+    MAX_INPUT_PIXELS,
+    PREPARED_DIR,
+    PREPARED_INPUT_FORMAT,
+    PREPARED_INPUT_OPTIONS,
+)
+from backend.utils.artifact_index import artifact_index, KIND_PREPARED
+from backend.utils.concurrency import SingleFlight
+from backend.utils.shared_state import shared_state
+from backend.utils.storage import hash_file, shard_path
+from backend.utils.workers import run_in_process, run_to_completion
+
+logger = logging.getLogger(__name__)
+
+_preparing = SingleFlight()
+
+
+def read_image_size(image_path):
+    """
+    Read an image's dimensions from its header without decoding the pixels.
+
+    Args:
+        image_path (str): Path to the image
+
+    Returns:
+        tuple: (width, height)
+
+    Raises:
+        ValueError: If the file is not a readable image
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(image_path) as image:
+            return image.size
+    except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Invalid image file: {str(e)}")
+
+
+async def validate_input_image(image_path):
+    """
+    Reject input images that cannot be read or have too many pixels.
+
+    Args:
+        image_path (str): Path to the uploaded image
+
+    Returns:
+        tuple: (width, height)
+
+    Raises:
+        ValueError: If the image is invalid or larger than MAX_INPUT_PIXELS
+    """
+    width, height = await asyncio.to_thread(read_image_size, image_path)
+    if width * height > MAX_INPUT_PIXELS:
+        raise ValueError(f"Image is too large: {width}x{height} pixels exceeds the limit of {MAX_INPUT_PIXELS} pixels")
+    return width, height
+
+
+def resize_image(source_path, target_path, max_side, output_format, options):
+    """
+    Downsample an image so its longest side is max_side (runs in the process pool).
+
+    Args:
+        source_path (str): The image to read
+        target_path (str): Where to write the downsampled image
+        max_side (int): Longest side of the output, in pixels
+        output_format (str): Format of the output file
+        options (dict): Encoder settings passed to Image.save
+    """
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        # Let JPEG decode at a reduced scale when it can
+        image.draft("RGB", (max_side, max_side))
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        image.save(target_path, format=output_format.upper(), **options)
+
+
+async def prepare_input_image(image_path, max_side, image_hash=None):
+    """
+    Return a version of the input image no larger than max_side.
+
+    Images that already fit are returned unchanged. Larger images are
+    downsampled in the process pool; the result is cached by content hash, so
+    the same upload is only prepared once per target size.
+
+    Args:
+        image_path (str): Path to the input image
+        max_side (int): Longest side accepted by the provider, or None for no limit
+        image_hash (str, optional): SHA-256 of the image, computed if not given
+
+    Returns:
+        str: Path of the image to send to the provider
+    """
+    if not max_side:
+        return image_path
+
+    width, height = await validate_input_image(image_path)
+    if max(width, height) <= max_side:
+        return image_path
+
+    if image_hash is None:
+        image_hash = await asyncio.to_thread(hash_file, image_path)
+
+    prepared_path = shard_path(PREPARED_DIR, f"{image_hash}_{max_side}.{PREPARED_INPUT_FORMAT}")
+    if os.path.exists(prepared_path):
+        artifact_index.touch(prepared_path)
+        return prepared_path
+
+    async def prepare():
+        temp_path = f"{prepared_path}.{uuid.uuid4().hex[:8]}.tmp"
+        os.makedirs(os.path.dirname(prepared_path), exist_ok=True)
+        try:
+            # A cancelled request waits for the pool process, so the file is not removed mid-write
+            await run_to_completion(run_in_process(resize_image, image_path, temp_path, max_side,
+                                                   PREPARED_INPUT_FORMAT, PREPARED_INPUT_OPTIONS))
+            os.replace(temp_path, prepared_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        artifact_index.record(prepared_path, KIND_PREPARED, parent=image_path)
+        logger.info("Input image %dx%d downsampled to %dpx: %s", width, height, max_side, prepared_path)
+        return prepared_path
+
+    async def reuse():
+        return prepared_path if os.path.exists(prepared_path) else None
+
+    async def prepare_once():
+        path, _ = await shared_state.run_once(f"prepare:{prepared_path}", prepare, reuse)
+        return path
+
+    return await _preparing.do(prepared_path, prepare_once)
@@ -0,0 +1,77 @@
+"""
+Observed latency of provider calls.
+
+Each provider keeps a rolling window of its most recent successful call
+durations, which routing decisions (such as the hedge delay of model="auto")
+are based on.
+"""
+import math
+from collections import deque
+
+from backend.config.settings import LATENCY_WINDOW
+
+
+class LatencyTracker:
+    """Rolling window of call durations for one provider."""
+
+    def __init__(self, name, window=LATENCY_WINDOW):
+        self.name = name
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds):
+        """Add the duration of a successful call."""
+        self._samples.append(seconds)
+
+    @property
+    def count(self):
+        return len(self._samples)
+
+    def percentile(self, percentile):
+        """
+        Return the given percentile of the recorded durations.
+
+        Args:
+            percentile (float): Between 0 and 100
+
+        Returns:
+            float: Seconds, or None if nothing has been recorded yet
+        """
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        rank = max(math.ceil(percentile / 100 * len(ordered)) - 1, 0)
+        return ordered[min(rank, len(ordered) - 1)]
+
+    def stats(self):
+        """Return the sample count and the usual percentiles."""
+        return {
+            "samples": self.count,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+_trackers = {}
+
+
+def get_latency_tracker(name):
+    """
+    Return the latency tracker for a provider, creating it on first use.
+
+    Args:
+        name (str): The provider name
+
+    Returns:
+        LatencyTracker: The provider's tracker
+    """
+    tracker = _trackers.get(name)
+    if tracker is None:
+        tracker = LatencyTracker(name)
+        _trackers[name] = tracker
+    return tracker
+
+
+def latency_stats():
+    """Return the latency statistics of every provider seen so far."""
+    return {name: tracker.stats() for name, tracker in _trackers.items()}
@@ -0,0 +1,172 @@
+"""
+Background removal on the CPU for images that do not need PhotoRoom.
+
+Most images sent for background removal are renders on a near-uniform
+background, and some already have an alpha channel. Those are cut out locally
+with NumPy, in the image process pool:
+
+- An image whose border is already transparent is a cut-out; it is stored as is.
+- Otherwise the background color is estimated from the border. Pixels close
+  to it that are connected to the border (a flood fill) become transparent,
+  with alpha ramping up over a tolerance band and a feathered edge.
+
+Each cut-out gets a confidence score. Busy or graded backgrounds, soft
+shadows and subjects that blend into the background score low, and the
+caller sends those to PhotoRoom instead.
+"""
+import numpy as np
+
+METHOD_EXISTING_ALPHA = "existing_alpha"
+METHOD_FLAT_BACKGROUND = "flat_background"
+
+# Width of the border sampled for the background color, as a share of the shorter side
+BORDER_FRACTION = 0.02
+# Share of the border that must be transparent for an image to count as a cut-out already
+TRANSPARENT_BORDER_FRACTION = 0.5
+# Share of the image the subject must cover; outside this range nothing or
+# everything would be removed
+MIN_SUBJECT_FRACTION = 0.005
+MAX_SUBJECT_FRACTION = 0.98
+
+
+def _border(array, width):
+    """Return the pixels within width of the image edge, one per row."""
+    channels = array.shape[2] if array.ndim == 3 else 1
+    parts = [array[:width], array[-width:], array[width:-width, :width], array[width:-width, -width:]]
+    return np.concatenate([part.reshape(-1, channels) for part in parts])
+
+
+def _spread_along_rows(reached, candidates):
+    """Extend reached pixels to the whole run of candidate pixels they are in, row by row."""
+    starts = candidates.copy()
+    starts[:, 1:] &= ~candidates[:, :-1]
+    # Runs never span rows, since a candidate in the first column always starts one
+    runs = np.cumsum(starts.ravel()).reshape(candidates.shape)
+    runs[~candidates] = 0
+    hit = np.zeros(runs.max() + 1, dtype=bool)
+    hit[runs[reached]] = True
+    hit[0] = False
+    return hit[runs]
+
+
+def flood_fill_from_border(candidates):
+    """
+    Return the candidate pixels connected to the image border (4-connected).
+
+    Whole runs of candidates are filled at once, alternating between rows and
+    columns, so the number of passes depends on how often the region turns,
+    not on its size.
+    """
+    reached = np.zeros_like(candidates)
+    for edge in (np.s_[0, :], np.s_[-1, :], np.s_[:, 0], np.s_[:, -1]):
+        reached[edge] = candidates[edge]
+    columns = np.ascontiguousarray(candidates.T)
+    count = 0
+    while True:
+        reached = _spread_along_rows(reached, candidates)
+        reached = _spread_along_rows(np.ascontiguousarray(reached.T), columns).T
+        previous, count = count, int(np.count_nonzero(reached))
+        if count == previous:
+            return reached
+
+
+def _box_blur(values):
+    """Average each value with its 8 neighbours (edges are repeated)."""
+    padded = np.pad(values, 1, mode="edge")
+    height, width = values.shape
+    total = np.zeros_like(values)
+    for dy in range(3):
+        for dx in range(3):
+            total += padded[dy:dy + height, dx:dx + width]
+    return total / 9
+
+
+def _boundary(mask):
+    """Return the pixels of the mask that touch a pixel outside it."""
+    inside = mask.copy()
+    inside[1:] &= mask[:-1]
+    inside[:-1] &= mask[1:]
+    inside[:, 1:] &= mask[:, :-1]
+    inside[:, :-1] &= mask[:, 1:]
+    return mask & ~inside
+
+
+def flat_background_alpha(rgb, tolerance):
+    """
+    Compute the alpha mask of an image on a flat background.
+
+    Args:
+        rgb (ndarray): Image pixels, height x width x 3
+        tolerance (float): RGB distance from the background color below which
+            pixels are fully transparent; opaque from twice this distance
+
+    Returns:
+        tuple: (alpha as floats in 0-1, confidence in 0-1)
+    """
+    height, width = rgb.shape[:2]
+    border_width = max(1, round(min(height, width) * BORDER_FRACTION))
+    if min(height, width) <= 2 * border_width:
+        return None, 0.0
+    pixels = rgb.astype(np.float32)
+    border = _border(pixels, border_width)
+    background = np.median(border, axis=0)
+
+    # How uniform the border is around the estimated background color
+    border_match = float(np.mean(np.linalg.norm(border - background, axis=1) < tolerance))
+
+    difference = pixels - background
+    distance = np.sqrt(np.einsum("ijk,ijk->ij", difference, difference))
+    removed = flood_fill_from_border(distance < 2 * tolerance)
+    ramp = np.clip((distance - tolerance) / tolerance, 0, 1)
+    alpha = np.where(removed, ramp, 1.0).astype(np.float32)
+
+    subject_fraction = float(np.mean(alpha > 0.5))
+    if not MIN_SUBJECT_FRACTION <= subject_fraction <= MAX_SUBJECT_FRACTION:
+        return alpha, 0.0
+
+    # A crisp edge has about one or two partially transparent pixels per
+    # boundary pixel; shadows and gradients have many more
+    partial = int(np.count_nonzero(removed & (ramp > 0)))
+    edge = int(np.count_nonzero(_boundary(alpha > 0.5)))
+    sharpness = min(1.0, 2 * edge / partial) if partial else 1.0
+
+    return _box_blur(alpha), border_match * sharpness
+
+
+def cut_out_locally(input_path, output_path, tolerance, min_confidence, options):
+    """
+    Remove the background of an image without PhotoRoom (runs in the process pool).
+
+    The cut-out is written to output_path as a PNG only when its confidence
+    reaches min_confidence.
+
+    Args:
+        input_path (str): The image
+        output_path (str): Where to write the cut-out
+        tolerance (float): See flat_background_alpha
+        min_confidence (float): Lowest confidence that is written
+        options (dict): PNG encoder settings passed to Image.save
+
+    Returns:
+        tuple: (method, confidence)
+    """
+    from PIL import Image
+
+    with Image.open(input_path) as image:
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            rgba = image.convert("RGBA")
+            alpha = np.asarray(rgba)[:, :, 3]
+            border_width = max(1, round(min(alpha.shape) * BORDER_FRACTION))
+            transparent_border = float(np.mean(_border(alpha, border_width) < 255))
+            subject_fraction = float(np.mean(alpha >= 128))
+            if (transparent_border >= TRANSPARENT_BORDER_FRACTION
+                    and MIN_SUBJECT_FRACTION <= subject_fraction <= MAX_SUBJECT_FRACTION):
+                rgba.save(output_path, format="PNG", **options)
+                return METHOD_EXISTING_ALPHA, 1.0
+        rgb = np.asarray(image.convert("RGB"))
+
+    alpha, confidence = flat_background_alpha(rgb, tolerance)
+    if confidence >= min_confidence:
+        rgba = np.dstack([rgb, np.round(alpha * 255).astype(np.uint8)])
+        Image.fromarray(rgba, "RGBA").save(output_path, format="PNG", **options)
+    return METHOD_FLAT_BACKGROUND, round(confidence, 3)
@@ -0,0 +1,83 @@
+"""
+Structured, non-blocking logging.
+
+Log records are put on an in-memory queue by the code that logs them and
+written to stdout by a background thread, so a slow terminal or log collector
+never stalls the event loop. Records are written as JSON lines (LOG_FORMAT=json)
+or as plain text, and fields passed with extra={...} are kept as JSON keys.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+from backend.config.settings import LOG_LEVEL, LOG_FORMAT
+
+# Attributes every LogRecord has; anything else was passed with extra={...}
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formats a record as a line of text followed by its extra fields."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        extras = [f"{key}={value}" for key, value in vars(record).items()
+                  if key not in _STANDARD_ATTRIBUTES and not key.startswith("_")]
+        return f"{line} {' '.join(extras)}" if extras else line
+
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """
+    Route the "backend" loggers through a queue to a background writer thread.
+
+    Safe to call more than once; later calls are ignored.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger("backend")
+    logger.setLevel(level)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Write out queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,184 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Latencies are recorded in histograms; current levels such as queue depths,
+in-flight calls and cache hit ratios are read from their owners when /metrics
+is scraped, so recording them costs nothing on the request path.
+"""
+import bisect
+import time
+from contextlib import contextmanager
+
+from backend.utils.tracing import span
+
+# Default latency buckets in seconds, from fast disk work to slow provider calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    body = ",".join(f'{name}="{str(value)}"'.replace("\n", " ") for name, value in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name + "_total", _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Distribution of observed values (usually seconds), optionally split by labels."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [bucket counts..., sum, count]
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the enclosed block, whether or not it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield self.name + "_bucket", _format_labels(self.labelnames, key, [("le", _format_value(bound))]), cumulative
+            yield self.name + "_bucket", _format_labels(self.labelnames, key, [("le", "+Inf")]), series[-1]
+            yield self.name + "_sum", _format_labels(self.labelnames, key), series[-2]
+            yield self.name + "_count", _format_labels(self.labelnames, key), series[-1]
+
+
+class Gauge:
+    """
+    A current level read from a callback at scrape time.
+
+    The callback returns a number, or a dict mapping label value tuples to
+    numbers.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        _registry.append(self)
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            if value is not None:
+                yield self.name, _format_labels(self.labelnames, key), value
+
+
+def render():
+    """Return every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        try:
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        except Exception as e:
+            lines.append(f"# error collecting {metric.name}: {str(e)}")
+    return "\n".join(lines) + "\n"
+
+
+# Latency of each stage of request handling. Stages: upload_save, queue_wait,
+# preprocess, provider_call, save_output, background_removal
+STAGE_SECONDS = Histogram(
+    "imagegen_stage_seconds",
+    "Time spent in each stage of request handling",
+    ["stage", "provider"],
+)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "imagegen_http_request_seconds",
+    "Time to answer HTTP requests to the API",
+    ["method", "route", "status"],
+)
+
+# From accepting a generation job to the first image the client can show: a
+# streamed partial preview, or the result itself
+TIME_TO_FIRST_PIXEL_SECONDS = Histogram(
+    "imagegen_time_to_first_pixel_seconds",
+    "Time from accepting a generation job to its first partial preview or result",
+    ["provider", "source"],
+)
+
+PROVIDER_CALLS = Counter(
+    "imagegen_provider_calls",
+    "Provider call attempts by outcome (success, error)",
+    ["provider", "outcome"],
+)
+
+
+@contextmanager
+def observe_stage(stage, provider=""):
+    """
+    Time a stage of request handling, in the stage histogram and as a span
+    of the current request trace.
+
+    Usage:
+        with observe_stage("provider_call", "gemini"):
+            ...
+    """
+    attributes = {"provider": provider} if provider else {}
+    with span(stage, **attributes), STAGE_SECONDS.time(stage=stage, provider=provider):
+        yield
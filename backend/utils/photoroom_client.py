@@ -0,0 +1,124 @@
+"""
+Client for the PhotoRoom background removal API.
+"""
+import asyncio
+import contextlib
+import logging
+import mimetypes
+import os
+import uuid
+from pathlib import Path
+
+import httpx
+
+from backend.config.settings import (
+    PHOTOROOM_API_KEY,
+    PHOTOROOM_API_URL,
+    PHOTOROOM_TIMEOUT_SECONDS,
+    PHOTOROOM_MAX_CONNECTIONS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks streamed from the response to disk
+RESPONSE_CHUNK_SIZE = 256 * 1024
+
+
+class PhotoRoomError(Exception):
+    """Raised when the PhotoRoom API returns an error response."""
+
+    def __init__(self, message, status_code=None, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class PhotoRoomClient:
+    """
+    Reusable PhotoRoom client backed by a keep-alive connection pool.
+
+    The input file is read and the response is streamed to disk in worker
+    threads, so file I/O never blocks the event loop and cut-outs are never
+    held in memory in full.
+    """
+
+    def __init__(self, api_key=PHOTOROOM_API_KEY, base_url=PHOTOROOM_API_URL,
+                 timeout=PHOTOROOM_TIMEOUT_SECONDS, max_connections=PHOTOROOM_MAX_CONNECTIONS):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._client = None
+
+    def _get_client(self):
+        """Create the underlying HTTP client on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    async def segment(self, input_path, output_path):
+        """
+        Remove the background of an image and save the result as PNG.
+
+        Args:
+            input_path (str): Path to the source image
+            output_path (str): Where to write the cut-out
+
+        Returns:
+            str: The output path
+
+        Raises:
+            ValueError: If no API key is configured
+            PhotoRoomError: If the API returns an error response
+        """
+        if not self.api_key:
+            logger.error("PhotoRoom API key not found in environment variables")
+            raise ValueError("PhotoRoom API key not configured")
+
+        content_type, _ = mimetypes.guess_type(input_path)
+        if content_type is None:
+            content_type = 'application/octet-stream'
+
+        # Write to a temporary file first so a partial cut-out is never reused
+        temp_path = f"{output_path}.{uuid.uuid4().hex[:8]}.tmp"
+        image_data = await asyncio.to_thread(Path(input_path).read_bytes)
+        files = {"image_file": (os.path.basename(input_path), image_data, content_type)}
+        try:
+            logger.debug("Calling PhotoRoom API for background removal")
+            async with self._get_client().stream(
+                'POST', '/v1/segment', files=files, headers={'x-api-key': self.api_key}
+            ) as response:
+                if response.status_code != 200:
+                    error_body = await response.aread()
+                    error_msg = f"PhotoRoom API error: {response.status_code} - {response.reason_phrase}"
+                    logger.error("%s", error_msg, extra={"response": error_body[:500].decode("utf-8", "replace")})
+                    raise PhotoRoomError(error_msg, response.status_code, response.headers)
+
+                out_f = await asyncio.to_thread(open, temp_path, 'wb')
+                try:
+                    async for chunk in response.aiter_bytes(RESPONSE_CHUNK_SIZE):
+                        await asyncio.to_thread(out_f.write, chunk)
+                finally:
+                    await asyncio.to_thread(out_f.close)
+
+            await asyncio.to_thread(os.replace, temp_path, output_path)
+            return output_path
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                await asyncio.to_thread(os.remove, temp_path)
+
+    async def aclose(self):
+        """Close the connection pool."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+photoroom_client = PhotoRoomClient()
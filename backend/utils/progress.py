@@ -0,0 +1,101 @@
+"""
+Progress reporting from deep inside a generation.
+
+A job worker sets a reporter for the job it runs; services, the output
+pipeline and the resilience layer call report() without knowing who, if
+anyone, is listening. Like the request trace, the reporter lives in a context
+variable, so it follows the job into the tasks it creates.
+
+Stages reported: "sent" (a provider call started), "partial" (a provider
+streamed a partial image), "received" (the provider answered) and "saved"
+(the result was written).
+"""
+import contextvars
+import logging
+
+from backend.config.settings import PREVIEW_WIDTH, PREVIEW_FORMAT, ENCODER_OPTIONS
+from backend.utils.workers import run_in_process
+
+logger = logging.getLogger(__name__)
+
+_reporter = contextvars.ContextVar("progress_reporter", default=None)
+
+
+def use_reporter(reporter):
+    """
+    Send progress of the current task (and tasks it creates) to reporter.
+
+    Args:
+        reporter: Callable taking the stage name and a dict of details
+
+    Returns:
+        Token to pass to reset_reporter
+    """
+    return _reporter.set(reporter)
+
+
+def reset_reporter(token):
+    _reporter.reset(token)
+
+
+def active():
+    """Return True if progress of the current task is being listened to."""
+    return _reporter.get() is not None
+
+
+def report(stage, **details):
+    """Report that the current task reached a stage."""
+    reporter = _reporter.get()
+    if reporter is not None:
+        reporter(stage, details)
+
+
+def make_preview(data, width, output_format, options):
+    """
+    Return a small re-encoded copy of an image (runs in the process pool).
+
+    Args:
+        data (bytes): The encoded image
+        width (int): Width of the preview; smaller images keep their size
+        output_format (str): Format of the preview
+        options (dict): Encoder settings passed to Image.save
+
+    Returns:
+        bytes: The encoded preview
+    """
+    import io
+
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("RGB", (width, width))
+        if image.mode not in ("RGB", "RGBA") or (output_format == "jpeg" and image.mode == "RGBA"):
+            image = image.convert("RGB" if output_format == "jpeg" else "RGBA")
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.BILINEAR)
+        output = io.BytesIO()
+        image.save(output, format=output_format.upper(), **options)
+    return output.getvalue()
+
+
+async def report_partial(data, index, provider):
+    """
+    Report a partial image streamed by a provider, as a low-resolution preview.
+
+    The preview is only made when someone is listening. A preview that
+    cannot be made is skipped; the generation goes on.
+
+    Args:
+        data (bytes): The encoded partial image
+        index (int): Its position in the provider's stream (0 first)
+        provider (str): The provider that sent it
+    """
+    if not active():
+        return
+    try:
+        preview = await run_in_process(make_preview, data, PREVIEW_WIDTH, PREVIEW_FORMAT,
+                                       ENCODER_OPTIONS.get(PREVIEW_FORMAT, {}))
+    except Exception as e:
+        logger.warning("Failed to make a preview of a partial image: %s", e, extra={"provider": provider})
+        return
+    report("partial", index=index, provider=provider, image=preview, format=PREVIEW_FORMAT)
@@ -1,8 +1,14 @@
-from openai import OpenAI
+import base64
 
-client = OpenAI()
+_client = None
 
-import base64
+def _get_client():
+    """Create the OpenAI client on first use instead of at import time."""
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        _client = OpenAI()
+    return _client
 
 def get_prompting_details(image_path):
     try:
@@ -11,7 +17,7 @@ def get_prompting_details(image_path):
 
         image_data_uri = f"data:image/png;base64,{image_base64}"
 
-        response = client.chat.completions.create(
+        response = _get_client().chat.completions.create(
             model="gpt-4.1",   
             messages=[
                 {
@@ -0,0 +1,391 @@
+"""
+Resilience layer for provider calls.
+
+Every call to an external provider goes through a ResiliencePolicy, which
+combines a client-side token-bucket rate limit, retries with exponential
+backoff and jitter for transient errors (429, 5xx, connection failures), and a
+circuit breaker that fails fast while the provider is down. Policies exist per
+provider and API key. Waits and calls stop at the request's deadline
+(backend/utils/deadlines.py). With several worker processes, the token
+buckets are kept in the shared store (backend/utils/shared_state.py), so the
+rate limits hold for the workers together; breakers are per process.
+"""
+import asyncio
+import email.utils
+import hashlib
+import logging
+import random
+import time
+
+import httpx
+
+from backend.config.settings import (
+    PROVIDER_RATE_LIMITS,
+    PROVIDER_MAX_RETRIES,
+    RETRY_BASE_DELAY_SECONDS,
+    RETRY_MAX_DELAY_SECONDS,
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_SECONDS,
+)
+from backend.utils.deadlines import (
+    DeadlineExceededError,
+    bounded,
+    remaining,
+    cancel_reason,
+    record_wasted,
+    REASON_DEADLINE,
+    OUTCOME_AVOIDED,
+    OUTCOME_ABORTED,
+)
+from backend.utils.metrics import Gauge, PROVIDER_CALLS
+from backend.utils.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker states
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+# HTTP statuses worth retrying
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class ProviderUnavailableError(Exception):
+    """Raised when a provider is down, rate limited or keeps failing."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def error_status(exc):
+    """Return the HTTP status carried by a provider SDK exception, or None."""
+    for attribute in ("status_code", "code"):
+        status = getattr(exc, attribute, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def retry_after_seconds(exc):
+    """
+    Return the delay requested by a Retry-After header on an error, or None.
+
+    Both the delta-seconds and the HTTP-date forms are understood.
+    """
+    headers = getattr(exc, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+    value = headers.get("retry-after") if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(exc):
+    """
+    Return True if a failed call may succeed when retried.
+
+    SDKs wrap connection errors in their own types, so the cause chain is
+    checked for transport errors as well.
+    """
+    status = error_status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    while exc is not None:
+        if isinstance(exc, (httpx.TransportError, asyncio.TimeoutError, ConnectionError)):
+            return True
+        exc = exc.__cause__
+    return False
+
+
+class TokenBucket:
+    """Spaces out calls to a sustained rate while allowing short bursts."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait until a call is allowed by the rate limit."""
+        if self.rate <= 0:
+            return
+        # Callers take tokens one at a time, in arrival order
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class SharedTokenBucket(TokenBucket):
+    """A token bucket in the shared store, drawn from by every worker process."""
+
+    def __init__(self, name, rate, burst):
+        super().__init__(rate, burst)
+        self.name = name
+
+    async def acquire(self):
+        """Wait until a call is allowed by the rate limit."""
+        if self.rate <= 0:
+            return
+        # The token is reserved right away, so callers wait their turn without a lock
+        self.tokens = await shared_state.take(f"bucket:{self.name}", self.rate, self.burst)
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a provider after repeated failures.
+
+    After failure_threshold consecutive failures the breaker opens and calls
+    fail immediately. Once reset_seconds have passed it lets a single trial
+    call through (half open): success closes the breaker, failure opens it
+    again.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return BREAKER_CLOSED
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return BREAKER_OPEN
+        return BREAKER_HALF_OPEN
+
+    def retry_after(self):
+        """Seconds until the breaker lets a trial call through, 0 if it does now."""
+        if self.opened_at is None:
+            return 0.0
+        return max(self.reset_seconds - (time.monotonic() - self.opened_at), 0.0)
+
+    def ensure_available(self):
+        """
+        Raise if the breaker is open, without claiming the half-open trial call.
+
+        Raises:
+            ProviderUnavailableError: If the provider is considered down
+        """
+        if self.state == BREAKER_OPEN:
+            raise ProviderUnavailableError(
+                f"{self.name} is temporarily unavailable, please retry later",
+                retry_after=self.retry_after(),
+            )
+
+    def before_call(self):
+        """
+        Admit a call, or raise if the breaker does not allow one now.
+
+        Returns:
+            bool: Whether the call is the half-open trial; pass it to the
+                record_* method that ends the call
+
+        Raises:
+            ProviderUnavailableError: If the breaker is open, or half open with
+                its trial call already running
+        """
+        self.ensure_available()
+        if self.state != BREAKER_HALF_OPEN:
+            return False
+        if self._trial_in_flight:
+            raise ProviderUnavailableError(
+                f"{self.name} is recovering, please retry shortly",
+                retry_after=1.0,
+            )
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self, trial=False):
+        self.failures = 0
+        self.opened_at = None
+        if trial:
+            self._trial_in_flight = False
+
+    def record_failure(self, trial=False):
+        self.failures += 1
+        if trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or trial:
+                self.times_opened += 1
+                logger.error("Circuit breaker for %s opened after %d failure(s)", self.name, self.failures)
+            self.opened_at = time.monotonic()
+        if trial:
+            self._trial_in_flight = False
+
+    def record_ignored(self, trial=False):
+        """End a call whose outcome says nothing about the provider's health."""
+        if trial:
+            self._trial_in_flight = False
+
+    def stats(self):
+        """Return the breaker's state."""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_after": round(self.retry_after(), 3),
+            "times_opened": self.times_opened,
+        }
+
+
+class ResiliencePolicy:
+    """Rate limit, retry and circuit breaker for one provider and API key."""
+
+    def __init__(self, name, rate, burst, max_retries=PROVIDER_MAX_RETRIES, bucket=None):
+        self.name = name
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(name)
+        self.max_retries = max_retries
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def ensure_available(self):
+        """Raise ProviderUnavailableError if the provider's breaker is open."""
+        self.breaker.ensure_available()
+
+    def backoff(self, attempt):
+        """Return the delay before a retry: exponential backoff with full jitter."""
+        return random.uniform(0, min(RETRY_BASE_DELAY_SECONDS * 2 ** attempt, RETRY_MAX_DELAY_SECONDS))
+
+    async def call(self, func):
+        """
+        Run a provider call under the rate limit, retrying transient errors.
+
+        Args:
+            func: Zero-argument callable returning an awaitable; called again
+                for each attempt
+
+        Returns:
+            The result of the successful attempt
+
+        Raises:
+            ProviderUnavailableError: If the breaker is open or transient
+                errors persist after the retries (or until the deadline)
+            DeadlineExceededError: If the request's deadline expires first
+            Exception: Non-transient errors from the provider, unchanged
+        """
+        for attempt in range(self.max_retries + 1):
+            trial = self.breaker.before_call()
+            try:
+                async with bounded():
+                    await self.bucket.acquire()
+            except (DeadlineExceededError, asyncio.CancelledError) as e:
+                self.breaker.record_ignored(trial)
+                reason = REASON_DEADLINE if isinstance(e, DeadlineExceededError) else cancel_reason(e)
+                record_wasted(self.name, reason, OUTCOME_AVOIDED)
+                raise
+            self.calls += 1
+            try:
+                async with bounded():
+                    result = await func()
+            except (DeadlineExceededError, asyncio.CancelledError) as e:
+                # The result is no longer wanted; the call says nothing about the provider's health
+                self.breaker.record_ignored(trial)
+                reason = REASON_DEADLINE if isinstance(e, DeadlineExceededError) else cancel_reason(e)
+                record_wasted(self.name, reason, OUTCOME_ABORTED)
+                raise
+            except Exception as e:
+                PROVIDER_CALLS.inc(provider=self.name, outcome="error")
+                if not is_transient(e):
+                    self.breaker.record_ignored(trial)
+                    raise
+                self.failures += 1
+                self.breaker.record_failure(trial)
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                logger.warning("%s call failed (attempt %d): %s", self.name, attempt + 1, e)
+                if (attempt == self.max_retries or self.breaker.state != BREAKER_CLOSED
+                        or delay > RETRY_MAX_DELAY_SECONDS or delay >= remaining()):
+                    raise ProviderUnavailableError(
+                        f"{self.name} is unavailable: {str(e)}",
+                        retry_after=max(delay, self.breaker.retry_after()),
+                    ) from e
+                self.retries += 1
+                await asyncio.sleep(delay)
+            else:
+                PROVIDER_CALLS.inc(provider=self.name, outcome="success")
+                self.breaker.record_success(trial)
+                return result
+
+    def stats(self):
+        """Return the policy's counters, rate limit and breaker state."""
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rate_per_second": self.bucket.rate,
+            "burst": self.bucket.burst,
+            "tokens": round(self.bucket.tokens, 3),
+            "breaker": self.breaker.stats(),
+        }
+
+
+_policies = {}
+
+
+def _key_id(api_key):
+    """Identify an API key in stats without revealing it."""
+    if not api_key:
+        return "default"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+def get_policy(name, api_key=None):
+    """
+    Return the resilience policy for a provider and API key, creating it on first use.
+
+    Args:
+        name (str): The provider name, e.g. "gemini", "openai" or "photoroom"
+        api_key (str, optional): The API key the calls are made with
+
+    Returns:
+        ResiliencePolicy: The policy
+    """
+    key = (name, _key_id(api_key))
+    policy = _policies.get(key)
+    if policy is None:
+        rate, burst = PROVIDER_RATE_LIMITS.get(name, (0, 1))
+        bucket = SharedTokenBucket(":".join(key), rate, burst) if shared_state.shared else None
+        policy = ResiliencePolicy(name, rate, burst, bucket=bucket)
+        _policies[key] = policy
+    return policy
+
+
+Gauge("imagegen_circuit_breaker_open", "1 while a provider's circuit breaker is open or half open",
+      lambda: {(name, key_id): int(policy.breaker.state != BREAKER_CLOSED)
+               for (name, key_id), policy in _policies.items()},
+      ["provider", "key_id"])
+
+
+def resilience_stats():
+    """Return the state of every policy, by provider and API key id."""
+    stats = {}
+    for (name, key_id), policy in _policies.items():
+        stats.setdefault(name, {})[key_id] = policy.stats()
+    return stats
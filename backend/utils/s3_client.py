@@ -0,0 +1,221 @@
+"""
+Minimal client for S3-compatible object storage.
+
+Only the calls the blob store needs are implemented (put, get, head and
+delete of single objects), signed with AWS Signature Version 4 and sent over a
+pooled httpx client. Objects are addressed path-style
+(<endpoint>/<bucket>/<key>), which AWS, MinIO and other stand-ins accept.
+"""
+import asyncio
+import datetime
+import hashlib
+import hmac
+import logging
+import mimetypes
+import os
+import uuid
+from urllib.parse import quote, urlsplit
+
+import httpx
+
+from backend.config.settings import (
+    S3_BUCKET,
+    S3_ENDPOINT_URL,
+    S3_REGION,
+    S3_ACCESS_KEY_ID,
+    S3_SECRET_ACCESS_KEY,
+    S3_TIMEOUT_SECONDS,
+    S3_MAX_CONNECTIONS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks streamed between files and requests
+TRANSFER_CHUNK_SIZE = 256 * 1024
+
+# Hash of an empty request body
+EMPTY_PAYLOAD_HASH = hashlib.sha256(b"").hexdigest()
+
+
+class S3Error(Exception):
+    """Raised when the object store returns an error response."""
+
+    def __init__(self, message, status_code=None, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+
+
+def sign_request(method, url, headers, payload_hash, region, access_key, secret_key, now=None):
+    """
+    Return the headers of a request signed with AWS Signature Version 4.
+
+    Args:
+        method (str): HTTP method
+        url (str): Full request URL, with the path already percent-encoded
+        headers (dict): Headers to sign in addition to host and x-amz-*
+        payload_hash (str): Hex SHA-256 of the body
+        region (str): Region name, e.g. "us-east-1"
+        access_key (str): Access key id
+        secret_key (str): Secret access key
+        now (datetime, optional): Signing time (UTC); the current time by default
+
+    Returns:
+        dict: The headers to send, including Authorization
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = now.strftime("%Y%m%d")
+    parsed = urlsplit(url)
+
+    signed = {name.lower(): str(value).strip() for name, value in headers.items()}
+    signed.update({"host": parsed.netloc, "x-amz-content-sha256": payload_hash, "x-amz-date": amz_date})
+    names = sorted(signed)
+    canonical_query = "&".join(sorted(parsed.query.split("&"))) if parsed.query else ""
+    canonical_request = "\n".join([
+        method,
+        parsed.path or "/",
+        canonical_query,
+        "".join(f"{name}:{signed[name]}\n" for name in names),
+        ";".join(names),
+        payload_hash,
+    ])
+
+    scope = f"{date}/{region}/s3/aws4_request"
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256",
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+    ])
+    key = _hmac(("AWS4" + secret_key).encode("utf-8"), date)
+    for part in (region, "s3", "aws4_request"):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    signed["authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={';'.join(names)}, Signature={signature}"
+    )
+    del signed["host"]
+    return signed
+
+
+class S3Client:
+    """
+    Reusable S3 client backed by a keep-alive connection pool.
+
+    Uploads are streamed from files and downloads are streamed to disk, so
+    objects are never held in memory in full.
+    """
+
+    def __init__(self, bucket=S3_BUCKET, endpoint_url=S3_ENDPOINT_URL, region=S3_REGION,
+                 access_key=S3_ACCESS_KEY_ID, secret_key=S3_SECRET_ACCESS_KEY,
+                 timeout=S3_TIMEOUT_SECONDS, max_connections=S3_MAX_CONNECTIONS):
+        self.bucket = bucket
+        self.endpoint_url = (endpoint_url or f"https://s3.{region}.amazonaws.com").rstrip("/")
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._client = None
+
+    def _get_client(self):
+        """Create the underlying HTTP client on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    def _request(self, method, key, payload_hash=EMPTY_PAYLOAD_HASH, headers=None):
+        """Return the URL and signed headers of a request for an object."""
+        if not self.bucket:
+            raise ValueError("S3 bucket not configured")
+        url = f"{self.endpoint_url}/{self.bucket}/{quote(key, safe='/-_.~')}"
+        return url, sign_request(method, url, headers or {}, payload_hash, self.region,
+                                 self.access_key or "", self.secret_key or "")
+
+    @staticmethod
+    async def _raise_for_status(response, method, key):
+        if response.status_code >= 300:
+            await response.aread()
+            error_msg = f"S3 {method} {key} failed: {response.status_code} - {response.reason_phrase}"
+            raise S3Error(error_msg, response.status_code, response.headers)
+
+    async def put_file(self, key, path, sha256):
+        """
+        Upload a file as an object.
+
+        Args:
+            key (str): Object key
+            path (str): The file to upload
+            sha256 (str): Hex SHA-256 of the file, which signs the body
+        """
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        headers = {"content-type": content_type, "content-length": str(os.path.getsize(path))}
+        url, signed = self._request("PUT", key, sha256, headers)
+
+        async def body():
+            with open(path, "rb") as f:
+                while chunk := await asyncio.to_thread(f.read, TRANSFER_CHUNK_SIZE):
+                    yield chunk
+
+        response = await self._get_client().put(url, content=body(), headers=signed)
+        await self._raise_for_status(response, "PUT", key)
+
+    async def get_file(self, key, path):
+        """
+        Download an object to a file.
+
+        Returns:
+            str: The path, or None if the object does not exist
+        """
+        url, signed = self._request("GET", key)
+        # Write to a temporary file first so a partial download is never used
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            async with self._get_client().stream("GET", url, headers=signed) as response:
+                if response.status_code == 404:
+                    return None
+                await self._raise_for_status(response, "GET", key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(temp_path, "wb") as out_f:
+                    async for chunk in response.aiter_bytes(TRANSFER_CHUNK_SIZE):
+                        await asyncio.to_thread(out_f.write, chunk)
+            os.replace(temp_path, path)
+            return path
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    async def exists(self, key):
+        """Return True if the object exists."""
+        url, signed = self._request("HEAD", key)
+        response = await self._get_client().head(url, headers=signed)
+        if response.status_code == 404:
+            return False
+        await self._raise_for_status(response, "HEAD", key)
+        return True
+
+    async def delete(self, key):
+        """Delete an object; deleting a missing object is not an error."""
+        url, signed = self._request("DELETE", key)
+        response = await self._get_client().delete(url, headers=signed)
+        if response.status_code != 404:
+            await self._raise_for_status(response, "DELETE", key)
+
+    async def aclose(self):
+        """Close the connection pool."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
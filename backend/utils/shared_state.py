@@ -0,0 +1,478 @@
+"""
+State shared by the server's worker processes.
+
+With SERVER_WORKERS above 1, uvicorn runs the app in several processes, each
+with its own memory, and any of them may get a client's next request. What
+they must agree on lives in a shared store instead:
+
+- job records, so any worker can answer for a job and stream its events, and
+  messages to the worker running a job (e.g. to cancel it)
+- the generation cache index, so a result generated by one worker is a hit in the others
+- rate-limit token buckets, so provider rate limits hold for all workers together
+- leases, so only one worker generates a given image, removes its
+  background, prepares an input or a thumbnail, or collects garbage at a time
+- holds, which unlike leases any number of workers may take on the same key,
+  e.g. on files in use by their jobs so the garbage collector keeps them
+
+SHARED_STATE_BACKEND selects the store: "memory" keeps everything in the
+process, "sqlite" uses a SQLite database in WAL mode that every process on the
+host opens. Values are JSON; entries given a TTL disappear once it has passed.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from backend.config.settings import SHARED_STATE_BACKEND, SHARED_STATE_PATH, SHARED_STATE_POLL_SECONDS
+from backend.utils.deadlines import bounded
+
+logger = logging.getLogger(__name__)
+
+# Identifies this worker process, e.g. as the owner of the jobs it runs
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# A lease whose holder stopped renewing it (e.g. the process died) is free after this long
+LEASE_SECONDS = 30.0
+# How long undelivered messages are kept (seconds)
+MESSAGE_TTL_SECONDS = 60.0
+# How often expired entries are deleted (seconds)
+PURGE_INTERVAL_SECONDS = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL);
+CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS holds (
+    key TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (key, owner)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    body TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id);
+"""
+
+# Take a lease that is free, expired or already ours
+_CLAIM = """
+INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+WHERE leases.owner = excluded.owner OR leases.expires < ?
+"""
+
+
+def _expiry(ttl):
+    return time.time() + ttl if ttl is not None else None
+
+
+def _refill(tokens, updated, now, rate, burst):
+    """Return the tokens in a bucket after taking one, refilled up to now."""
+    return min(burst, tokens + (now - updated) * rate) - 1
+
+
+class Lease:
+    """
+    A named lock held by one holder at a time across all worker processes.
+
+    While held, the lease is renewed in the background; if the holder's
+    process dies, the lease expires after LEASE_SECONDS.
+    """
+
+    def __init__(self, store, key, ttl=LEASE_SECONDS):
+        self.store = store
+        self.key = key
+        self.ttl = ttl
+        # Unique per lease, so two tasks in one process do not share it
+        self.owner = f"{WORKER_ID}/{uuid.uuid4().hex[:8]}"
+        self.held = False
+        self._renewal = None
+
+    async def acquire(self):
+        """Take the lease if it is free; returns True if it is now held."""
+        self.held = await self.store.claim(self.key, self.ttl, self.owner)
+        if self.held and self._renewal is None:
+            # The renewal belongs to the lease, not to the request that took it
+            self._renewal = asyncio.create_task(self._renew(), context=contextvars.Context())
+        return self.held
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.store.claim(self.key, self.ttl, self.owner)
+            except Exception as e:
+                logger.error("Failed to renew lease %s: %s", self.key, e)
+
+    async def release(self):
+        """Give the lease up, if held."""
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+        if self.held:
+            self.held = False
+            await self.store.unclaim(self.key, self.owner)
+
+
+class SharedState:
+    """
+    Key-value entries, token buckets, leases, holds and messages shared by the worker processes.
+
+    Subclasses implement the synchronous operations; the async API runs them.
+    """
+
+    # True if other processes see the state
+    shared = False
+
+    async def _call(self, func, *args):
+        return func(*args)
+
+    # Async API
+
+    async def get(self, key):
+        """Return the value stored under a key, or None."""
+        return await self._call(self._get, key)
+
+    async def set(self, key, value, ttl=None):
+        """Store a value under a key, for ttl seconds (None: until deleted)."""
+        await self.set_many({key: value}, ttl)
+
+    async def set_many(self, values, ttl=None):
+        """Store several values at once, e.g. every job that changed."""
+        if values:
+            encoded = [(key, json.dumps(value)) for key, value in values.items()]
+            await self._call(self._set_many, encoded, _expiry(ttl))
+
+    async def delete(self, key):
+        await self._call(self._delete, key)
+
+    async def take(self, name, rate, burst):
+        """
+        Take a token from a bucket refilling at rate per second up to burst.
+
+        The token is taken even when the bucket is empty: the caller waits
+        until the bucket has refilled to 0 before using it.
+
+        Returns:
+            float: Tokens left; negative when the caller has to wait -tokens / rate seconds
+        """
+        return await self._call(self._take, name, rate, burst)
+
+    async def claim(self, key, ttl, owner=WORKER_ID):
+        """
+        Take (or renew) a lease for ttl seconds if it is free or already the owner's.
+
+        Returns:
+            bool: True if the owner holds the lease
+        """
+        return await self._call(self._claim, key, owner, ttl)
+
+    async def unclaim(self, key, owner=WORKER_ID):
+        await self._call(self._unclaim, key, owner)
+
+    def lease(self, key, ttl=LEASE_SECONDS):
+        """Return a Lease on a key; acquire it before use and release it afterwards."""
+        return Lease(self, key, ttl)
+
+    async def hold(self, keys, ttl, owner=WORKER_ID):
+        """Take (or renew) the owner's hold on each key for ttl seconds; other owners may hold them too."""
+        if keys:
+            await self._call(self._hold, list(keys), owner, time.time() + ttl)
+
+    async def unhold(self, key, owner=WORKER_ID):
+        await self._call(self._unhold, key, owner)
+
+    async def held(self, prefix):
+        """Return the keys starting with prefix that any owner holds."""
+        return await self._call(self._held, prefix)
+
+    async def run_once(self, key, work, existing):
+        """
+        Do some work in one worker process at a time, unless another worker already did it.
+
+        While another worker holds the key's lease, this one waits (until the
+        current deadline at most). Once the lease is free, existing() tells
+        whether the other worker's result can be used; if not (e.g. its work
+        failed), this worker does the work itself. Callers still collapse
+        concurrent calls within their process with a SingleFlight.
+
+        Args:
+            key (str): Identifies the work, e.g. "cutout:<sha256>"
+            work: Zero-argument callable returning an awaitable that does the work
+            existing: Zero-argument callable returning an awaitable of the
+                result another worker produced, or None
+
+        Returns:
+            tuple: (result, True if this worker did the work)
+        """
+        if not self.shared:
+            return await work(), True
+        lease = self.lease(key)
+        try:
+            async with bounded():
+                waited = False
+                while not await lease.acquire():
+                    waited = True
+                    await asyncio.sleep(SHARED_STATE_POLL_SECONDS)
+                # The lease may have been released because the result is ready
+                result = await existing() if waited else None
+            if result is not None:
+                return result, False
+            return await work(), True
+        finally:
+            await lease.release()
+
+    async def send(self, recipient, message):
+        """Send a message (a JSON-serializable dict) to a worker process by its WORKER_ID."""
+        await self._call(self._send, recipient, json.dumps(message), _expiry(MESSAGE_TTL_SECONDS))
+
+    async def receive(self, recipient=WORKER_ID):
+        """Return and remove the messages sent to a worker process, oldest first."""
+        return [json.loads(body) for body in await self._call(self._receive, recipient)]
+
+    async def purge(self):
+        """Delete expired entries, leases, holds and messages."""
+        await self._call(self._purge, time.time())
+
+    async def start(self):
+        """Open the store and start deleting expired entries in the background."""
+
+    async def shutdown(self):
+        """Stop the background task and close the store."""
+
+
+class MemoryState(SharedState):
+    """Shared state of a single worker process, in plain dicts."""
+
+    def __init__(self):
+        self._values = {}
+        self._buckets = {}
+        self._leases = {}
+        self._holds = defaultdict(dict)
+        self._messages = defaultdict(list)
+
+    def _get(self, key):
+        value, expires = self._values.get(key, (None, None))
+        if expires is not None and expires < time.time():
+            del self._values[key]
+            return None
+        return json.loads(value) if value is not None else None
+
+    def _set_many(self, encoded, expires):
+        for key, value in encoded:
+            self._values[key] = (value, expires)
+
+    def _delete(self, key):
+        self._values.pop(key, None)
+
+    def _take(self, name, rate, burst):
+        now = time.time()
+        tokens, updated = self._buckets.get(name, (burst, now))
+        tokens = _refill(tokens, updated, now, rate, burst)
+        self._buckets[name] = (tokens, now)
+        return tokens
+
+    def _claim(self, key, owner, ttl):
+        now = time.time()
+        holder, expires = self._leases.get(key, (owner, now))
+        if holder != owner and expires >= now:
+            return False
+        self._leases[key] = (owner, now + ttl)
+        return True
+
+    def _unclaim(self, key, owner):
+        if self._leases.get(key, (None,))[0] == owner:
+            del self._leases[key]
+
+    def _hold(self, keys, owner, expires):
+        for key in keys:
+            self._holds[key][owner] = expires
+
+    def _unhold(self, key, owner):
+        owners = self._holds.get(key, {})
+        owners.pop(owner, None)
+        if not owners:
+            self._holds.pop(key, None)
+
+    def _held(self, prefix):
+        now = time.time()
+        return {key for key, owners in self._holds.items()
+                if key.startswith(prefix) and any(expires >= now for expires in owners.values())}
+
+    def _send(self, recipient, body, expires):
+        self._messages[recipient].append(body)
+
+    def _receive(self, recipient):
+        return self._messages.pop(recipient, [])
+
+    def _purge(self, now):
+        for key in [key for key, (_, expires) in self._values.items() if expires is not None and expires < now]:
+            del self._values[key]
+        for key in [key for key, (_, expires) in self._leases.items() if expires < now]:
+            del self._leases[key]
+        for key, owners in list(self._holds.items()):
+            for owner in [owner for owner, expires in owners.items() if expires < now]:
+                self._unhold(key, owner)
+
+
+class SQLiteState(SharedState):
+    """Shared state in a SQLite database (WAL mode) opened by every worker process."""
+
+    shared = True
+
+    def __init__(self, db_path=SHARED_STATE_PATH):
+        self.db_path = db_path
+        self._db = None
+        # Serializes use of the connection between the threads running operations
+        self._lock = threading.Lock()
+        self._task = None
+
+    async def _call(self, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+    # Database access (runs in a worker thread)
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        # Autocommit; operations that read before they write open their own transaction
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Other processes hold the write lock for a moment at most
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(SCHEMA)
+
+    def _open(self):
+        with self._connection():
+            pass
+
+    @contextmanager
+    def _connection(self):
+        with self._lock:
+            if self._db is None:
+                self._connect()
+            yield self._db
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as db:
+            # Take the write lock up front, so concurrent writers wait instead of failing
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def _get(self, key):
+        with self._connection() as db:
+            row = db.execute("SELECT value FROM state WHERE key = ? AND (expires IS NULL OR expires >= ?)",
+                             (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_many(self, encoded, expires):
+        with self._transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)",
+                           [(key, value, expires) for key, value in encoded])
+
+    def _delete(self, key):
+        with self._connection() as db:
+            db.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def _take(self, name, rate, burst):
+        with self._transaction() as db:
+            now = time.time()
+            row = db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+            tokens = _refill(*(row or (burst, now)), now, rate, burst)
+            db.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                       (name, tokens, now))
+        return tokens
+
+    def _claim(self, key, owner, ttl):
+        with self._connection() as db:
+            now = time.time()
+            return db.execute(_CLAIM, (key, owner, now + ttl, now)).rowcount == 1
+
+    def _unclaim(self, key, owner):
+        with self._connection() as db:
+            db.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+    def _hold(self, keys, owner, expires):
+        with self._transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO holds (key, owner, expires) VALUES (?, ?, ?)",
+                           [(key, owner, expires) for key in keys])
+
+    def _unhold(self, key, owner):
+        with self._connection() as db:
+            db.execute("DELETE FROM holds WHERE key = ? AND owner = ?", (key, owner))
+
+    def _held(self, prefix):
+        with self._connection() as db:
+            rows = db.execute("SELECT DISTINCT key FROM holds WHERE substr(key, 1, ?) = ? AND expires >= ?",
+                              (len(prefix), prefix, time.time())).fetchall()
+        return {key for key, in rows}
+
+    def _send(self, recipient, body, expires):
+        with self._connection() as db:
+            db.execute("INSERT INTO messages (recipient, body, expires) VALUES (?, ?, ?)", (recipient, body, expires))
+
+    def _receive(self, recipient):
+        with self._connection() as db:
+            rows = db.execute("DELETE FROM messages WHERE recipient = ? RETURNING id, body", (recipient,)).fetchall()
+        return [body for _, body in sorted(rows)]
+
+    def _purge(self, now):
+        with self._transaction() as db:
+            db.execute("DELETE FROM state WHERE expires < ?", (now,))
+            db.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            db.execute("DELETE FROM holds WHERE expires < ?", (now,))
+            db.execute("DELETE FROM messages WHERE expires < ?", (now,))
+
+    # Async API
+
+    async def start(self):
+        await self._call(self._open)
+        if self._task is None:
+            # The purge outlives the request that started it
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+            try:
+                await self.purge()
+            except Exception as e:
+                logger.error("Failed to purge the shared state: %s", e)
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def _create_store():
+    if SHARED_STATE_BACKEND == "sqlite":
+        return SQLiteState()
+    if SHARED_STATE_BACKEND != "memory":
+        raise ValueError(f"Unknown SHARED_STATE_BACKEND: {SHARED_STATE_BACKEND}")
+    return MemoryState()
+
+
+shared_state = _create_store()
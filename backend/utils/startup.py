@@ -0,0 +1,33 @@
+"""
+Startup time measurement.
+
+Imported as early as possible by the entry points, so the measured time covers
+framework and application imports as well as the startup hooks.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+STARTED_AT = time.perf_counter()
+
+_startup_seconds = None
+
+
+def mark_ready():
+    """
+    Record that the application finished starting up.
+
+    Returns:
+        float: Seconds from the first import of this module until ready
+    """
+    global _startup_seconds
+    if _startup_seconds is None:
+        _startup_seconds = time.perf_counter() - STARTED_AT
+        logger.info("Application ready in %.3fs", _startup_seconds)
+    return _startup_seconds
+
+
+def startup_seconds():
+    """Return the measured startup time, or None if startup has not finished."""
+    return _startup_seconds
@@ -0,0 +1,249 @@
+"""
+Content-addressed storage for uploads and results.
+
+Files are named by the SHA-256 of their contents and placed in a two-level
+shard layout (<root>/ab/cd/abcd....png), so identical files are stored once
+and no directory grows beyond a few hundred entries. Files derived from
+another one (e.g. a background removal cut-out) are named after the source's
+hash and sharded the same way.
+
+Every write goes through a store: new files are written to a staging path
+inside it and moved into place with put_file. LocalStorage keeps them
+on disk only. S3Storage also writes them to an S3-compatible bucket and treats
+the local directory as a cache, fetching files back on demand.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import uuid
+
+from fastapi.staticfiles import StaticFiles
+from starlette.exceptions import HTTPException
+
+from backend.config.settings import UPLOAD_DIR, RESULT_DIR, STORAGE_BACKEND, S3_PREFIX
+from backend.utils.artifact_index import artifact_index
+from backend.utils.resilience import ProviderUnavailableError, get_policy
+
+logger = logging.getLogger(__name__)
+
+# Hex characters used per shard level, and number of levels
+SHARD_WIDTH = 2
+SHARD_DEPTH = 2
+
+# Partially written files live here until they are moved into place
+STAGING_DIR_NAME = ".staging"
+
+
+def shard_path(root, name):
+    """
+    Return where a file is stored in a sharded directory.
+
+    Args:
+        root (str): The directory
+        name (str): File name; its first characters (a hex digest) pick the shard
+
+    Returns:
+        str: <root>/<ab>/<cd>/<name>
+    """
+    shards = [name[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(SHARD_DEPTH)]
+    return os.path.join(root, *shards, name)
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 of a file's contents.
+
+    Args:
+        file_path (str): Path to the file
+        chunk_size (int): Number of bytes read at a time
+
+    Returns:
+        str: Hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _move_into_place(source_path, target_path):
+    """Move a staged file to its final path, or drop it if an identical file is already there."""
+    if os.path.exists(target_path):
+        os.remove(source_path)
+        return False
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    os.replace(source_path, target_path)
+    return True
+
+
+class LocalStorage:
+    """Content-addressed files in a sharded local directory."""
+
+    def __init__(self, name, root, url_prefix):
+        self.name = name
+        self.root = os.path.realpath(root)
+        self.url_prefix = url_prefix.rstrip("/")
+        self.staging_dir = os.path.join(self.root, STAGING_DIR_NAME)
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def staging_path(self, extension):
+        """Return a fresh path to write a new file to before put_file."""
+        return os.path.join(self.staging_dir, f"{uuid.uuid4().hex}.{extension}")
+
+    def path_for(self, name, extension):
+        """Return the path of a stored file, e.g. path_for(digest, "png")."""
+        return shard_path(self.root, f"{name}.{extension}")
+
+    async def put_file(self, source_path, extension, digest=None, name=None):
+        """
+        Move a staged file into the store.
+
+        Args:
+            source_path (str): The staged file (from staging_path); it is moved
+                or, when an identical file is already stored, deleted
+            extension (str): File extension
+            digest (str, optional): SHA-256 of the file, computed if not given
+            name (str, optional): Name for files derived from another one,
+                starting with the source's digest; the content digest is used
+                by default
+
+        Returns:
+            str: Path of the stored file
+        """
+        if digest is None:
+            digest = await asyncio.to_thread(hash_file, source_path)
+        target_path = self.path_for(name or digest, extension)
+        created = await asyncio.to_thread(_move_into_place, source_path, target_path)
+        if created:
+            await self._replicate(target_path, digest)
+        return target_path
+
+    async def _replicate(self, path, digest):
+        """Copy a newly stored file to a remote backend (none for local storage)."""
+
+    def relative_path(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def url(self, path):
+        """Return the URL path a stored file is served at."""
+        return f"{self.url_prefix}/{self.relative_path(path)}"
+
+    def resolve(self, reference):
+        """
+        Map a path relative to the store to its local path.
+
+        Raises:
+            ValueError: If the reference points outside the store or into
+                its staging directory
+        """
+        path = os.path.realpath(os.path.join(self.root, reference.lstrip("/")))
+        if not self.contains(path):
+            raise ValueError(f"Invalid path: {reference}")
+        return path
+
+    def contains(self, path):
+        """Whether a local path is a stored file, i.e. inside the store but not staged."""
+        path = os.path.abspath(path)
+        if os.path.commonpath([self.root, path]) != self.root or path == self.root:
+            return False
+        return os.path.commonpath([self.staging_dir, path]) != self.staging_dir
+
+    async def fetch(self, path):
+        """
+        Make sure a stored file is available locally.
+
+        Returns:
+            str: The path, or None if the file does not exist
+        """
+        return path if os.path.isfile(path) else None
+
+    async def aclose(self):
+        pass
+
+
+class S3Storage(LocalStorage):
+    """
+    Content-addressed files in an S3-compatible bucket, cached in a local directory.
+
+    New files are uploaded when they are stored; files missing locally (e.g.
+    evicted by the artifact garbage collector, or written by another server)
+    are downloaded on first access.
+    """
+
+    def __init__(self, name, root, url_prefix, key_prefix=S3_PREFIX, client=None):
+        super().__init__(name, root, url_prefix)
+        from backend.utils.s3_client import S3Client
+
+        self.key_prefix = key_prefix
+        self.client = client or S3Client()
+        self.policy = get_policy("s3", self.client.access_key)
+
+    def key_for(self, path):
+        return f"{self.key_prefix}{self.name}/{self.relative_path(path)}"
+
+    async def _replicate(self, path, digest):
+        if os.path.basename(path).split(".")[0] != digest:
+            # Derived files are named after their source, not their contents
+            digest = await asyncio.to_thread(hash_file, path)
+        try:
+            await self.policy.call(lambda: self.client.put_file(self.key_for(path), path, digest))
+        except Exception as e:
+            # The local copy still serves the file; it is only missing from the bucket
+            logger.error("Failed to upload %s to S3: %s", path, e)
+
+    async def fetch(self, path):
+        if os.path.isfile(path):
+            return path
+        if not self.contains(path):
+            return None
+        fetched = await self.policy.call(lambda: self.client.get_file(self.key_for(path), path))
+        if fetched:
+            artifact_index.record_existing(fetched)
+        return fetched
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def create_storage(name, root, url_prefix):
+    """Create the store for uploads or results with the configured backend."""
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(name, root, url_prefix)
+    if STORAGE_BACKEND != "local":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return LocalStorage(name, root, url_prefix)
+
+
+upload_store = create_storage("uploads", UPLOAD_DIR, "/uploads")
+result_store = create_storage("results", RESULT_DIR, "/results")
+
+
+class StorageFiles(StaticFiles):
+    """
+    Serves the files of a store.
+
+    With a remote backend, files that are not cached locally are fetched
+    before they are served.
+    """
+
+    def __init__(self, store, **kwargs):
+        super().__init__(directory=store.root, **kwargs)
+        self.store = store
+
+    async def fetch(self, path):
+        """Fetch a requested file from the store's backend if it is not cached locally."""
+        try:
+            await self.store.fetch(self.store.resolve(path))
+        except ValueError:
+            # Outside the store or a partially written staged file
+            raise HTTPException(status_code=404)
+        except ProviderUnavailableError as e:
+            headers = {"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after else None
+            raise HTTPException(status_code=503, detail=str(e), headers=headers)
+
+    async def get_response(self, path, scope):
+        await self.fetch(path)
+        return await super().get_response(path, scope)
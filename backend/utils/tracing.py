@@ -0,0 +1,236 @@
+"""
+Per-request timing breakdown.
+
+Each API request (and each generation job) gets a RequestTrace. Code that runs
+on its behalf records spans with span(); spans opened inside another span
+become its children, so the trace is a tree of where the time went. The trace
+is reported in the Server-Timing header, in the JSON payload on request, and
+kept in a bounded ring buffer when the request was slow.
+"""
+import contextvars
+import cProfile
+import io
+import pstats
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from backend.config.settings import (
+    SLOW_REQUEST_THRESHOLD_SECONDS,
+    SLOW_REQUEST_BUFFER_SIZE,
+    SLOW_REQUEST_PROFILE_RATE,
+)
+
+# Number of functions kept from a profiler capture
+PROFILE_TOP_FUNCTIONS = 30
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """A timed section of work, with the spans that ran inside it."""
+
+    def __init__(self, name, started, attributes=None):
+        self.name = name
+        self.started = started
+        self.duration = None
+        self.attributes = attributes or {}
+        self.children = []
+
+    def to_dict(self, origin):
+        entry = {
+            "name": self.name,
+            "start_ms": round((self.started - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+        }
+        if self.attributes:
+            entry.update(self.attributes)
+        if self.children:
+            entry["children"] = [child.to_dict(origin) for child in self.children]
+        return entry
+
+
+class RequestTrace:
+    """The span tree of one request or job."""
+
+    def __init__(self, name, debug=False):
+        self.name = name
+        self.debug = debug
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.duration = None
+        self.spans = []
+        self.profile = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def walk(self):
+        """Yield every span in the tree, parents before children."""
+        pending = list(reversed(self.spans))
+        while pending:
+            span = pending.pop()
+            yield span
+            pending.extend(reversed(span.children))
+
+    def server_timing(self):
+        """
+        Return the value of a Server-Timing header for the trace.
+
+        Top-level spans are listed in the order they started, followed by the
+        total time so far.
+        """
+        entries = []
+        for span in self.spans:
+            if span.duration is None:
+                continue
+            entry = f"{span.name};dur={span.duration * 1000:.1f}"
+            if span.attributes.get("provider"):
+                entry += f';desc="{span.attributes["provider"]}"'
+            entries.append(entry)
+        total = self.duration if self.duration is not None else time.perf_counter() - self.started
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+    def durations(self):
+        """Return the total milliseconds spent in each top-level span, and overall."""
+        totals = {}
+        for span in self.spans:
+            if span.duration is not None:
+                totals[span.name] = round(totals.get(span.name, 0) + span.duration * 1000, 1)
+        if self.duration is not None:
+            totals["total"] = round(self.duration * 1000, 1)
+        return totals
+
+    def to_dict(self):
+        """Return the trace as a JSON-serializable span tree."""
+        entry = {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "spans": [span.to_dict(self.started) for span in self.spans],
+        }
+        if self.profile:
+            entry["profile"] = self.profile
+        return entry
+
+
+def current_trace():
+    """Return the trace of the request or job being handled, or None."""
+    return _current_trace.get()
+
+
+def start_trace(name, debug=False):
+    """
+    Start a trace and make it current for this task and the tasks it creates.
+
+    Returns:
+        tuple: (trace, token); pass the token to end_trace
+    """
+    trace = RequestTrace(name, debug)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    """Finish the current trace and restore the previous one."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.finish()
+    _current_trace.reset(token)
+    return trace
+
+
+def use_trace(trace):
+    """Make an existing trace current (e.g. a job's trace in its worker)."""
+    _current_span.set(None)
+    return _current_trace.set(trace)
+
+
+def _attach(span):
+    parent = _current_span.get()
+    trace = _current_trace.get()
+    if parent is not None:
+        parent.children.append(span)
+    elif trace is not None:
+        trace.spans.append(span)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Record the enclosed block as a span of the current trace.
+
+    Does nothing but run the block when no trace is active.
+    """
+    if _current_trace.get() is None:
+        yield None
+        return
+    current = Span(name, time.perf_counter(), attributes)
+    _attach(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.started
+        _current_span.reset(token)
+
+
+def add_span(name, started, duration, **attributes):
+    """Record a span that was timed by the caller (perf_counter values)."""
+    if _current_trace.get() is None:
+        return
+    current = Span(name, started, attributes)
+    current.duration = duration
+    _attach(current)
+
+
+# Requests slower than SLOW_REQUEST_THRESHOLD_SECONDS, newest last
+_slow_requests = deque(maxlen=SLOW_REQUEST_BUFFER_SIZE)
+
+# cProfile can only run one capture per process at a time
+_profiler_busy = False
+
+
+def record_if_slow(trace):
+    """Keep the trace in the slow-request buffer if it took too long."""
+    if trace.duration is not None and trace.duration >= SLOW_REQUEST_THRESHOLD_SECONDS:
+        _slow_requests.append(trace.to_dict())
+
+
+def slow_requests():
+    """Return the traces in the slow-request buffer, newest first."""
+    return list(reversed(_slow_requests))
+
+
+def clear_slow_requests():
+    _slow_requests.clear()
+
+
+@contextmanager
+def maybe_profile(trace):
+    """
+    Profile a sample of requests (SLOW_REQUEST_PROFILE_RATE) with cProfile.
+
+    The profile is only kept when the request turns out to be slow. The
+    profiler sees everything the event loop runs while it is enabled, so a
+    capture also includes work for concurrent requests.
+    """
+    global _profiler_busy
+    if _profiler_busy or SLOW_REQUEST_PROFILE_RATE <= 0 or random.random() >= SLOW_REQUEST_PROFILE_RATE:
+        yield
+        return
+
+    _profiler_busy = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiler_busy = False
+        if time.perf_counter() - trace.started >= SLOW_REQUEST_THRESHOLD_SECONDS:
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            trace.profile = output.getvalue()
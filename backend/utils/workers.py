@@ -0,0 +1,70 @@
+"""
+Process pool for CPU-heavy image work.
+
+Encoding and resizing large images would otherwise hold the GIL and slow down
+every request handled by the API worker, so that work runs in separate
+processes.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from backend.config.settings import IMAGE_PROCESS_WORKERS
+
+_process_pool = None
+
+
+def get_process_pool():
+    """Return the shared process pool, creating it on first use."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+    return _process_pool
+
+
+async def run_in_process(func, *args):
+    """
+    Run a picklable, module-level function in the process pool.
+
+    Args:
+        func: The function to run
+        *args: Arguments passed to the function
+
+    Returns:
+        The function's return value
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), func, *args)
+
+
+async def run_to_completion(awaitable):
+    """
+    Await work running in a thread or process, letting it finish if the caller is cancelled.
+
+    Cancelling the caller does not stop work that already runs in a thread or
+    process, which could then write files after the caller cleaned up. The
+    cancellation is held back until the work has finished, so the caller's
+    cleanup sees everything it wrote.
+
+    Args:
+        awaitable: E.g. run_in_process(...) or asyncio.to_thread(...)
+
+    Returns:
+        The result of the work
+    """
+    work = asyncio.ensure_future(awaitable)
+    try:
+        return await asyncio.shield(work)
+    except asyncio.CancelledError:
+        await asyncio.wait([work])
+        if not work.cancelled():
+            # Retrieve the outcome so a failure is not reported as unhandled
+            work.exception()
+        raise
+
+
+def shutdown_process_pool():
+    """Stop the worker processes."""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
@@ -0,0 +1,367 @@
+"""
+Load and latency benchmark with stub providers.
+
+Starts the full application in-process with Gemini, OpenAI and PhotoRoom
+replaced by stubs (see benchmarks/stubs.py), drives /api/upload (until the job
+finishes), /api/download and static /results traffic at a fixed concurrency,
+and reports throughput, latency percentiles and event-loop lag. Results are
+written as JSON so runs of different versions can be compared.
+
+Usage:
+    python -m benchmarks.run --scenarios upload,download,static --concurrency 16 --requests 200
+    python -m benchmarks.run --baseline benchmarks/results/previous.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+SCENARIOS = ("upload", "download", "static", "thumbnail")
+
+# Format version of the results file
+RESULTS_VERSION = 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="upload,download,static",
+                        help=f"Comma separated scenarios to run: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients per scenario")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="Run each scenario for this many seconds instead of a request count")
+    parser.add_argument("--model", default="gemini", help="Model used by the upload scenario")
+    parser.add_argument("--gemini-latency", default="lognormal:1.0,0.5",
+                        help="Stub latency spec: fixed:S, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--openai-latency", default="lognormal:1.5,0.6")
+    parser.add_argument("--photoroom-latency", default="lognormal:0.8,0.4")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of stub calls that fail with 503")
+    parser.add_argument("--payload-side", type=int, default=1024, help="Side in pixels of the stub output image")
+    parser.add_argument("--input-side", type=int, default=0,
+                        help="Side in pixels of the input image sent with uploads (0: prompt only)")
+    parser.add_argument("--output-format", default=None, help="output_format sent with uploads")
+    parser.add_argument("--download-pool", type=int, default=20,
+                        help="Distinct results used by the download/static scenarios")
+    parser.add_argument("--repeat-prompts", action="store_true",
+                        help="Reuse one prompt so uploads are served by the result cache")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default=None, help="Results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", default=None, help="Earlier results file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Exit with status 1 if p95 latency grows or throughput drops by more than this share")
+    parser.add_argument("--keep-files", action="store_true",
+                        help="Write uploads and results to the real directories instead of a temporary one")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    """Settings are read at import time, so they are set before the application is imported."""
+    if not args.keep_files:
+        workdir = tempfile.mkdtemp(prefix="imagegen-bench-")
+        os.environ["UPLOAD_DIR"] = os.path.join(workdir, "uploads")
+        os.environ["RESULT_DIR"] = os.path.join(workdir, "results")
+        os.environ["DATA_DIR"] = os.path.join(workdir, "data")
+    # Measure the server, not the client-side provider rate limits
+    for provider in ("GEMINI", "OPENAI", "PHOTOROOM"):
+        os.environ.setdefault(f"{provider}_RATE_PER_SECOND", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("WARM_UP_PROVIDERS", "false")
+
+
+def percentiles(samples):
+    """Return count, mean and p50/p95/p99/max of samples in seconds, as milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def at(percentile):
+        return ordered[min(int(percentile / 100 * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(at(50) * 1000, 3),
+        "p95_ms": round(at(95) * 1000, 3),
+        "p99_ms": round(at(99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+class LoopLagMonitor:
+    """Measures how late the server's event loop wakes up from short sleeps."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(time.perf_counter() - started - self.interval, 0.0))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def reset(self):
+        self.samples = []
+
+
+def install_stubs(args):
+    from benchmarks.stubs import LatencyDistribution, StubService, StubPhotoRoomClient, make_payload
+    from backend.config.settings import OPENAI_PARTIAL_IMAGES
+    from backend.services import service_factory
+    from backend.utils import file_utils
+
+    payload = make_payload(args.payload_side)
+    stubs = {
+        "gemini": StubService("gemini", LatencyDistribution(args.gemini_latency), args.error_rate, payload),
+        "openai": StubService("openai", LatencyDistribution(args.openai_latency), args.error_rate, payload,
+                              base64_payload=True, max_images_per_call=10, partial_images=OPENAI_PARTIAL_IMAGES),
+    }
+    for name, stub in stubs.items():
+        service_factory.register_service(name, stub)
+    photoroom = StubPhotoRoomClient(LatencyDistribution(args.photoroom_latency), args.error_rate)
+    file_utils.photoroom_client = photoroom
+    return stubs, photoroom
+
+
+def start_server(app, port, monitor):
+    import uvicorn
+
+    app.add_event_handler("startup", monitor.start)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("Benchmark server failed to start")
+        time.sleep(0.05)
+    return server, thread
+
+
+def make_input_image(side):
+    from PIL import Image
+
+    output = io.BytesIO()
+    Image.new("RGB", (side, side), (120, 160, 200)).save(output, format="PNG")
+    return output.getvalue()
+
+
+async def run_scenario(name, client, args, request_once):
+    """Run request_once from `concurrency` clients and collect latencies and errors."""
+    latencies = []
+    errors = {}
+    issued = 0
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def next_index():
+        nonlocal issued
+        if deadline is not None:
+            if time.perf_counter() >= deadline:
+                return None
+        elif issued >= args.requests:
+            return None
+        issued += 1
+        return issued - 1
+
+    async def worker():
+        while (index := next_index()) is not None:
+            started = time.perf_counter()
+            try:
+                await request_once(client, index)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                key = str(e)[:120]
+                errors[key] = errors.get(key, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": issued,
+        "succeeded": len(latencies),
+        "failed": issued - len(latencies),
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "latency": percentiles(latencies),
+    }
+
+
+async def run_benchmark(args, monitor):
+    import httpx
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    input_image = make_input_image(args.input_side) if args.input_side else None
+    results = {}
+    result_paths = []
+    first_pixel_seconds = []
+
+    def client_headers(index):
+        # Each concurrent client is its own client for fair queuing, like
+        # separate users would be, rather than one client with a deep queue
+        return {"X-Api-Key": f"benchmark-{index % args.concurrency}"}
+
+    async def upload(client, index, prompt=None):
+        if prompt is None:
+            prompt = "benchmark prompt" if args.repeat_prompts else f"benchmark prompt {index}"
+        data = {"prompt": prompt, "model": args.model}
+        if args.output_format:
+            data["output_format"] = args.output_format
+        files = {"file": ("input.png", input_image, "image/png")} if input_image else None
+        response = await client.post("/api/upload", data=data, files=files, headers=client_headers(index))
+        if response.status_code != 202:
+            raise RuntimeError(f"upload: HTTP {response.status_code}")
+        status_url = response.json()["status_url"]
+        while True:
+            response = await client.get(status_url, params={"wait": 30})
+            if response.status_code != 200:
+                raise RuntimeError(f"job status: HTTP {response.status_code}")
+            job = response.json()
+            if job["status"] == "done":
+                result_paths.append(job["result_path"])
+                first_pixel_seconds.append(job["first_pixel_seconds"])
+                return
+            if job["status"] == "failed":
+                raise RuntimeError(f"job failed: {job['error']}")
+
+    async def download(client, index):
+        path = result_paths[index % len(pool)]
+        response = await client.post("/api/download", json={"path": path}, headers=client_headers(index))
+        if response.status_code != 200:
+            raise RuntimeError(f"download: HTTP {response.status_code}")
+
+    async def static(client, index):
+        response = await client.get(result_paths[index % len(pool)])
+        if response.status_code != 200:
+            raise RuntimeError(f"static: HTTP {response.status_code}")
+
+    async def thumbnail(client, index):
+        response = await client.get(result_paths[index % len(pool)], params={"w": 256, "fmt": "webp"})
+        if response.status_code != 200:
+            raise RuntimeError(f"thumbnail: HTTP {response.status_code}")
+
+    handlers = {"upload": upload, "download": download, "static": static, "thumbnail": thumbnail}
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        pool = []
+        if any(name != "upload" for name in scenarios):
+            # The other scenarios need existing results to work on
+            for index in range(args.download_pool):
+                await upload(client, index, prompt=f"benchmark pool {index}")
+            pool = result_paths[:args.download_pool]
+            result_paths[:] = pool
+
+        for name in scenarios:
+            monitor.reset()
+            first_pixel_seconds.clear()
+            print(f"Running {name}...", file=sys.stderr)
+            results[name] = await run_scenario(name, client, args, handlers[name])
+            results[name]["event_loop_lag"] = percentiles(monitor.samples)
+            if name == "upload":
+                # Server-side: from accepting the job to its first partial preview or result
+                results[name]["time_to_first_pixel"] = percentiles(first_pixel_seconds)
+                if pool:
+                    result_paths[:] = pool
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, max_regression):
+    """Print the change against a baseline and return True if nothing regressed too far."""
+    ok = True
+    print(f"\n{'scenario':<12}{'p95 ms':>12}{'baseline':>12}{'change':>10}{'rps':>10}{'baseline':>10}{'change':>10}")
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous or not previous["latency"].get("count") or not current["latency"].get("count"):
+            continue
+        p95, base_p95 = current["latency"]["p95_ms"], previous["latency"]["p95_ms"]
+        rps, base_rps = current["throughput_rps"], previous["throughput_rps"]
+        p95_change = (p95 - base_p95) / base_p95 if base_p95 else 0.0
+        rps_change = (rps - base_rps) / base_rps if base_rps else 0.0
+        regressed = p95_change > max_regression or rps_change < -max_regression
+        ok = ok and not regressed
+        print(f"{name:<12}{p95:>12.1f}{base_p95:>12.1f}{p95_change:>+10.1%}{rps:>10.1f}{base_rps:>10.1f}"
+              f"{rps_change:>+10.1%}{'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment(args)
+
+    # Imported only now, so the settings above take effect
+    import main as application
+
+    stubs, photoroom = install_stubs(args)
+    monitor = LoopLagMonitor()
+    server, thread = start_server(application.app, args.port, monitor)
+    try:
+        scenarios = asyncio.run(run_benchmark(args, monitor))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+
+    results = {
+        "version": RESULTS_VERSION,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "stub_calls": {**{name: stub.calls for name, stub in stubs.items()}, "photoroom": photoroom.calls},
+        "scenarios": scenarios,
+    }
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results",
+        f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"\n{'scenario':<12}{'ok':>8}{'failed':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'lag p99':>10}")
+    for name, result in scenarios.items():
+        latency, lag = result["latency"], result["event_loop_lag"]
+        print(f"{name:<12}{result['succeeded']:>8}{result['failed']:>8}{result['throughput_rps']:>10.1f}"
+              f"{latency.get('p50_ms', 0):>10.1f}{latency.get('p95_ms', 0):>10.1f}{latency.get('p99_ms', 0):>10.1f}"
+              f"{lag.get('p99_ms', 0):>10.1f}")
+    if "upload" in scenarios:
+        first_pixel = scenarios["upload"]["time_to_first_pixel"]
+        print(f"\ntime to first pixel: p50 {first_pixel.get('p50_ms', 0):.1f} ms, "
+              f"p95 {first_pixel.get('p95_ms', 0):.1f} ms")
+    print(f"\nResults written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Stub providers for benchmarking.
+
+StubService stands in for GeminiService/OpenAIService and StubPhotoRoomClient
+for the PhotoRoom client. Both wait for a latency drawn from a configurable
+distribution, fail at a configurable rate with a retryable error, and return a
+real image of a configurable size, so the server's own work (upload handling,
+pre-processing, decoding, writing, transcoding, background-removal caching) is
+exercised exactly as with the real providers.
+"""
+import asyncio
+import base64
+import io
+import os
+import random
+import shutil
+
+import numpy as np
+from PIL import Image
+
+from backend.services.base_service import BaseImageGenerationService
+from backend.utils import progress
+from backend.utils.image_output import save_base64_image, save_image_bytes
+
+
+class LatencyDistribution:
+    """
+    Random call latency, parsed from a spec string.
+
+    Specs:
+        "fixed:0.5"            always 0.5s
+        "uniform:0.2,1.5"      uniform between 0.2s and 1.5s
+        "lognormal:2.0,0.5"    median 2.0s, sigma 0.5 (a long right tail)
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(value) for value in params.split(",") if value]
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2}
+        if kind not in expected or len(self.params) != expected[kind]:
+            raise ValueError(f"Invalid latency spec: {spec!r}")
+
+    def sample(self):
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return random.uniform(*self.params)
+        median, sigma = self.params
+        return random.lognormvariate(np.log(median), sigma)
+
+
+class StubProviderError(Exception):
+    """A retryable provider failure (HTTP 503)."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.status_code = 503
+        self.headers = {}
+
+
+def make_payload(side, seed=0):
+    """
+    Return PNG bytes of a side x side image.
+
+    The image is noise, so it does not compress and its size is close to that
+    of a detailed generated image of the same dimensions.
+    """
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, size=(side, side, 3), dtype=np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
+
+class StubService(BaseImageGenerationService):
+    """
+    Image generation service with simulated latency, errors and payload.
+
+    Providers that answer with base64 (OpenAI) are simulated by going through
+    save_base64_image, the others through save_image_bytes. Random bytes are
+    appended after the end of the PNG, so every response is a distinct file
+    for the content-addressed result store, as real generations are. With
+    partial_images, single-image calls made for a job report that many
+    partial images spread over the latency, as OpenAI's streaming mode does.
+    """
+
+    def __init__(self, name, latency, error_rate, payload, base64_payload=False, max_images_per_call=1,
+                 partial_images=0):
+        # Set before the base class looks up the provider's bulkhead and policies
+        self.name = name
+        self.max_images_per_call = max_images_per_call
+        super().__init__()
+        self.latency_distribution = latency
+        self.error_rate = error_rate
+        # Padded to a multiple of 3 bytes so base64 suffixes can be appended
+        self.payload = payload + b"\0" * (-len(payload) % 3)
+        self.payload_base64 = base64.b64encode(self.payload).decode("ascii") if base64_payload else None
+        self.partial_images = partial_images
+        self.calls = 0
+
+    async def _respond(self, n):
+        self.calls += 1
+        latency = self.latency_distribution.sample()
+        partial_images = self.partial_images if n == 1 and progress.active() else 0
+        for index in range(partial_images):
+            await asyncio.sleep(latency / (partial_images + 1))
+            await progress.report_partial(self.payload, index, self.name)
+        await asyncio.sleep(latency / (partial_images + 1))
+        if random.random() < self.error_rate:
+            raise StubProviderError(f"{self.name} stub: simulated failure")
+
+    async def _save(self, output_format):
+        suffix = os.urandom(18)
+        if self.payload_base64 is not None:
+            return await save_base64_image(self.payload_base64 + base64.b64encode(suffix).decode("ascii"),
+                                           output_format)
+        return await save_image_bytes(self.payload + suffix, output_format)
+
+    async def _generate_image(self, prompt, image_path=None, output_format=None):
+        await self._respond(1)
+        return await self._save(output_format)
+
+    async def _generate_images(self, prompt, n, image_path=None, output_format=None):
+        await self._respond(n)
+        return [await self._save(output_format) for _ in range(n)]
+
+
+class StubPhotoRoomClient:
+    """Drop-in replacement for PhotoRoomClient that copies the input as the cut-out."""
+
+    def __init__(self, latency, error_rate):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+
+    async def segment(self, input_path, output_path):
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample())
+        if random.random() < self.error_rate:
+            raise StubProviderError("photoroom stub: simulated failure")
+        await asyncio.to_thread(shutil.copyfile, input_path, output_path)
+        return output_path
+
+    async def aclose(self):
+        pass
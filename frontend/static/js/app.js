@@ -30,56 +30,101 @@ const cancelChangesBtn = document.getElementById('cancelChangesBtn');
 // API Endpoint
 const UPLOAD_API_URL = '/api/upload';
 const DOWNLOAD_API_URL = '/api/download';
+const JOBS_API_URL = '/api/jobs';
+
+// Long-poll timeout used while waiting for a generation job (seconds)
+const JOB_POLL_WAIT_SECONDS = 25;
 
 // Image History Management
-const MAX_HISTORY_ITEMS = 20;
-let imageHistory = [];
+// The history is kept on the server per session and loaded a page at a time
+// as the sidebar is scrolled
+const HISTORY_API_URL = '/api/history';
+const HISTORY_PAGE_SIZE = 20;
+// Thumbnails are served as resized derivatives instead of the full-size results
+const THUMBNAIL_QUERY = '?w=256&fmt=webp';
+let historyCursor = null;
+let historyExhausted = false;
+let historyLoading = false;
 
 /**
- * Initialize image history from localStorage
+ * Load the first page of history and load further pages as the sidebar is scrolled
  */
 function initializeHistory() {
-    const stored = localStorage.getItem('imageHistory');
-    if (stored) {
-        try {
-            imageHistory = JSON.parse(stored);
-            if (imageHistory.length > 0) {
-                showSidebar();
-                renderHistoryItems();
-            }
-        } catch (e) {
-            console.error('Failed to load history:', e);
-            imageHistory = [];
+    // History used to be kept in localStorage
+    localStorage.removeItem('imageHistory');
+
+    const sidebarContent = document.getElementById('sidebarContent');
+    const sentinel = document.createElement('div');
+    sentinel.id = 'historySentinel';
+    sidebarContent.appendChild(sentinel);
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadHistoryPage();
         }
-    }
+    }, { root: sidebarContent, rootMargin: '200px' });
+    observer.observe(sentinel);
+
+    loadHistoryPage();
 }
 
 /**
- * Add image to history
+ * Fetch the next page of history and append it to the sidebar
  */
-function addToHistory(imagePath) {
-    const historyItem = {
-        id: Date.now(),
-        path: imagePath,
-        timestamp: new Date().toISOString(),
-        thumbnail: imagePath // In production, might want separate thumbnail
-    };
+async function loadHistoryPage() {
+    if (historyLoading || historyExhausted) return;
+    historyLoading = true;
 
-    imageHistory.unshift(historyItem);
+    try {
+        const historyGrid = document.getElementById('historyGrid');
+        // Background removals are not shown, so a page may render nothing;
+        // keep fetching until something renders or there are no more pages
+        let rendered = 0;
+        while (rendered === 0 && !historyExhausted) {
+            const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE });
+            if (historyCursor) {
+                params.set('cursor', historyCursor);
+            }
+            const response = await fetch(`${HISTORY_API_URL}?${params}`);
+            if (!response.ok) {
+                throw new Error('Failed to load history');
+            }
 
-    // Limit history size
-    if (imageHistory.length > MAX_HISTORY_ITEMS) {
-        imageHistory = imageHistory.slice(0, MAX_HISTORY_ITEMS);
+            const page = await response.json();
+            historyCursor = page.next_cursor;
+            historyExhausted = !page.next_cursor;
+
+            const generations = page.items.filter(item => item.kind === 'generation');
+            generations.forEach(item => historyGrid.appendChild(createHistoryElement(item)));
+            rendered = generations.length;
+        }
+
+        if (historyGrid.children.length > 0) {
+            showSidebar();
+            markCurrentHistoryItem();
+        }
+    } catch (e) {
+        console.error('Failed to load history:', e);
+    } finally {
+        historyLoading = false;
     }
+}
 
-    localStorage.setItem('imageHistory', JSON.stringify(imageHistory));
+/**
+ * Add a new image to the top of the history (the server has already recorded it)
+ */
+function addToHistory(imagePath) {
+    const historyGrid = document.getElementById('historyGrid');
+    if (!historyGrid) return;
+
+    historyGrid.prepend(createHistoryElement({ result_path: imagePath }));
 
     // Show sidebar on first image
-    if (imageHistory.length === 1) {
+    if (historyGrid.children.length === 1) {
         showSidebar();
     }
 
-    renderHistoryItems();
+    markCurrentHistoryItem();
 }
 
 /**
@@ -89,7 +134,7 @@ function showSidebar() {
     const sidebar = document.getElementById('imageHistorySidebar');
     const mainWrapper = document.getElementById('mainContentWrapper');
 
-    if (sidebar && mainWrapper) {
+    if (sidebar && mainWrapper && sidebar.classList.contains('hidden')) {
         sidebar.style.display = 'flex';
         setTimeout(() => {
             sidebar.classList.remove('hidden');
@@ -115,31 +160,28 @@ function hideSidebar() {
 }
 
 /**
- * Render history items in sidebar
+ * Create the sidebar element of a history entry
  */
-function renderHistoryItems() {
-    const historyGrid = document.getElementById('historyGrid');
-    if (!historyGrid) return;
-
-    historyGrid.innerHTML = '';
-
-    imageHistory.forEach(item => {
-        const historyElement = document.createElement('div');
-        historyElement.className = 'history-item';
-        historyElement.dataset.imageId = item.id;
-
-        const img = document.createElement('img');
-        img.src = item.path;
-        img.alt = 'Generated image';
-        img.loading = 'lazy';
-
-        historyElement.appendChild(img);
-        historyElement.addEventListener('click', () => loadHistoryImage(item));
-
-        historyGrid.appendChild(historyElement);
-    });
+function createHistoryElement(item) {
+    const historyElement = document.createElement('div');
+    historyElement.className = 'history-item';
+    historyElement.dataset.path = new URL(item.result_path, window.location.href).href;
+
+    const img = document.createElement('img');
+    img.src = item.result_path + THUMBNAIL_QUERY;
+    img.alt = item.prompt || 'Generated image';
+    img.title = item.prompt || '';
+    img.loading = 'lazy';
+
+    historyElement.appendChild(img);
+    historyElement.addEventListener('click', () => loadHistoryImage(item));
+    return historyElement;
+}
 
-    // Mark current image as active
+/**
+ * Mark the image currently shown as active in the sidebar
+ */
+function markCurrentHistoryItem() {
     const currentPath = document.getElementById('resultImage')?.src;
     if (currentPath) {
         markActiveHistoryItem(currentPath);
@@ -152,14 +194,14 @@ function renderHistoryItems() {
 function loadHistoryImage(item) {
     const resultImage = document.getElementById('resultImage');
     if (resultImage) {
-        resultImage.src = item.path;
+        resultImage.src = item.result_path;
 
         // Show result container
         setGenerationState(false);
         document.getElementById('resultContainer').hidden = false;
 
         // Mark as active
-        markActiveHistoryItem(item.path);
+        markActiveHistoryItem(item.result_path);
     }
 }
 
@@ -171,9 +213,9 @@ function markActiveHistoryItem(imagePath) {
         item.classList.remove('active');
     });
 
+    const activePath = new URL(imagePath, window.location.href).href;
     const activeItem = Array.from(document.querySelectorAll('.history-item')).find(item => {
-        const img = item.querySelector('img');
-        return img && img.src === imagePath;
+        return item.dataset.path === activePath;
     });
 
     if (activeItem) {
@@ -184,12 +226,20 @@ function markActiveHistoryItem(imagePath) {
 /**
  * Clear all history
  */
-function clearHistory() {
+async function clearHistory() {
     if (confirm('Clear all image history?')) {
-        imageHistory = [];
-        localStorage.removeItem('imageHistory');
-        document.getElementById('historyGrid').innerHTML = '';
-        hideSidebar();
+        try {
+            const response = await fetch(HISTORY_API_URL, { method: 'DELETE' });
+            if (!response.ok) {
+                throw new Error('Failed to clear history');
+            }
+            historyCursor = null;
+            historyExhausted = true;
+            document.getElementById('historyGrid').innerHTML = '';
+            hideSidebar();
+        } catch (error) {
+            showError(error.message);
+        }
     }
 }
 /**
@@ -375,10 +425,11 @@ async function generateImage() {
         }
         
         const data = await response.json();
+        const job = await waitForJob(data.job_id);
         
         // Display result
-        resultImage.src = data.result_path;
-        addToHistory(data.result_path); // Add to history
+        resultImage.src = job.result_path;
+        addToHistory(job.result_path); // Add to history
         resultContainer.hidden = false;
         
         // Scroll to result
@@ -393,6 +444,92 @@ async function generateImage() {
     }
 }
 
+/**
+ * Wait for a generation job to finish, following its event stream so progress
+ * and partial previews can be shown; falls back to long-polling
+ */
+function waitForJob(jobId) {
+    if (!window.EventSource) {
+        return pollJob(jobId);
+    }
+
+    return new Promise((resolve, reject) => {
+        const events = new EventSource(`${JOBS_API_URL}/${jobId}/events`);
+        let finished = false;
+
+        events.addEventListener('progress', (e) => showProgress(JSON.parse(e.data)));
+        events.addEventListener('partial', (e) => showPartialPreview(JSON.parse(e.data)));
+        events.addEventListener('status', (e) => {
+            const job = JSON.parse(e.data);
+            if (job.status === 'done' || job.status === 'failed') {
+                finished = true;
+                events.close();
+                if (job.status === 'done') {
+                    resolve(job);
+                } else {
+                    reject(new Error(job.error || 'Failed to generate image'));
+                }
+            }
+        });
+        events.onerror = () => {
+            if (!finished) {
+                // The stream was cut (e.g. by a proxy); keep waiting by polling
+                events.close();
+                pollJob(jobId).then(resolve, reject);
+            }
+        };
+    });
+}
+
+/**
+ * Wait for a generation job to finish by long-polling its status
+ */
+async function pollJob(jobId) {
+    while (true) {
+        const response = await fetch(`${JOBS_API_URL}/${jobId}?wait=${JOB_POLL_WAIT_SECONDS}`);
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.detail || 'Failed to get generation status');
+        }
+
+        const job = await response.json();
+        if (job.status === 'done') {
+            return job;
+        }
+        if (job.status === 'failed') {
+            throw new Error(job.error || 'Failed to generate image');
+        }
+        showProgress({ stage: job.stage });
+    }
+}
+
+/**
+ * Describe the stage a generation job has reached below the spinner
+ */
+function showProgress(event) {
+    const progressText = document.getElementById('progressText');
+    const messages = {
+        queued: 'Waiting for a free slot...',
+        sent: 'Creating your image...',
+        received: 'Almost done, saving your image...',
+        saved: 'Almost done, saving your image...',
+    };
+    if (progressText && messages[event.stage]) {
+        progressText.textContent = messages[event.stage];
+    }
+}
+
+/**
+ * Show a low-resolution preview of the image while it is being generated
+ */
+function showPartialPreview(event) {
+    const partialPreview = document.getElementById('partialPreview');
+    if (partialPreview && event.image) {
+        partialPreview.src = event.image;
+        partialPreview.hidden = false;
+    }
+}
+
 /**
  * Download generated image
  */
@@ -469,6 +606,15 @@ async function downloadImage() {
  * Show/hide loading state
  */
 function setLoading(isLoading) {
+    const partialPreview = document.getElementById('partialPreview');
+    if (partialPreview) {
+        partialPreview.hidden = true;
+        partialPreview.src = '';
+    }
+    const progressText = document.getElementById('progressText');
+    if (progressText && isLoading) {
+        progressText.textContent = 'Please wait while we create your image...';
+    }
     if (loadingContainer) {
         loadingContainer.hidden = !isLoading;
         if (isLoading) {
@@ -587,15 +733,11 @@ async function applyChangesToImage() {
     setLoading(true);
     
     try {
-        // Convert current result image to blob and send with modification request
-        const response = await fetch(resultImage.src);
-        const blob = await response.blob();
-        
-        // Prepare form data with the modification request
+        // Reference the current result on the server instead of re-uploading it
         const formData = new FormData();
         formData.append('prompt', followUpText);
         formData.append('model', modelSelect.value);
-        formData.append('file', blob, 'current-image.png');
+        formData.append('source_result', new URL(resultImage.src).pathname);
         
         // Send API request
         const apiResponse = await fetch(UPLOAD_API_URL, {
@@ -610,10 +752,11 @@ async function applyChangesToImage() {
         }
         
         const data = await apiResponse.json();
+        const job = await waitForJob(data.job_id);
         
         // Display new result
-        resultImage.src = data.result_path;
-        addToHistory(data.result_path); // Add to history
+        resultImage.src = job.result_path;
+        addToHistory(job.result_path); // Add to history
         resultContainer.hidden = false;
         
         // Scroll to result
@@ -1,6 +1,8 @@
 """
 Main entry point for the Image Generation Web App.
 """
+# Imported first so the measured startup time includes all other imports
+from backend.utils import startup
 import uvicorn
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
@@ -9,21 +11,33 @@ from fastapi.responses import HTMLResponse
 from fastapi.requests import Request
 import os
 
-from backend.app import app as api_app
+from backend.config.settings import (
+    SERVER_HOST,
+    SERVER_PORT,
+    SERVER_WORKERS,
+    SERVER_RELOAD,
+    SHUTDOWN_DRAIN_SECONDS,
+)
+from backend.utils.derivatives import ResultFiles
+from backend.utils.storage import StorageFiles, upload_store, result_store
+from backend.app import app as api_app, startup_event as api_startup_event, shutdown_event as api_shutdown_event
 
 # Create main FastAPI app
 app = FastAPI(title="Image Generation Web App")
 
 # Mount the API app
 app.mount("/api", api_app)
+# Mounted apps do not get lifespan events, so forward them to the API app
+app.add_event_handler("startup", api_startup_event)
+app.add_event_handler("shutdown", api_shutdown_event)
 
 # Set up templates
 templates = Jinja2Templates(directory="frontend/templates")
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="frontend/static"), name="static")
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-app.mount("/results", StaticFiles(directory="results"), name="results")
+app.mount("/uploads", StorageFiles(upload_store), name="uploads")
+app.mount("/results", ResultFiles(result_store), name="results")
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
@@ -31,4 +45,8 @@ async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # Each worker is a separate process; state they share is in SHARED_STATE_BACKEND.
+    # On SIGTERM, open requests and streams get SHUTDOWN_DRAIN_SECONDS to finish
+    # before the shutdown handlers drain the jobs
+    uvicorn.run("main:app", host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, reload=SERVER_RELOAD,
+                timeout_graceful_shutdown=SHUTDOWN_DRAIN_SECONDS)
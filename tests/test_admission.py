@@ -0,0 +1,118 @@
+"""
+Admission of model auto's provider calls through the providers' own queues.
+"""
+import asyncio
+
+import pytest
+
+from backend.services import service_factory
+from backend.services.base_service import BaseImageGenerationService
+from backend.services.hedged_service import HedgedService
+from backend.utils import admission
+from backend.utils.admission import AdmissionQueue, current_client, get_admission, use_client, reset_client
+from backend.utils.resilience import ProviderUnavailableError
+
+
+class FakeGemini(BaseImageGenerationService):
+    """Stands in for Gemini and records the queue state each call runs under."""
+
+    name = "gemini"
+
+    def __init__(self):
+        super().__init__()
+        self.seen = []
+        self.release = asyncio.Event()
+
+    async def _generate_image(self, prompt, image_path=None, output_format=None):
+        queue = get_admission(self.name)
+        self.seen.append((current_client(), queue.running))
+        await asyncio.wait_for(self.release.wait(), 5)
+        return f"{prompt}.png"
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    monkeypatch.setattr(admission, "_queues", {"gemini": AdmissionQueue("gemini", slots=1, queue_size=2)})
+    service = FakeGemini()
+    monkeypatch.setitem(service_factory.SERVICES, "gemini", service)
+    return service
+
+
+async def generate_for(client, hedged, prompt):
+    token = use_client(client)
+    try:
+        return await hedged.generate_image(prompt)
+    finally:
+        reset_client(token)
+
+
+async def until_called(service, call):
+    """Wait until the provider got the call, failing if it never does."""
+    for _ in range(1000):
+        if service.seen:
+            return
+        assert not call.done(), call.result()
+        await asyncio.sleep(0.001)
+    raise AssertionError("The provider was not called")
+
+
+def test_auto_calls_take_a_slot_in_the_provider_queue(gemini):
+    hedged = HedgedService(providers=["gemini"])
+
+    async def scenario():
+        gemini.release = asyncio.Event()
+        auto_call = asyncio.create_task(generate_for("client-a", hedged, "cat"))
+        await until_called(gemini, auto_call)
+        gemini.release.set()
+        return await auto_call
+
+    assert asyncio.run(scenario()) == "cat.png"
+    assert gemini.seen == [("client-a", 1)]
+    assert get_admission("gemini").running == 0
+
+
+def test_auto_calls_queue_fairly_behind_other_clients(gemini):
+    hedged = HedgedService(providers=["gemini"])
+    queue = get_admission("gemini")
+    queue.queue_size = 3
+
+    async def scenario():
+        gemini.release = asyncio.Event()
+        running = queue.enter("hog")
+        next_hog, last_hog = queue.enter("hog"), queue.enter("hog")
+        auto_call = asyncio.create_task(generate_for("fair", hedged, "cat"))
+        await asyncio.sleep(0.01)
+        assert queue.queued == 3
+
+        # Round robin: after one request of the first client, the second client is served
+        running.release()
+        assert next_hog.granted
+        next_hog.release()
+        await until_called(gemini, auto_call)
+        assert not last_hog.granted
+        gemini.release.set()
+        result = await auto_call
+        last_hog.release()
+        return result
+
+    assert asyncio.run(scenario()) == "cat.png"
+    assert gemini.seen == [("fair", 1)]
+
+
+def test_auto_fails_when_the_provider_queue_is_full(gemini):
+    hedged = HedgedService(providers=["gemini"])
+    queue = get_admission("gemini")
+
+    async def scenario():
+        tickets = [queue.enter("other"), queue.enter("other"), queue.enter("another")]
+        try:
+            return await generate_for("client-a", hedged, "cat")
+        finally:
+            for ticket in tickets:
+                ticket.release()
+
+    with pytest.raises(ProviderUnavailableError) as excinfo:
+        asyncio.run(scenario())
+
+    assert excinfo.value.retry_after >= 1
+    assert gemini.seen == []
@@ -0,0 +1,91 @@
+"""
+Artifact garbage collection with pins taken by several worker processes.
+"""
+import asyncio
+import os
+import time
+
+import pytest
+
+from backend.utils import artifact_index as artifact_index_module
+from backend.utils.artifact_index import ArtifactIndex, KIND_UPLOAD, PIN_KEY_PREFIX
+from backend.utils.shared_state import SQLiteState
+
+
+@pytest.fixture
+def shared(tmp_path, monkeypatch):
+    """A shared store on SQLite, as used with several worker processes."""
+    state = SQLiteState(str(tmp_path / "shared.sqlite3"))
+    monkeypatch.setattr(artifact_index_module, "shared_state", state)
+    # The index must not pick up the real upload and result directories
+    monkeypatch.setattr(artifact_index_module, "scan_directories", lambda: [])
+    yield state
+    asyncio.run(state.shutdown())
+
+
+def make_index(tmp_path):
+    return ArtifactIndex(db_path=str(tmp_path / "artifacts.sqlite3"), max_bytes=10 ** 9,
+                         ttls={KIND_UPLOAD: 0.001}, gc_interval=0)
+
+
+def make_files(tmp_path, *names):
+    paths = []
+    for name in names:
+        path = tmp_path / "uploads" / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"image")
+        paths.append(os.path.realpath(path))
+    return paths
+
+
+def test_files_pinned_by_another_worker_are_not_collected(tmp_path, shared):
+    index = make_index(tmp_path)
+    in_use, unused = make_files(tmp_path, "in_use.png", "unused.png")
+
+    async def scenario():
+        index.record(in_use, KIND_UPLOAD)
+        index.record(unused, KIND_UPLOAD)
+        await shared.hold([PIN_KEY_PREFIX + in_use], 30, owner="other-worker")
+        time.sleep(0.01)
+        first = await index.collect()
+        kept = os.path.exists(in_use)
+
+        await shared.unhold(PIN_KEY_PREFIX + in_use, owner="other-worker")
+        await index.collect()
+        await index.shutdown()
+        return first, kept
+
+    first, kept = asyncio.run(scenario())
+
+    assert kept
+    assert not os.path.exists(unused)
+    assert first["deleted"] == {"ttl": 1}
+    assert not os.path.exists(in_use)
+
+
+def test_pins_are_held_in_the_shared_state_while_in_use(tmp_path, shared):
+    index = make_index(tmp_path)
+    path, = make_files(tmp_path, "input.png")
+
+    async def scenario():
+        async with index.pinned(path):
+            async with index.pinned(path):
+                pass
+            during = await shared.held(PIN_KEY_PREFIX)
+        after = await shared.held(PIN_KEY_PREFIX)
+        return during, after
+
+    during, after = asyncio.run(scenario())
+
+    assert during == {PIN_KEY_PREFIX + path}
+    assert after == set()
+    assert index.stats()["pinned"] == 0
+
+
+def test_expired_holds_no_longer_protect_files(tmp_path, shared):
+    async def scenario():
+        await shared.hold([PIN_KEY_PREFIX + "/a.png", "other:/b.png"], 30, owner="live")
+        await shared.hold([PIN_KEY_PREFIX + "/c.png"], -1, owner="dead")
+        return await shared.held(PIN_KEY_PREFIX)
+
+    assert asyncio.run(scenario()) == {PIN_KEY_PREFIX + "/a.png"}
@@ -0,0 +1,72 @@
+"""
+BaseImageGenerationService.generate_images with and without a native multi-image parameter.
+"""
+import asyncio
+import itertools
+
+import pytest
+
+from backend.services.base_service import BaseImageGenerationService
+
+_names = itertools.count()
+
+
+class FakeService(BaseImageGenerationService):
+    """Provider that answers instantly and records the calls it gets."""
+
+    def __init__(self, max_images_per_call=1, fail_on_call=None):
+        # Each instance gets its own latency tracker, bulkhead and policy
+        self.name = f"fake-{next(_names)}"
+        self.max_images_per_call = max_images_per_call
+        super().__init__()
+        self.fail_on_call = fail_on_call
+        self.calls = []
+        self.cancelled = 0
+
+    async def _generate_image(self, prompt, image_path=None, output_format=None):
+        self.calls.append(1)
+        call = len(self.calls)
+        if call == self.fail_on_call:
+            raise ValueError("Rejected prompt")
+        try:
+            await asyncio.sleep(0.01 if self.fail_on_call is None else 10)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return f"{prompt}-{call}.png"
+
+
+class NativeMultiImageService(FakeService):
+    async def _generate_images(self, prompt, n, image_path=None, output_format=None):
+        self.calls.append(n)
+        return [f"{prompt}-{len(self.calls)}-{i}.png" for i in range(n)]
+
+
+def test_single_image_providers_make_one_call_per_image():
+    service = FakeService()
+
+    paths = asyncio.run(service.generate_images("cat", 3))
+
+    assert len(paths) == 3 and len(set(paths)) == 3
+    assert service.calls == [1, 1, 1]
+    assert service.latency.count == 3
+
+
+def test_requests_are_split_into_calls_of_at_most_max_images_per_call():
+    service = NativeMultiImageService(max_images_per_call=2)
+
+    paths = asyncio.run(service.generate_images("cat", 5))
+
+    assert len(paths) == 5
+    assert sorted(service.calls) == [1, 2, 2]
+    assert service.latency.count == 3
+
+
+def test_a_failed_image_cancels_the_others():
+    service = FakeService(fail_on_call=2)
+
+    with pytest.raises(ValueError):
+        asyncio.run(service.generate_images("cat", 3))
+
+    assert service.cancelled == 2
+    assert service.latency.count == 0
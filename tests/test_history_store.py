@@ -0,0 +1,58 @@
+"""
+Paging through a session's history, and rejection of invalid cursors.
+"""
+import asyncio
+
+import pytest
+
+from backend.services.history_store import HistoryStore, KIND_GENERATION
+from backend.utils.storage import result_store
+
+SESSION_ID = "test-session-0123456789"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = HistoryStore(db_path=str(tmp_path / "history.sqlite3"))
+    yield store
+    asyncio.run(store.shutdown())
+
+
+def test_pages_follow_the_cursor_to_the_last_page(store):
+    for i in range(3):
+        store.record(SESSION_ID, KIND_GENERATION, result_store.path_for(f"{i:064d}", "png"), prompt=f"prompt {i}")
+
+    async def scenario():
+        first = await store.page(SESSION_ID, limit=2)
+        second = await store.page(SESSION_ID, limit=2, cursor=first["next_cursor"])
+        return first, second
+
+    first, second = asyncio.run(scenario())
+
+    assert [item["prompt"] for item in first["items"]] == ["prompt 2", "prompt 1"]
+    assert [item["prompt"] for item in second["items"]] == ["prompt 0"]
+    assert second["next_cursor"] is None
+
+
+def test_largest_cursor_is_accepted(store):
+    page = asyncio.run(store.page(SESSION_ID, cursor=str(2 ** 63 - 1)))
+
+    assert page == {"items": [], "next_cursor": None}
+
+
+@pytest.mark.parametrize("cursor", [
+    str(2 ** 63),
+    "9" * 30,
+    "0",
+    "-1",
+    "1e3",
+    " 12",
+    "12\n",
+    "abc",
+    "١٢٣",  # Arabic-Indic digits
+    "²",  # superscript two
+    "１２",  # fullwidth digits
+])
+def test_invalid_cursors_are_rejected(store, cursor):
+    with pytest.raises(ValueError):
+        asyncio.run(store.page(SESSION_ID, cursor=cursor))
@@ -0,0 +1,132 @@
+"""
+PhotoRoomClient against a local stand-in of the PhotoRoom API (httpx.MockTransport).
+"""
+import asyncio
+import os
+
+import httpx
+import pytest
+
+from backend.utils.photoroom_client import PhotoRoomClient, PhotoRoomError
+from backend.utils.resilience import is_transient
+
+CUTOUT = b"\x89PNG\r\n\x1a\n" + b"cut-out" * 100_000
+
+
+class TrackedStream(httpx.AsyncByteStream):
+    """Response body sent in chunks, recording whether the client closed it."""
+
+    def __init__(self, chunks, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+        self.closed = False
+
+    async def __aiter__(self):
+        for i, chunk in enumerate(self.chunks):
+            if i == self.fail_after:
+                raise httpx.ReadTimeout("Timed out reading the response")
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+
+def make_client(handler):
+    client = PhotoRoomClient(api_key="test-key", base_url="https://photoroom.test")
+    client._client = httpx.AsyncClient(base_url=client.base_url, transport=httpx.MockTransport(handler))
+    return client
+
+
+@pytest.fixture
+def input_image(tmp_path):
+    path = tmp_path / "input.png"
+    path.write_bytes(b"\x89PNG\r\n\x1a\n" + b"input" * 1000)
+    return str(path)
+
+
+def leftover_temp_files(directory):
+    return [name for name in os.listdir(directory) if name.endswith(".tmp")]
+
+
+def test_segment_streams_the_cutout_to_disk(tmp_path, input_image):
+    requests = []
+    stream = TrackedStream([CUTOUT[i:i + 64 * 1024] for i in range(0, len(CUTOUT), 64 * 1024)])
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, stream=stream, headers={"content-type": "image/png"})
+
+    async def scenario():
+        client = make_client(handler)
+        try:
+            return await client.segment(input_image, str(tmp_path / "output.png"))
+        finally:
+            await client.aclose()
+
+    output_path = asyncio.run(scenario())
+
+    assert output_path == str(tmp_path / "output.png")
+    with open(output_path, "rb") as f:
+        assert f.read() == CUTOUT
+    assert stream.closed
+    assert leftover_temp_files(tmp_path) == []
+    assert requests[0].url.path == "/v1/segment"
+    assert requests[0].headers["x-api-key"] == "test-key"
+    assert b'name="image_file"' in requests[0].read()
+
+
+def test_server_error_releases_the_connection_and_leaves_no_file(tmp_path, input_image):
+    stream = TrackedStream([b'{"detail": "upstream unavailable"}'])
+
+    def handler(request):
+        return httpx.Response(503, stream=stream, headers={"retry-after": "3"})
+
+    async def scenario():
+        client = make_client(handler)
+        try:
+            await client.segment(input_image, str(tmp_path / "output.png"))
+        finally:
+            await client.aclose()
+
+    with pytest.raises(PhotoRoomError) as excinfo:
+        asyncio.run(scenario())
+
+    assert excinfo.value.status_code == 503
+    assert excinfo.value.headers["retry-after"] == "3"
+    assert is_transient(excinfo.value)
+    assert stream.closed
+    assert not os.path.exists(tmp_path / "output.png")
+    assert leftover_temp_files(tmp_path) == []
+
+
+def test_timeout_mid_download_leaves_no_file(tmp_path, input_image):
+    stream = TrackedStream([CUTOUT[:1024], CUTOUT[1024:2048], CUTOUT[2048:]], fail_after=2)
+
+    def handler(request):
+        return httpx.Response(200, stream=stream)
+
+    async def scenario():
+        client = make_client(handler)
+        try:
+            await client.segment(input_image, str(tmp_path / "output.png"))
+        finally:
+            await client.aclose()
+
+    with pytest.raises(httpx.ReadTimeout) as excinfo:
+        asyncio.run(scenario())
+
+    assert is_transient(excinfo.value)
+    assert stream.closed
+    assert not os.path.exists(tmp_path / "output.png")
+    assert leftover_temp_files(tmp_path) == []
+
+
+def test_missing_api_key_fails_before_any_request(tmp_path, input_image):
+    def handler(request):
+        raise AssertionError("No request expected")
+
+    client = make_client(handler)
+    client.api_key = None
+
+    with pytest.raises(ValueError):
+        asyncio.run(client.segment(input_image, str(tmp_path / "output.png")))
@@ -0,0 +1,206 @@
+"""
+ResiliencePolicy and CircuitBreaker against a fake provider.
+"""
+import asyncio
+
+import pytest
+
+from backend.utils import resilience
+from backend.utils.resilience import (
+    BREAKER_CLOSED,
+    BREAKER_HALF_OPEN,
+    BREAKER_OPEN,
+    CircuitBreaker,
+    ProviderUnavailableError,
+    ResiliencePolicy,
+)
+
+
+class ProviderError(Exception):
+    """Error shaped like the provider SDKs' HTTP errors."""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeProvider:
+    """Answers each call with the next scripted outcome: an exception to raise or a result."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record retry delays instead of waiting for them."""
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(resilience.asyncio, "sleep", sleep)
+    return delays
+
+
+def make_policy(max_retries=3, failure_threshold=5, reset_seconds=30):
+    policy = ResiliencePolicy("fake", rate=1000, burst=1000, max_retries=max_retries)
+    policy.breaker = CircuitBreaker("fake", failure_threshold=failure_threshold, reset_seconds=reset_seconds)
+    return policy
+
+
+def expire_open_period(breaker):
+    breaker.opened_at -= breaker.reset_seconds
+
+
+def test_transient_errors_are_retried_with_backoff(sleeps):
+    provider = FakeProvider(ProviderError(503), ProviderError(502), "result.png")
+    policy = make_policy()
+
+    assert asyncio.run(policy.call(provider)) == "result.png"
+
+    assert provider.calls == 3
+    assert policy.retries == 2
+    assert policy.failures == 2
+    assert len(sleeps) == 2
+    for attempt, delay in enumerate(sleeps):
+        assert 0 <= delay <= resilience.RETRY_BASE_DELAY_SECONDS * 2 ** attempt
+    assert policy.breaker.state == BREAKER_CLOSED
+    assert policy.breaker.failures == 0
+
+
+def test_backoff_grows_exponentially_up_to_the_maximum():
+    policy = make_policy()
+    for attempt in range(12):
+        cap = min(resilience.RETRY_BASE_DELAY_SECONDS * 2 ** attempt, resilience.RETRY_MAX_DELAY_SECONDS)
+        assert all(0 <= policy.backoff(attempt) <= cap for _ in range(50))
+
+
+def test_retries_give_up_after_max_retries(sleeps):
+    provider = FakeProvider(*[ProviderError(500)] * 3)
+    policy = make_policy(max_retries=2)
+
+    with pytest.raises(ProviderUnavailableError):
+        asyncio.run(policy.call(provider))
+
+    assert provider.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_non_transient_errors_are_not_retried(sleeps):
+    provider = FakeProvider(ProviderError(400), "unused")
+    policy = make_policy()
+
+    with pytest.raises(ProviderError):
+        asyncio.run(policy.call(provider))
+
+    assert provider.calls == 1
+    assert sleeps == []
+    assert policy.breaker.failures == 0
+
+
+def test_retry_after_header_sets_the_delay(sleeps):
+    provider = FakeProvider(ProviderError(429, {"retry-after": "2"}), "result.png")
+    policy = make_policy()
+
+    assert asyncio.run(policy.call(provider)) == "result.png"
+
+    assert sleeps == [2.0]
+
+
+def test_retry_after_beyond_the_maximum_delay_is_not_waited_for(sleeps):
+    wait = resilience.RETRY_MAX_DELAY_SECONDS + 10
+    provider = FakeProvider(ProviderError(503, {"retry-after": str(wait)}), "unused")
+    policy = make_policy()
+
+    with pytest.raises(ProviderUnavailableError) as excinfo:
+        asyncio.run(policy.call(provider))
+
+    assert provider.calls == 1
+    assert sleeps == []
+    assert excinfo.value.retry_after >= wait
+
+
+def test_breaker_opens_after_consecutive_failures(sleeps):
+    provider = FakeProvider(*[ProviderError(503)] * 3, "unused")
+    policy = make_policy(max_retries=0, failure_threshold=3)
+
+    for _ in range(3):
+        with pytest.raises(ProviderUnavailableError):
+            asyncio.run(policy.call(provider))
+    assert policy.breaker.state == BREAKER_OPEN
+    assert policy.breaker.times_opened == 1
+
+    with pytest.raises(ProviderUnavailableError) as excinfo:
+        asyncio.run(policy.call(provider))
+    assert provider.calls == 3
+    assert 0 < excinfo.value.retry_after <= policy.breaker.reset_seconds
+    with pytest.raises(ProviderUnavailableError):
+        policy.ensure_available()
+
+
+def test_half_open_breaker_lets_a_single_trial_through():
+    policy = make_policy(max_retries=0, failure_threshold=1)
+    policy.breaker.record_failure()
+    expire_open_period(policy.breaker)
+    assert policy.breaker.state == BREAKER_HALF_OPEN
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def trial():
+            await release.wait()
+            return "result.png"
+
+        trial_call = asyncio.create_task(policy.call(trial))
+        await asyncio.sleep(0)
+        with pytest.raises(ProviderUnavailableError):
+            await policy.call(FakeProvider("unused"))
+        release.set()
+        return await trial_call
+
+    assert asyncio.run(scenario()) == "result.png"
+    assert policy.breaker.state == BREAKER_CLOSED
+
+
+def test_failed_trial_reopens_the_breaker(sleeps):
+    policy = make_policy(max_retries=3, failure_threshold=1)
+    policy.breaker.record_failure()
+    expire_open_period(policy.breaker)
+    provider = FakeProvider(ProviderError(503), "unused")
+
+    with pytest.raises(ProviderUnavailableError):
+        asyncio.run(policy.call(provider))
+
+    assert provider.calls == 1
+    assert sleeps == []
+    assert policy.breaker.state == BREAKER_OPEN
+    assert policy.breaker.times_opened == 2
+
+
+def test_only_the_trial_call_releases_the_trial():
+    breaker = CircuitBreaker("fake", failure_threshold=1, reset_seconds=30)
+    earlier_call = breaker.before_call()
+    breaker.record_failure(earlier_call)
+    expire_open_period(breaker)
+
+    trial = breaker.before_call()
+    assert trial and not earlier_call
+    # A call admitted before the breaker opened ends while the trial runs
+    breaker.record_ignored(earlier_call)
+    with pytest.raises(ProviderUnavailableError):
+        breaker.before_call()
+
+    breaker.record_ignored(trial)
+    assert breaker.before_call()
@@ -0,0 +1,143 @@
+"""
+S3Storage against a local stand-in of an S3-compatible bucket (httpx.MockTransport).
+"""
+import asyncio
+import hashlib
+import os
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.utils.s3_client import S3Client
+from backend.utils.storage import S3Storage, StorageFiles, hash_file
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + b"pixels" * 50_000
+
+
+class FakeBucket:
+    """In-memory bucket answering path-style PUT, GET and HEAD requests."""
+
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.requests = []
+
+    def handler(self, request):
+        self.requests.append(request)
+        assert request.headers["authorization"].startswith("AWS4-HMAC-SHA256 Credential=test-access/")
+        bucket, _, key = request.url.path.lstrip("/").partition("/")
+        if bucket != self.name:
+            return httpx.Response(404)
+        if request.method == "PUT":
+            body = request.read()
+            assert request.headers["x-amz-content-sha256"] == hashlib.sha256(body).hexdigest()
+            self.objects[key] = body
+            return httpx.Response(200)
+        if key not in self.objects:
+            return httpx.Response(404)
+        if request.method == "HEAD":
+            return httpx.Response(200)
+        return httpx.Response(200, content=self.objects[key])
+
+
+@pytest.fixture
+def bucket():
+    return FakeBucket("images")
+
+
+@pytest.fixture
+def store(tmp_path, bucket):
+    client = S3Client(bucket="images", endpoint_url="https://s3.test", access_key="test-access",
+                      secret_key="test-secret")
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(bucket.handler))
+    return S3Storage("results", str(tmp_path / "results"), "/results", key_prefix="test/", client=client)
+
+
+def stage(store, content=IMAGE, extension="png"):
+    path = store.staging_path(extension)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def test_put_file_stores_locally_and_uploads(store, bucket):
+    digest = hashlib.sha256(IMAGE).hexdigest()
+
+    path = asyncio.run(store.put_file(stage(store), "png"))
+
+    assert path == os.path.join(store.root, digest[:2], digest[2:4], f"{digest}.png")
+    assert hash_file(path) == digest
+    assert bucket.objects == {f"test/results/{digest[:2]}/{digest[2:4]}/{digest}.png": IMAGE}
+    assert os.listdir(store.staging_dir) == []
+
+
+def test_put_file_of_a_stored_file_is_not_uploaded_again(store, bucket):
+    first = asyncio.run(store.put_file(stage(store), "png"))
+    second = asyncio.run(store.put_file(stage(store), "png"))
+
+    assert first == second
+    assert len([r for r in bucket.requests if r.method == "PUT"]) == 1
+    assert os.listdir(store.staging_dir) == []
+
+
+def test_put_file_of_a_derived_file_signs_its_contents(store, bucket):
+    digest = hashlib.sha256(b"source").hexdigest()
+
+    path = asyncio.run(store.put_file(stage(store), "png", digest, name=f"{digest}_no_bg"))
+
+    assert os.path.basename(path) == f"{digest}_no_bg.png"
+    assert bucket.objects[store.key_for(path)] == IMAGE
+
+
+def test_failed_upload_keeps_the_local_copy(store, bucket):
+    bucket.name = "other"
+
+    path = asyncio.run(store.put_file(stage(store), "png"))
+
+    assert os.path.isfile(path)
+    assert bucket.objects == {}
+
+
+def test_fetch_downloads_files_missing_locally(store, bucket):
+    path = asyncio.run(store.put_file(stage(store), "png"))
+    os.remove(path)
+
+    assert asyncio.run(store.fetch(path)) == path
+    with open(path, "rb") as f:
+        assert f.read() == IMAGE
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith(".tmp")]
+
+
+def test_fetch_of_a_missing_object_returns_none(store):
+    assert asyncio.run(store.fetch(store.path_for("0" * 64, "png"))) is None
+
+
+def test_fetch_never_downloads_staged_or_outside_paths(store, bucket, tmp_path):
+    assert asyncio.run(store.fetch(os.path.join(store.staging_dir, "partial.png"))) is None
+    assert asyncio.run(store.fetch(str(tmp_path / "elsewhere.png"))) is None
+    assert bucket.requests == []
+
+
+def test_resolve_maps_references_inside_the_store(store):
+    assert store.resolve("ab/cd/abcd.png") == os.path.join(store.root, "ab", "cd", "abcd.png")
+    assert store.resolve("/ab/cd/abcd.png") == os.path.join(store.root, "ab", "cd", "abcd.png")
+    for reference in ("../uploads/x.png", "ab/../../x.png", "", "/", ".staging/partial.png"):
+        with pytest.raises(ValueError):
+            store.resolve(reference)
+
+
+def test_served_files_are_fetched_and_staged_files_are_not(store):
+    path = asyncio.run(store.put_file(stage(store), "png"))
+    os.remove(path)
+    staged = stage(store)
+    app = FastAPI()
+    app.mount("/results", StorageFiles(store), name="results")
+
+    with TestClient(app) as client:
+        response = client.get(store.url(path))
+        assert response.status_code == 200
+        assert response.content == IMAGE
+        assert client.get(f"/results/.staging/{os.path.basename(staged)}").status_code == 404
+        assert client.get("/results/../main.py").status_code == 404